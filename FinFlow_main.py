@@ -1,12 +1,44 @@
+import asyncio
+import functools
+import logging
+import math
+import os
+import tempfile
+import time
 import telegram
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import (Update, ReplyKeyboardMarkup, InputFile,
+                      InputMediaDocument, InputMediaPhoto)
 from telegram.ext import (Application,
                           CommandHandler, MessageHandler,
                           filters, ContextTypes)
-import json
-import os
-import matplotlib.pyplot as plt
-import io
+from datetime import date, timedelta
+from budgets import Budgets
+from charts import ChartRenderer
+from csv_io import (CsvImporter, filter_period, iter_csv, record_rows,
+                    summary_rows, write_chunks)
+import metrics
+from outbox import Outbox
+from recurring import Recurring
+from storage import JsonStorage, Storage
+
+logger = logging.getLogger(__name__)
+
+# Bot API не отдает ботам файлы больше 20 МБ
+MAX_CSV_BYTES = 20 << 20
+
+# Тексты диаграмм: (чего нет, заголовок итога)
+CHART_TEXTS = {
+    "income": ("доходах", "Общие доходы"),
+    "expense": ("расходах", "Общие расходы"),
+}
+
+# Максимальная длина подписи к фото и альбому в Bot API
+CAPTION_LIMIT = 1024
+
+# Как часто проверяются сроки регулярных операций, секунды
+RECURRING_INTERVAL = 60
+
+KIND_NAMES = {"income": "Доход", "expense": "Расход"}
 
 
 class FinanceBot:
@@ -17,7 +49,20 @@ class FinanceBot:
     просматривать статистику и получать визуализацию данных.
     :ivar token: Токен бота Telegram
     :type token: str
-    :ivar data: Финансовые данные всех пользователей
+    :ivar storage: Хранилище данных пользователей
+    :type storage: storage.Storage
+    :ivar charts: Рендерер диаграмм
+    :type charts: charts.ChartRenderer
+    :ivar importer: Импорт банковских выписок
+    :type importer: csv_io.CsvImporter
+    :ivar outbox: Очередь исходящих запросов с ограничением скорости
+    :type outbox: outbox.Outbox
+    :ivar budgets: Месячные лимиты расходов по категориям
+    :type budgets: budgets.Budgets
+    :ivar recurring: Ежемесячные операции по расписанию
+    :type recurring: recurring.Recurring
+    :ivar data: Финансовые данные всех пользователей (None, пока
+        данные загружаются в фоне)
     :type data: dict
     :ivar kb: Главная клавиатура
     :type kb: list
@@ -27,15 +72,45 @@ class FinanceBot:
     :type inc_cat: list
     """
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, storage: Storage = None,
+                 charts: ChartRenderer = None,
+                 background_load: bool = False,
+                 importer: CsvImporter = None, outbox: Outbox = None,
+                 budgets: Budgets = None, recurring: Recurring = None):
         """
         Инициализирует бота с заданным токеном.
 
         :param token: Токен бота, полученный от BotFather
         :type token: str
+        :param storage: Хранилище данных, по умолчанию data.json
+        :type storage: storage.Storage
+        :param charts: Рендерер диаграмм, по умолчанию пул из 2 процессов
+        :type charts: charts.ChartRenderer
+        :param background_load: Загружать данные в фоновом потоке, чтобы
+            бот сразу отвечал на /start и принимал новые операции
+        :type background_load: bool
+        :param importer: Импорт выписок, по умолчанию с правилами
+            csv_io.DEFAULT_RULES и категориями клавиатур бота
+        :type importer: csv_io.CsvImporter
+        :param outbox: Очередь исходящих запросов, по умолчанию с лимитами
+            Bot API: 1 сообщение в секунду в чат и 30 в секунду всего
+        :type outbox: outbox.Outbox
+        :param budgets: Бюджеты, по умолчанию из budgets.json
+        :type budgets: budgets.Budgets
+        :param recurring: Регулярные операции, по умолчанию
+            из recurring.json
+        :type recurring: recurring.Recurring
         """
         self.token = token
-        self.data = self.load_data()
+        self.storage = storage if storage is not None else JsonStorage()
+        self.charts = charts if charts is not None else ChartRenderer()
+        self.flusher = None
+        self.locks = {}
+        if background_load:
+            self.storage.load_background()
+            self.data = None
+        else:
+            self.data = self.load_data()
         self.kb = [
             ["Доход", "Расход"],
             ["Баланс", "Статистика"],
@@ -51,34 +126,50 @@ class FinanceBot:
             ["Подарок", "Премия", "Прочее"],
             ["Назад"]
         ]
+        self.branches = {
+            "Доход": "income", "Расход": "expense", "Баланс": "balance",
+            "Статистика": "stats", "Категории": "categories",
+            "Назад": "back"
+        }
+        for row in self.exp_cat + self.inc_cat:
+            for name in row:
+                self.branches.setdefault(name, "category")
+        if importer is None:
+            importer = CsvImporter(categories={
+                kind: {n for row in rows for n in row if n != "Назад"}
+                for kind, rows in (("expense", self.exp_cat),
+                                   ("income", self.inc_cat))
+            })
+        self.importer = importer
+        self.outbox = outbox if outbox is not None else Outbox()
+        self.budgets = budgets if budgets is not None else Budgets()
+        self.recurring = (recurring if recurring is not None
+                          else Recurring())
 
     def load_data(self):
         """
-        Загружает финансовые данные пользователей из JSON файла.
+        Загружает финансовые данные пользователей из хранилища.
 
-        :return: Словарь с данными пользователей или пустой словарь при ошибке
+        :return: Словарь с данными пользователей (пустой, если файла нет)
         :rtype: dict
+        :raises snapshot.SnapshotError: Если снимок поврежден
         """
-        try:
-            if os.path.exists("data.json"):
-                with open("data.json", "r") as f:
-                    return json.load(f)
-        except Exception:
-            pass
-        return {}
+        return self.storage.load()
 
     def save_data(self):
         """
         Сохраняет финансовые данные пользователей в JSON файл.
 
-        :raises OSError: При проблемах с записью в файл
+        Во время фоновой загрузки сначала ждет ее окончания, иначе
+        еще пустые данные заменили бы снимок на диске.
+
+        :raises OSError: При проблемах с записью в файл или если
+            фоновая загрузка завершилась ошибкой
         """
-        try:
-            with open("data.json", "w", encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
-        except Exception:
-            raise OSError
+        self.storage.wait_loaded()
+        self.storage.save(self.data)
 
+    @metrics.timed("start")
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Обработчик команды /start - начало работы с ботом.
@@ -88,6 +179,7 @@ class FinanceBot:
         :param context: Контекст выполнения, содержит дополнительные данные
         :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
         """
+        metrics.UPDATES.inc()
         keyboard = ReplyKeyboardMarkup(self.kb, resize_keyboard=True)
         await update.message.reply_text(
             "Выберите действие:",
@@ -108,57 +200,67 @@ class FinanceBot:
         text = update.message.text
         user_id = str(update.message.from_user.id)
 
-        if text == "Доход":
-            context.user_data["action"] = "income"
-            keyboard = ReplyKeyboardMarkup(self.inc_cat, resize_keyboard=True)
-            await update.message.reply_text(
-                "Выберите категорию дохода:",
-                reply_markup=keyboard
-            )
+        metrics.UPDATES.inc()
+        branch = self.branches.get(text, "amount")
+        with metrics.HANDLER_SECONDS.time(handler="hand_mess", branch=branch):
+            if text == "Доход":
+                context.user_data["action"] = "income"
+                keyboard = ReplyKeyboardMarkup(self.inc_cat,
+                                               resize_keyboard=True)
+                await update.message.reply_text(
+                    "Выберите категорию дохода:",
+                    reply_markup=keyboard
+                )
 
-        elif text == "Расход":
-            context.user_data["action"] = "expense"
-            keyboard = ReplyKeyboardMarkup(self.exp_cat, resize_keyboard=True)
-            await update.message.reply_text(
-                "Выберите категорию расхода:",
-                reply_markup=keyboard
-            )
+            elif text == "Расход":
+                context.user_data["action"] = "expense"
+                keyboard = ReplyKeyboardMarkup(self.exp_cat,
+                                               resize_keyboard=True)
+                await update.message.reply_text(
+                    "Выберите категорию расхода:",
+                    reply_markup=keyboard
+                )
 
-        elif text == "Баланс":
-            await self.show_bal(update, user_id)
+            elif text == "Баланс":
+                await self.show_bal(update, user_id)
 
-        elif text == "Статистика":
-            await self.show_stat(update, user_id)
+            elif text == "Статистика":
+                await self.show_stat(update, user_id)
 
-        elif text == "Категории":
-            await self.show_cat(update, user_id)
+            elif text == "Категории":
+                await self.show_cat(update, user_id)
 
-        elif text in ["Еда", "Транспорт", "Жилье", "Развлечения",
-                      "Одежда", "Здоровье", "Образование", "Подарки"]:
-            context.user_data["category"] = text
-            await update.message.reply_text(f"Введите сумму для {text}:")
+            elif text in ["Еда", "Транспорт", "Жилье", "Развлечения",
+                          "Одежда", "Здоровье", "Образование", "Подарки"]:
+                context.user_data["category"] = text
+                await update.message.reply_text(f"Введите сумму для {text}:")
 
-        elif text in ["Зарплата", "Бизнес", "Инвестиции", "Подарок",
-                      "Премия", "Прочее"]:
-            context.user_data["category"] = text
-            await update.message.reply_text(f"Введите сумму для {text}:")
+            elif text in ["Зарплата", "Бизнес", "Инвестиции", "Подарок",
+                          "Премия", "Прочее"]:
+                context.user_data["category"] = text
+                await update.message.reply_text(f"Введите сумму для {text}:")
 
-        elif text == "Назад":
-            keyboard = ReplyKeyboardMarkup(self.kb, resize_keyboard=True)
-            await update.message.reply_text(
-                "Возвращаемся в главное меню",
-                reply_markup=keyboard
-            )
+            elif text == "Назад":
+                keyboard = ReplyKeyboardMarkup(self.kb, resize_keyboard=True)
+                await update.message.reply_text(
+                    "Возвращаемся в главное меню",
+                    reply_markup=keyboard
+                )
 
-        else:
-            await self.hand_amnt(update, context, user_id, text)
+            else:
+                await self.hand_amnt(update, context, user_id, text)
 
+    @metrics.timed("hand_amnt")
     async def hand_amnt(self, update: Update,
                         context: ContextTypes.DEFAULT_TYPE,
                         user_id: str, text: str):
         """
         Обрабатывает ввод суммы для дохода или расхода.
 
+        Во время фоновой загрузки операция сразу ставится в очередь,
+        а подтверждение приходит после загрузки: если она не
+        удалась, пользователь узнает, что операция не сохранена.
+
         :param update: Объект с информацией о входящем сообщении
         :type update: telegram.Update
         :param context: Контекст выполнения, содержит дополнительные данные
@@ -171,6 +273,8 @@ class FinanceBot:
         """
         try:
             amount = float(text)
+            if not math.isfinite(amount):
+                raise ValueError(text)
             action = context.user_data.get("action")
             category = context.user_data.get("category")
 
@@ -180,174 +284,706 @@ class FinanceBot:
                 )
                 return
 
-            if user_id not in self.data:
-                self.data[user_id] = []
-
             record = {
                 "type": "income" if action == "income" else "expense",
                 "amount": amount,
-                "category": category
+                "category": category,
+                "ts": int(time.time())
             }
 
-            self.data[user_id].append(record)
-            self.save_data()
+            self.charts.invalidate(user_id)
+            try:
+                self.storage.append(user_id, record)
+                await self.storage.loaded()
+            except OSError:
+                logger.exception("Не удалось сохранить операцию")
+                if self.storage.load_error is not None:
+                    text = ("Данные не загрузились, операция не сохранена. "
+                            "Попробуйте позже")
+                else:
+                    text = ("Операция принята, но пока не записана на "
+                            "диск: она сохранится при следующей записи")
+                await update.message.reply_text(text)
+                return
 
+            text = f"{category} {amount} руб. добавлен!"
+            alert = self.check_budget(user_id, record)
+            if alert:
+                text += f"\n{alert}"
             keyboard = ReplyKeyboardMarkup(self.kb, resize_keyboard=True)
-            await update.message.reply_text(
-                f"{category} {amount} руб. добавлен!",
-                reply_markup=keyboard
-            )
+            await update.message.reply_text(text, reply_markup=keyboard)
 
             context.user_data.clear()
 
         except ValueError:
             await update.message.reply_text("Введите число!")
 
-    async def show_bal(self, update: Update, user_id: str):
+    def check_budget(self, user_id: str, record: dict) -> str:
         """
-        Показывает текущий баланс пользователя.
+        Проверяет бюджет категории новой записи за O(1).
+
+        Расходы категории за месяц берутся из сводки месяца, которую
+        хранилище уже обновило при добавлении записи. Пока данные
+        загружаются в фоне, проверка пропускается: порог будет
+        замечен на следующей записи. Пройденный порог сохраняется
+        сразу в режиме "strict" и при остановке бота в "batched".
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param record: Добавленная запись
+        :type record: dict
+        :return: Текст предупреждения или None
+        :rtype: str
+        """
+        if record["type"] != "expense" or not self.storage.ready.is_set():
+            return None
+        alert = self.budget_alert(user_id, record["category"],
+                                  date.fromtimestamp(record["ts"]))
+        if alert and self.storage.durability == "strict":
+            self.budgets.flush()
+        return alert
+
+    def check_budgets(self, user_id: str, categories=None,
+                      today: date = None) -> list:
+        """
+        Проверяет бюджеты после пачки записей: импорта выписки
+        или регулярных операций.
+
+        Каждая категория с лимитом проверяется один раз, по сводке
+        текущего месяца; записи прошлых месяцев предупреждений
+        не вызывают.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param categories: Категории новых расходов, None - все с лимитом
+        :type categories: iterable
+        :param today: Текущая дата (для тестов)
+        :type today: datetime.date
+        :return: Тексты предупреждений
+        :rtype: list
+        """
+        limits = self.budgets.get(user_id)
+        if not limits or not self.storage.ready.is_set():
+            return []
+        today = today or date.today()
+        names = limits if categories is None else set(categories) & set(limits)
+        alerts = [self.budget_alert(user_id, category, today)
+                  for category in sorted(names)]
+        alerts = [alert for alert in alerts if alert]
+        if alerts and self.storage.durability == "strict":
+            self.budgets.flush()
+        return alerts
+
+    def budget_alert(self, user_id: str, category: str, day: date) -> str:
+        """
+        Сверяет расходы категории за месяц дня day с лимитом.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param category: Категория расходов
+        :type category: str
+        :param day: День, месяц которого проверяется
+        :type day: datetime.date
+        :return: Текст предупреждения о новом пороге или None
+        :rtype: str
+        """
+        limit = self.budgets.get(user_id).get(category)
+        if limit is None:
+            return None
+        month = self.storage.month_summary(user_id, day.year, day.month)
+        spent = month.exp_by_cat.get(category, 0) if month else 0
+        threshold = self.budgets.check(user_id, category,
+                                       (day.year, day.month), spent)
+        if threshold is None:
+            return None
+        percent = spent / limit * 100
+        if threshold >= 1:
+            return (f"Бюджет на {category} превышен: {spent} из {limit} руб. "
+                    f"за месяц ({percent:.0f}%)")
+        return (f"Внимание: на {category} потрачено {spent} из {limit} руб. "
+                f"за месяц ({percent:.0f}%)")
+
+    @metrics.timed("hand_budget")
+    async def hand_budget(self, update: Update,
+                          context: ContextTypes.DEFAULT_TYPE):
+        """
+        Обработчик команд /budget и /budgets.
+
+        /budget Еда 10000 - лимит расходов на категорию за месяц,
+        /budget Еда 0 - удалить лимит, /budgets - лимиты и расходы
+        текущего месяца.
+
+        :param update: Объект с информацией о входящем сообщении
+        :type update: telegram.Update
+        :param context: Контекст выполнения, содержит аргументы команды
+        :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
+        """
+        metrics.UPDATES.inc()
+        user_id = str(update.message.from_user.id)
+        command = update.message.text.split()[0][1:].split("@")[0]
+        args = list(context.args or [])
+        if command == "budgets" or not args:
+            await self.show_budgets(update, user_id)
+            return
+
+        categories = [n for row in self.exp_cat for n in row if n != "Назад"]
+        category = " ".join(args[:-1])
+        try:
+            limit = float(args[-1].replace(",", "."))
+            if category not in categories:
+                raise ValueError(category)
+            self.budgets.set(user_id, category, limit)
+        except ValueError:
+            await update.message.reply_text(
+                "Например: /budget Еда 10000 (0 - удалить лимит)\n"
+                f"Категории: {', '.join(categories)}"
+            )
+            return
+
+        if limit:
+            await update.message.reply_text(
+                f"Бюджет на {category}: {limit} руб. в месяц"
+            )
+        else:
+            await update.message.reply_text(f"Бюджет на {category} удален")
+
+    async def show_budgets(self, update: Update, user_id: str,
+                           today: date = None):
+        """
+        Показывает лимиты пользователя и расходы текущего месяца.
 
         :param update: Объект с информацией о входящем сообщении
         :type update: telegram.Update
         :param user_id: ID пользователя в Telegram
         :type user_id: str
+        :param today: Текущая дата (для тестов)
+        :type today: datetime.date
         """
-        if user_id not in self.data:
-            await update.message.reply_text("Нет операций")
+        limits = self.budgets.get(user_id)
+        if not limits:
+            await update.message.reply_text(
+                "Бюджетов нет. Например: /budget Еда 10000"
+            )
             return
 
-        inc = sum(r['amount'] for r in self.data[user_id]
-                  if r['type'] == 'income')
-        exp = sum(r['amount'] for r in self.data[user_id]
-                  if r['type'] == 'expense')
-        bal = inc - exp
+        await self.storage.loaded()
+        today = today or date.today()
+        month = self.storage.month_summary(user_id, today.year, today.month)
+        text = f"Бюджеты на {today:%m.%Y}:\n"
+        for category, limit in sorted(limits.items()):
+            spent = month.exp_by_cat.get(category, 0) if month else 0
+            percent = spent / limit * 100
+            text += f"  {category}: {spent} из {limit} руб. ({percent:.0f}%)\n"
+        await update.message.reply_text(text.rstrip())
+
+    @metrics.timed("hand_repeat")
+    async def hand_repeat(self, update: Update,
+                          context: ContextTypes.DEFAULT_TYPE):
+        """
+        Обработчик команды /repeat - ежемесячные операции.
 
-        text = f"""
-Доходы: {inc} руб.
-Расходы: {exp} руб.
-Баланс: {bal} руб.
+        /repeat расход Жилье 30000 5 - каждый месяц 5 числа,
+        /repeat удалить 1 - удалить операцию, /repeat - список.
+
+        :param update: Объект с информацией о входящем сообщении
+        :type update: telegram.Update
+        :param context: Контекст выполнения, содержит аргументы команды
+        :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
         """
+        metrics.UPDATES.inc()
+        user_id = str(update.message.from_user.id)
+        args = list(context.args or [])
+        if not args:
+            await self.show_repeat(update, user_id)
+            return
 
-        await update.message.reply_text(text)
+        if args[0].lower() == "удалить":
+            try:
+                rule = self.recurring.delete(user_id, int(args[-1]))
+            except ValueError:
+                await update.message.reply_text(
+                    "Например: /repeat удалить 1 (номер из списка /repeat)"
+                )
+                return
+            await update.message.reply_text(
+                f"Регулярная операция удалена: {rule['category']} "
+                f"{rule['amount']} руб."
+            )
+            return
+
+        kinds = {"доход": ("income", self.inc_cat),
+                 "расход": ("expense", self.exp_cat)}
+        try:
+            kind, rows = kinds[args[0].lower()]
+            category = " ".join(args[1:-2])
+            if category not in {n for row in rows for n in row} - {"Назад"}:
+                raise ValueError(category)
+            amount = float(args[-2].replace(",", "."))
+            rule = self.recurring.add(user_id, kind, category, amount,
+                                      int(args[-1]))
+        except (KeyError, IndexError, ValueError):
+            await update.message.reply_text(
+                "Например: /repeat расход Жилье 30000 5 - каждый месяц "
+                "5 числа, /repeat доход Зарплата 80000 10"
+            )
+            return
+
+        await update.message.reply_text(
+            f"{KIND_NAMES[kind]} {category} {amount} руб. будет добавляться "
+            f"каждый месяц, ближайший - "
+            f"{date.fromtimestamp(rule['next']):%d.%m.%Y}"
+        )
 
-    async def show_stat(self, update: Update, user_id: str):
+    async def show_repeat(self, update: Update, user_id: str):
         """
-        Показывает статистику с графиками доходов и расходов.
+        Показывает регулярные операции пользователя.
 
         :param update: Объект с информацией о входящем сообщении
         :type update: telegram.Update
         :param user_id: ID пользователя в Telegram
         :type user_id: str
         """
-        if user_id not in self.data or not self.data[user_id]:
-            await update.message.reply_text("Нет данных для статистики")
+        rules = self.recurring.get(user_id)
+        if not rules:
+            await update.message.reply_text(
+                "Регулярных операций нет. Например: "
+                "/repeat расход Жилье 30000 5"
+            )
             return
 
-        exp_by_cat = {}
-        inc_by_cat = {}
+        text = "Регулярные операции:\n"
+        for number, rule in enumerate(rules, 1):
+            text += (f"  {number}. {KIND_NAMES[rule['type']]} "
+                     f"{rule['category']}: {rule['amount']} руб., "
+                     f"{rule['day']} числа, ближайшая "
+                     f"{date.fromtimestamp(rule['next']):%d.%m.%Y}\n")
+        await update.message.reply_text(text.rstrip())
 
-        for record in self.data[user_id]:
-            cat = record["category"]
-            amount = record["amount"]
+    async def tick_recurring(self, context=None, now: float = None) -> int:
+        """
+        Добавляет операции всех наступивших сроков одной пачкой.
+
+        Вызывается job_queue раз в RECURRING_INTERVAL секунд. Все
+        наступившие сроки, включая пропущенные, пока бот не работал,
+        собираются за один проход, записи каждого пользователя
+        добавляются в хранилище вместе, и вся пачка сохраняется
+        одним flush; после этого сохраняются сдвинутые сроки, а
+        пользователям, чьи расходы перешли порог бюджета, приходит
+        предупреждение. Если flush не удался, записи остаются в
+        очереди хранилища, а сроки - сдвинутыми в памяти: следующий
+        проход сохраняет их, не добавляя операции второй раз. Пока
+        данные загружаются в фоне, проход откладывается.
+
+        :param context: Контекст задачи job_queue
+        :type context: telegram.ext.CallbackContext
+        :param now: Текущее время (для тестов и замеров)
+        :type now: float
+        :return: Количество добавленных записей
+        :rtype: int
+        :raises OSError: При проблемах с записью
+        """
+        if not self.storage.ready.is_set():
+            return 0
+        with metrics.RECURRING_SECONDS.time():
+            now = time.time() if now is None else now
+            batch = self.recurring.due(now)
+            for user_id in batch:
+                self.charts.invalidate(user_id)
+            if batch:
+                self.storage.append_batch(batch)
+            if not self.recurring.dirty:
+                return 0
+            # при ошибке записи сроки остаются сдвинутыми: операции уже
+            # в очереди хранилища, их и сроки сохранит следующий проход
+            self.storage.flush()
+            self.recurring.save()
+        count = sum(len(records) for records in batch.values())
+        metrics.RECURRING_RECORDS.inc(count)
+
+        alerts = {}
+        for user_id, records in batch.items():
+            categories = {record["category"] for record in records
+                          if record["type"] == "expense"}
+            if categories:
+                alerts[user_id] = self.check_budgets(
+                    user_id, categories, date.fromtimestamp(now))
+        if context is not None:
+            results = await asyncio.gather(*(
+                context.bot.send_message(chat_id=int(user_id),
+                                         text="\n".join(texts))
+                for user_id, texts in alerts.items() if texts
+            ), return_exceptions=True)
+            for error in results:
+                if isinstance(error, Exception):
+                    logger.warning("Не удалось отправить "
+                                   "предупреждение о бюджете: %s", error)
+        return count
+
+    @metrics.timed("hand_doc")
+    async def hand_doc(self, update: Update,
+                       context: ContextTypes.DEFAULT_TYPE):
+        """
+        Импортирует банковскую выписку из присланного CSV файла.
 
-            if record["type"] == "expense":
-                exp_by_cat[cat] = exp_by_cat.get(cat, 0) + amount
-            else:
-                inc_by_cat[cat] = inc_by_cat.get(cat, 0) + amount
+        Файл скачивается во временный каталог и читается построчно,
+        операции сохраняются пачками.
 
-        await self.send_inc_chrt(update, inc_by_cat)
-        await self.send_exp_chrt(update, exp_by_cat)
-        await self.send_txt_stat(update, inc_by_cat, exp_by_cat)
+        :param update: Объект с информацией о входящем сообщении
+        :type update: telegram.Update
+        :param context: Контекст выполнения, содержит дополнительные данные
+        :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
+        """
+        metrics.UPDATES.inc()
+        user_id = str(update.message.from_user.id)
+        document = update.message.document
+        if document.file_size and document.file_size > MAX_CSV_BYTES:
+            await update.message.reply_text("Файл больше 20 МБ")
+            return
 
-    async def send_inc_chrt(self, update: Update, income_by_category: dict):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "statement.csv")
+            file = await document.get_file()
+            await file.download_to_drive(path)
+            try:
+                stats = await self.importer.import_file(self.storage,
+                                                        user_id, path)
+            except ValueError as e:
+                await update.message.reply_text(
+                    f"Не удалось прочитать выписку: {e}"
+                )
+                return
+        self.charts.invalidate(user_id)
+
+        text = (f"Импортировано операций: {stats['imported']}\n"
+                f"Доходы: {stats['income']} руб.\n"
+                f"Расходы: {stats['expense']} руб.\n"
+                f"Пропущено строк: {stats['skipped']}")
+        if stats["expense"]:
+            alerts = self.check_budgets(user_id)
+            if alerts:
+                text += "\n" + "\n".join(alerts)
+        await update.message.reply_text(text)
+
+    @metrics.timed("hand_export")
+    async def hand_export(self, update: Update,
+                          context: ContextTypes.DEFAULT_TYPE):
         """
-        Создает и отправляет круговую диаграмму доходов.
+        Обработчик команды /export - выгрузка операций в CSV.
 
-        :param update: Объект с информацией о входящем сообщения
+        Например: /export, /export месяц, /export год итоги.
+        Аргумент "итоги" добавляет второй файл с суммами по категориям.
+        Файл собирается частями во временном файле (в памяти до 1 МБ,
+        дальше на диске), между частями бот отвечает другим.
+
+        :param update: Объект с информацией о входящем сообщении
         :type update: telegram.Update
-        :param income_by_category: Словарь с категориями доходов и суммами
-        :type income_by_category: dict
+        :param context: Контекст выполнения, содержит аргументы команды
+        :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
         """
-        if not income_by_category:
-            await update.message.reply_text("Нет данных о доходах")
+        metrics.UPDATES.inc()
+        user_id = str(update.message.from_user.id)
+        args = list(context.args or [])
+        totals = [a for a in args if a.lower() in ("итоги", "summary")]
+        try:
+            period = self.parse_period([a for a in args if a not in totals])
+        except ValueError:
+            await update.message.reply_text(
+                "Период: неделя, месяц, год, число дней "
+                "или даты ГГГГ-ММ-ДД [ГГГГ-ММ-ДД], и при желании: итоги"
+            )
             return
 
-        plt.figure(figsize=(8, 6))
+        await self.storage.loaded()
+        summ = self.get_summ(user_id, period)
+        if summ is None or not summ.count:
+            await update.message.reply_text("Нет операций")
+            return
 
-        categories = list(income_by_category.keys())
-        amounts = list(income_by_category.values())
+        records = self.storage.records(user_id)
+        if period is not None:
+            records = filter_period(records, *period)
+        sheets = [("finflow_operations.csv", record_rows(records))]
+        if totals:
+            sheets.append(("finflow_categories.csv", summary_rows(summ)))
+
+        caption = self.period_title(period).strip() or None
+        for filename, rows in sheets:
+            with tempfile.SpooledTemporaryFile(max_size=1 << 20) as f:
+                await write_chunks(iter_csv(rows), f)
+                f.seek(0)
+                # без read_file_handle=False PTB прочитал бы весь файл
+                # в память; так httpx отправляет его частями с диска
+                await update.message.reply_document(
+                    document=InputFile(f, filename=filename,
+                                       read_file_handle=False),
+                    caption=caption
+                )
 
-        colors = ['#90EE90', '#98FB98', '#8FBC8F',
-                  '#3CB371', '#2E8B57', '#228B22']
+    @metrics.timed("hand_period")
+    async def hand_period(self, update: Update,
+                          context: ContextTypes.DEFAULT_TYPE):
+        """
+        Обработчик команд /balance, /stats и /categories с периодом.
 
-        plt.pie(
-            amounts,
-            labels=categories,
-            autopct='%1.1f%%',
-            startangle=90,
-            colors=colors[:len(categories)],
-            textprops={'fontsize': 10}
-        )
+        Например: /stats месяц, /balance 7, /categories 2026-01-01 2026-01-31
 
-        plt.title('Доходы по категориям', fontsize=14, fontweight='bold')
+        :param update: Объект с информацией о входящем сообщении
+        :type update: telegram.Update
+        :param context: Контекст выполнения, содержит аргументы команды
+        :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
+        """
+        metrics.UPDATES.inc()
+        user_id = str(update.message.from_user.id)
+        try:
+            period = self.parse_period(context.args or [])
+        except ValueError:
+            await update.message.reply_text(
+                "Период: неделя, месяц, год, число дней "
+                "или даты ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]"
+            )
+            return
 
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=80, bbox_inches='tight')
-        buf.seek(0)
-        plt.close()
+        command = update.message.text.split()[0][1:].split("@")[0]
+        views = {
+            "balance": self.show_bal,
+            "stats": self.show_stat,
+            "categories": self.show_cat,
+        }
+        await views[command](update, user_id, period)
 
-        total_income = sum(amounts)
-        await update.message.reply_photo(
-            photo=buf,
-            caption=f"Общие доходы: {total_income} руб."
-        )
+    @staticmethod
+    def parse_period(args: list, today: date = None):
+        """
+        Разбирает период из аргументов команды.
+
+        :param args: Аргументы команды
+        :type args: list
+        :param today: Текущая дата, по умолчанию сегодня
+        :type today: datetime.date
+        :return: Пара дат (начало, конец) или None - за все время
+        :rtype: tuple
+        :raises ValueError: Если период не распознан
+        """
+        today = today or date.today()
+        if not args:
+            return None
+        word = args[0].lower()
+        if len(args) == 1:
+            if word in ("неделя", "week"):
+                return today - timedelta(days=6), today
+            if word in ("месяц", "month"):
+                return today.replace(day=1), today
+            if word in ("год", "year"):
+                return today.replace(month=1, day=1), today
+            if word.isdigit() and 0 < int(word) <= 36600:
+                return today - timedelta(days=int(word) - 1), today
+        if len(args) <= 2:
+            start = date.fromisoformat(args[0])
+            end = date.fromisoformat(args[-1])
+            if start <= end:
+                return start, end
+        raise ValueError(args)
+
+    def get_summ(self, user_id: str, period: tuple = None):
+        """
+        Возвращает сводку пользователя за все время или за период.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param period: Пара дат (начало, конец) или None
+        :type period: tuple
+        :return: Сводка или None, если у пользователя нет операций
+        :rtype: summary.Summary
+        """
+        if period is None:
+            return self.storage.summary(user_id)
+        return self.storage.period_summary(user_id, *period)
+
+    @staticmethod
+    def period_title(period: tuple = None) -> str:
+        """
+        Формирует заголовок отчета за период.
+
+        :param period: Пара дат (начало, конец) или None
+        :type period: tuple
+        :rtype: str
+        """
+        if period is None:
+            return ""
+        start, end = period
+        return f"Период: {start:%d.%m.%Y} - {end:%d.%m.%Y}\n"
+
+    @metrics.timed("show_bal")
+    async def show_bal(self, update: Update, user_id: str,
+                       period: tuple = None):
+        """
+        Показывает текущий баланс пользователя.
+
+        :param update: Объект с информацией о входящем сообщении
+        :type update: telegram.Update
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param period: Пара дат (начало, конец) или None - за все время
+        :type period: tuple
+        """
+        await self.storage.loaded()
+        summ = self.get_summ(user_id, period)
+        if summ is None:
+            await update.message.reply_text("Нет операций")
+            return
+
+        inc = summ.income
+        exp = summ.expense
+        bal = inc - exp
 
-    async def send_exp_chrt(self, update: Update, expenses_by_category: dict):
+        text = f"""
+{self.period_title(period)}Доходы: {inc} руб.
+Расходы: {exp} руб.
+Баланс: {bal} руб.
         """
-        Создает и отправляет круговую диаграмму расходов.
+
+        await update.message.reply_text(text)
+
+    @metrics.timed("show_stat")
+    async def show_stat(self, update: Update, user_id: str,
+                        period: tuple = None):
+        """
+        Показывает статистику с графиками доходов и расходов.
 
         :param update: Объект с информацией о входящем сообщении
         :type update: telegram.Update
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param period: Пара дат (начало, конец) или None - за все время
+        :type period: tuple
+        """
+        await self.storage.loaded()
+        summ = self.get_summ(user_id, period)
+        if summ is None or not summ.count:
+            await update.message.reply_text("Нет данных для статистики")
+            return
+
+        inc_by_cat = summ.inc_by_cat
+        exp_by_cat = summ.exp_by_cat
+
+        if inc_by_cat and exp_by_cat:
+            charts = await asyncio.gather(
+                self.charts.render("income", inc_by_cat, user_id),
+                self.charts.render("expense", exp_by_cat, user_id)
+            )
+            if None not in charts:
+                await self.send_album(update, charts, inc_by_cat,
+                                      exp_by_cat, period)
+                return
+            await self.send_rendered(update, "income", inc_by_cat, charts[0])
+            await self.send_rendered(update, "expense", exp_by_cat,
+                                     charts[1])
+        else:
+            await self.send_chrt(update, "income", inc_by_cat, user_id)
+            await self.send_chrt(update, "expense", exp_by_cat, user_id)
+        await self.send_txt_stat(update, inc_by_cat, exp_by_cat, period)
+
+    async def send_album(self, update: Update, charts: list,
+                         income_by_category: dict,
+                         expenses_by_category: dict, period: tuple = None):
+        """
+        Отправляет обе диаграммы одним альбомом с текстовой статистикой
+        в подписи, а если подпись длиннее CAPTION_LIMIT - альбом
+        с итогами в подписях и статистику отдельным сообщением.
+
+        :param update: Объект с информацией о входящем сообщении
+        :type update: telegram.Update
+        :param charts: Диаграммы доходов и расходов
+        :type charts: list
+        :param income_by_category: Словарь с категориями доходов и суммами
+        :type income_by_category: dict
         :param expenses_by_category: Словарь с категориями расходов и суммами
         :type expenses_by_category: dict
+        :param period: Пара дат (начало, конец) или None - за все время
+        :type period: tuple
         """
-        if not expenses_by_category:
-            await update.message.reply_text("Нет данных о расходах")
-            return
+        text = self.stat_text(income_by_category, expenses_by_category,
+                              period)
+        media = []
+        for kind, by_category, chart in zip(
+            ("income", "expense"),
+            (income_by_category, expenses_by_category),
+            charts
+        ):
+            caption = None
+            if len(text) > CAPTION_LIMIT:
+                total = sum(by_category.values())
+                caption = f"{CHART_TEXTS[kind][1]}: {total} руб."
+            if self.charts.fmt == "svg":
+                media.append(InputMediaDocument(
+                    chart, caption=caption, filename=f"{kind}.svg"
+                ))
+            else:
+                media.append(InputMediaPhoto(chart, caption=caption))
 
-        plt.figure(figsize=(8, 6))
+        if len(text) > CAPTION_LIMIT:
+            await update.message.reply_media_group(media=media)
+            await update.message.reply_text(text)
+        else:
+            await update.message.reply_media_group(media=media,
+                                                   caption=text)
 
-        categories = list(expenses_by_category.keys())
-        amounts = list(expenses_by_category.values())
+    async def send_chrt(self, update: Update, kind: str,
+                        by_category: dict, user_id: str = None):
+        """
+        Создает и отправляет круговую диаграмму доходов или расходов.
 
-        colors = ['#FFB6C1', '#FF69B4', '#FF1493',
-                  '#DC143C', '#B22222', '#8B0000']
+        :param update: Объект с информацией о входящем сообщении
+        :type update: telegram.Update
+        :param kind: Вид диаграммы: "income" или "expense"
+        :type kind: str
+        :param by_category: Словарь с категориями и суммами
+        :type by_category: dict
+        :param user_id: ID пользователя для кэша диаграмм
+        :type user_id: str
+        """
+        missing = CHART_TEXTS[kind][0]
+        if not by_category:
+            await update.message.reply_text(f"Нет данных о {missing}")
+            return
 
-        plt.pie(
-            amounts,
-            labels=categories,
-            autopct='%1.1f%%',
-            startangle=90,
-            colors=colors[:len(categories)],
-            textprops={'fontsize': 10}
-        )
+        chart = await self.charts.render(kind, by_category, user_id)
+        await self.send_rendered(update, kind, by_category, chart)
 
-        plt.title('Расходы по категориям', fontsize=14, fontweight='bold')
+    async def send_rendered(self, update: Update, kind: str,
+                            by_category: dict, chart: bytes):
+        """
+        Отправляет готовую диаграмму или итог, если она не нарисована.
 
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=80, bbox_inches='tight')
-        buf.seek(0)
-        plt.close()
+        :param update: Объект с информацией о входящем сообщении
+        :type update: telegram.Update
+        :param kind: Вид диаграммы: "income" или "expense"
+        :type kind: str
+        :param by_category: Словарь с категориями и суммами
+        :type by_category: dict
+        :param chart: Содержимое файла диаграммы или None
+        :type chart: bytes
+        """
+        total_title = CHART_TEXTS[kind][1]
+        total = sum(by_category.values())
+        if chart is None:
+            await update.message.reply_text(
+                f"{total_title}: {total} руб. (диаграмма недоступна)"
+            )
+            return
 
-        total_expenses = sum(amounts)
-        await update.message.reply_photo(
-            photo=buf,
-            caption=f"Общие расходы: {total_expenses} руб."
-        )
+        caption = f"{total_title}: {total} руб."
+        if self.charts.fmt == "svg":
+            await update.message.reply_document(
+                document=chart, filename=f"{kind}.svg", caption=caption
+            )
+            return
+        await update.message.reply_photo(photo=chart, caption=caption)
 
     async def send_txt_stat(self, update: Update,
                             income_by_category: dict,
-                            expenses_by_category: dict):
+                            expenses_by_category: dict,
+                            period: tuple = None):
         """
         Отправляет детальную текстовую статистику.
 
@@ -357,12 +993,32 @@ class FinanceBot:
         :type income_by_category: dict
         :param expenses_by_category: Словарь с категориями расходов и суммами
         :type expenses_by_category: dict
+        :param period: Пара дат (начало, конец) или None - за все время
+        :type period: tuple
+        """
+        await update.message.reply_text(self.stat_text(
+            income_by_category, expenses_by_category, period
+        ))
+
+    def stat_text(self, income_by_category: dict,
+                  expenses_by_category: dict, period: tuple = None) -> str:
+        """
+        Формирует детальную текстовую статистику.
+
+        :param income_by_category: Словарь с категориями доходов и суммами
+        :type income_by_category: dict
+        :param expenses_by_category: Словарь с категориями расходов и суммами
+        :type expenses_by_category: dict
+        :param period: Пара дат (начало, конец) или None - за все время
+        :type period: tuple
+        :rtype: str
         """
         total_income = sum(income_by_category.values())
         total_expenses = sum(expenses_by_category.values())
         balance = total_income - total_expenses
 
-        text = "Детальная статистика:\n\n"
+        text = self.period_title(period)
+        text += "Детальная статистика:\n\n"
         text += f"Общие доходы: {total_income} руб.\n"
 
         if income_by_category:
@@ -388,10 +1044,11 @@ class FinanceBot:
                 text += f"  {category}: {amount} руб. ({percent:.1f}%)\n"
 
         text += f"\nИтоговый баланс: {balance} руб."
+        return text
 
-        await update.message.reply_text(text)
-
-    async def show_cat(self, update: Update, user_id: str):
+    @metrics.timed("show_cat")
+    async def show_cat(self, update: Update, user_id: str,
+                       period: tuple = None):
         """
         Показывает статистику по категориям доходов и расходов.
 
@@ -399,28 +1056,20 @@ class FinanceBot:
         :type update: telegram.Update
         :param user_id: ID пользователя в Telegram
         :type user_id: str
+        :param period: Пара дат (начало, конец) или None - за все время
+        :type period: tuple
         """
-        if user_id not in self.data:
+        await self.storage.loaded()
+        summ = self.get_summ(user_id, period)
+        if summ is None:
             await update.message.reply_text("Нет операций")
             return
 
-        expenses_by_category = {}
-        income_by_category = {}
+        expenses_by_category = summ.exp_by_cat
+        income_by_category = summ.inc_by_cat
 
-        for record in self.data[user_id]:
-            category = record["category"]
-            amount = record["amount"]
-
-            if record["type"] == "expense":
-                expenses_by_category[category] = (
-                    expenses_by_category.get(category, 0) + amount
-                )
-            else:
-                income_by_category[category] = (
-                    income_by_category.get(category, 0) + amount
-                )
-
-        text = "Статистика по категориям:\n\n"
+        text = self.period_title(period)
+        text += "Статистика по категориям:\n\n"
         text += "Расходы:\n"
 
         if expenses_by_category:
@@ -451,20 +1100,177 @@ class FinanceBot:
 
         await update.message.reply_text(text)
 
-    def run(self):
+    async def post_init(self, app: Application):
+        """
+        Запускает фоновое сохранение, если хранилище копит записи,
+        и прогрев matplotlib, если он включен у рендерера.
+
+        :param app: Приложение Telegram
+        :type app: telegram.ext.Application
+        """
+        if self.charts.warm:
+            self.charts.warm_up()
+        if self.storage.durability == "batched":
+            self.flusher = asyncio.create_task(self.storage.flusher())
+
+    async def post_stop(self, app: Application):
+        """
+        Останавливает фоновое сохранение и сохраняет остаток очереди,
+        сдвинутые сроки регулярных операций и пройденные пороги
+        бюджетов.
+
+        :param app: Приложение Telegram
+        :type app: telegram.ext.Application
+        :raises OSError: Если остаток очереди не удалось сохранить
+        """
+        if self.flusher is not None:
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # задача уже завершилась с ошибкой; очередь сохраняется ниже
+                logger.exception("Фоновое сохранение завершилось с ошибкой")
+            self.flusher = None
+        self.locks = {}
+        try:
+            self.storage.flush()
+            if self.recurring.dirty:
+                self.recurring.save()
+        finally:
+            self.budgets.flush()
+
+    def locked(self, handler):
+        """
+        Оборачивает обработчик так, чтобы сообщения одного пользователя
+        обрабатывались строго по очереди, а разных - параллельно.
+
+        :param handler: Обработчик (update, context)
+        :return: Обработчик с блокировкой по пользователю
+        """
+        @functools.wraps(handler)
+        async def wrapper(update: Update,
+                          context: ContextTypes.DEFAULT_TYPE):
+            user = update.effective_user
+            if user is None:
+                return await handler(update, context)
+
+            entry = self.locks.get(user.id)
+            if entry is None:
+                entry = self.locks[user.id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    return await handler(update, context)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[user.id]
+        return wrapper
+
+    def build_app(self, concurrency: int = 64, request=None,
+                  base_url: str = None):
+        """
+        Создает приложение Telegram с обработчиками бота.
+
+        :param concurrency: Сколько сообщений обрабатывать одновременно
+        :type concurrency: int
+        :param request: Транспорт Bot API (для тестов), по умолчанию HTTP
+        :type request: telegram.request.BaseRequest
+        :param base_url: Адрес Bot API, по умолчанию api.telegram.org
+        :type base_url: str
+        :rtype: telegram.ext.Application
+        :raises RuntimeError: Если не установлен APScheduler для job_queue
+        """
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .concurrent_updates(concurrency)
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .rate_limiter(self.outbox)
+        )
+        if request is not None:
+            builder = builder.request(request).get_updates_request(request)
+        if base_url is not None:
+            builder = builder.base_url(base_url)
+        app = builder.build()
+        app.add_handler(CommandHandler("start", self.locked(self.start)))
+        app.add_handler(CommandHandler(
+            ["balance", "stats", "categories"], self.locked(self.hand_period)
+        ))
+        app.add_handler(CommandHandler("export",
+                                       self.locked(self.hand_export)))
+        app.add_handler(CommandHandler(["budget", "budgets"],
+                                       self.locked(self.hand_budget)))
+        app.add_handler(CommandHandler("repeat",
+                                       self.locked(self.hand_repeat)))
+        app.add_handler(MessageHandler(filters.Document.FileExtension("csv"),
+                                       self.locked(self.hand_doc)))
+        app.add_handler(MessageHandler(filters.TEXT,
+                                       self.locked(self.hand_mess)))
+        if app.job_queue is None:
+            raise RuntimeError("Для регулярных операций нужен "
+                               "python-telegram-bot[job-queue]")
+        app.job_queue.run_repeating(self.tick_recurring, RECURRING_INTERVAL,
+                                    first=0, name="recurring")
+        return app
+
+    def run(self, mode: str = "polling", host: str = "127.0.0.1",
+            port: int = 8443, path: str = "webhook",
+            webhook_url: str = None, secret_token: str = None,
+            concurrency: int = 64, metrics_port: int = None,
+            metrics_file: str = None):
         try:
             """
             Запускает бота и начинает обработку сообщений.
-                        
+
+            В режиме "webhook" бот слушает host:port/path, а Telegram
+            присылает обновления на webhook_url (обычно это внешний
+            адрес reverse proxy, который ведет на host:port/path).
+
+            :param mode: Режим получения обновлений: "polling" или "webhook"
+            :type mode: str
+            :param host: Адрес, на котором слушает webhook
+            :type host: str
+            :param port: Порт webhook
+            :type port: int
+            :param path: Путь webhook
+            :type path: str
+            :param webhook_url: Внешний URL, который сообщается Telegram
+            :type webhook_url: str
+            :param secret_token: Секрет для проверки запросов Telegram
+            :type secret_token: str
+            :param concurrency: Сколько сообщений обрабатывать одновременно
+            :type concurrency: int
+            :param metrics_port: Порт для отдачи метрик на /metrics
+            :type metrics_port: int
+            :param metrics_file: Файл, в который периодически пишутся метрики
+            :type metrics_file: str
             :raises telegram.error.InvalidToken: Если указан неверный токен
             :raises telegram.error.NetworkError: При проблемах с сетью
             """
-            app = Application.builder().token(self.token).build()
-            app.add_handler(CommandHandler("start", self.start))
-            app.add_handler(MessageHandler(filters.TEXT, self.hand_mess))
+            if metrics_port is not None:
+                metrics.REGISTRY.serve(metrics_port)
+            if metrics_file is not None:
+                metrics.REGISTRY.write_periodically(metrics_file)
+
+            app = self.build_app(concurrency)
 
             print("Бот запущен!")
-            app.run_polling()
+            if mode == "webhook":
+                app.run_webhook(
+                    listen=host,
+                    port=port,
+                    url_path=path,
+                    webhook_url=webhook_url,
+                    secret_token=secret_token
+                )
+            else:
+                app.run_polling()
+            self.storage.close()
+            self.charts.close()
         except telegram.error.InvalidToken:
             raise telegram.error.InvalidToken
         except telegram.error.NetworkError:
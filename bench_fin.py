@@ -0,0 +1,967 @@
+"""
+Нагрузочные замеры FinanceBot без сети.
+
+Пример: python bench_fin.py load --users 200 --rounds 5 --storage journal
+Холодный старт: python bench_fin.py startup --users 2000 --records 200
+Импорт выписки: python bench_fin.py import --rows 100000 --storage journal
+Экспорт в CSV: python bench_fin.py export --records 1000000 --storage sqlite
+Диаграммы: python bench_fin.py render --renders 200
+Бюджеты: python bench_fin.py budgets --users 100 --history 2000
+Снимки: python bench_fin.py snapshot --users 1000 --records 1000
+Расписание: python bench_fin.py recurring --users 10000 --rules 10
+История в Ledger: python bench_fin.py ledger --records 200000
+Результат печатается в виде JSON (или пишется в файл --out).
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import snapshot
+from FinFlow_main import FinanceBot
+from budgets import Budgets
+from charts import PALETTES, ChartRenderer, render_pie
+from fakes import FakeContext, FakeUpdate
+from ledger import Ledger
+from recurring import Recurring
+from storage import JsonStorage, ShardedStorage, SqliteStorage
+from summary import Summary
+
+
+class Timings:
+    """
+    Собирает длительности вызовов по именам обработчиков.
+
+    :ivar samples: Длительности в секундах по именам
+    :type samples: dict
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def wrap(self, owner, name: str, label: str = None):
+        """
+        Подменяет метод объекта оберткой, замеряющей время вызова.
+
+        :param owner: Объект с методом
+        :param name: Имя метода
+        :type name: str
+        :param label: Имя в отчете, по умолчанию имя метода
+        :type label: str
+        """
+        func = getattr(owner, name)
+        samples = self.samples.setdefault(label or name, [])
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start)
+        setattr(owner, name, timed)
+
+    def report(self) -> dict:
+        """
+        Считает количество вызовов и перцентили в миллисекундах.
+
+        :rtype: dict
+        """
+        result = {}
+        for label, samples in self.samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            result[label] = {
+                "count": len(ordered),
+                "p50_ms": percentile(ordered, 50) * 1000,
+                "p95_ms": percentile(ordered, 95) * 1000,
+                "p99_ms": percentile(ordered, 99) * 1000,
+                "max_ms": ordered[-1] * 1000,
+            }
+        return result
+
+
+def percentile(ordered: list, p: float) -> float:
+    """
+    Перцентиль отсортированной выборки (метод ближайшего ранга).
+
+    :param ordered: Отсортированные значения
+    :type ordered: list
+    :param p: Перцентиль от 0 до 100
+    :type p: float
+    :rtype: float
+    """
+    rank = max(0, min(len(ordered) - 1,
+                      int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_kb() -> int:
+    """
+    Пиковая память процесса в килобайтах.
+
+    :rtype: int
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_storage(kind: str, directory: str, durability: str = "strict"):
+    """
+    Создает хранилище для замера во временном каталоге.
+
+    :param kind: json, journal, binary, sqlite или sharded
+    :type kind: str
+    :param directory: Каталог с данными
+    :type directory: str
+    :param durability: Режим сохранения: "strict" или "batched"
+    :type durability: str
+    :rtype: storage.Storage
+    """
+    path = os.path.join(directory, "data")
+    if kind == "json":
+        return JsonStorage(path + ".json", durability=durability)
+    if kind == "journal":
+        return JsonStorage(path + ".json", journal=True,
+                           durability=durability)
+    if kind == "binary":
+        return JsonStorage(path + ".snap", journal=True, fmt="binary",
+                           compression="zlib", durability=durability)
+    if kind == "sqlite":
+        return SqliteStorage(path + ".db", durability=durability)
+    if kind == "sharded":
+        return ShardedStorage(path, durability=durability)
+    raise ValueError(f"Неизвестное хранилище: {kind}")
+
+
+def instrument(bot: FinanceBot) -> Timings:
+    """
+    Оборачивает обработчики, сохранение и отрисовку замерами времени.
+
+    :param bot: Бот под нагрузкой
+    :type bot: FinFlow_main.FinanceBot
+    :rtype: Timings
+    """
+    timings = Timings()
+    for name in ("hand_mess", "hand_amnt", "show_bal", "show_stat",
+                 "show_cat"):
+        timings.wrap(bot, name)
+    timings.wrap(bot.storage, "flush", "storage.flush")
+    timings.wrap(bot.charts, "render", "charts.render")
+    return timings
+
+
+async def simulate_user(bot: FinanceBot, user_id: int, rounds: int,
+                        rng: random.Random):
+    """
+    Проигрывает типичные диалоги одного пользователя.
+
+    :param bot: Бот под нагрузкой
+    :type bot: FinFlow_main.FinanceBot
+    :param user_id: ID пользователя
+    :type user_id: int
+    :param rounds: Количество повторов сценария
+    :type rounds: int
+    :param rng: Генератор случайных чисел
+    :type rng: random.Random
+    :return: Количество отправленных сообщений
+    :rtype: int
+    """
+    context = FakeContext()
+    sent = 0
+    for _ in range(rounds):
+        if rng.random() < 0.3:
+            flow = ["Доход", rng.choice(["Зарплата", "Премия", "Бизнес"])]
+        else:
+            flow = ["Расход", rng.choice(["Еда", "Транспорт", "Жилье"])]
+        flow.append(str(rng.randint(1, 5000)))
+        flow.append("Баланс")
+        if rng.random() < 0.2:
+            flow.append("Статистика")
+        if rng.random() < 0.2:
+            flow.append("Категории")
+        for text in flow:
+            await bot.hand_mess(FakeUpdate(user_id, text), context)
+            sent += 1
+            await asyncio.sleep(0)
+    return sent
+
+
+async def run_load(bot: FinanceBot, users: int, rounds: int,
+                   seed: int = 1) -> dict:
+    """
+    Запускает users параллельных пользователей и собирает отчет.
+
+    :param bot: Бот под нагрузкой
+    :type bot: FinFlow_main.FinanceBot
+    :param users: Количество пользователей
+    :type users: int
+    :param rounds: Количество повторов сценария у каждого
+    :type rounds: int
+    :param seed: Начальное значение генератора случайных чисел
+    :type seed: int
+    :rtype: dict
+    """
+    timings = instrument(bot)
+    flusher = None
+    if bot.storage.durability == "batched":
+        flusher = asyncio.create_task(bot.storage.flusher())
+
+    start = time.perf_counter()
+    sent = await asyncio.gather(*(
+        simulate_user(bot, 100000 + i, rounds, random.Random(seed + i))
+        for i in range(users)
+    ))
+    if flusher is not None:
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+    bot.storage.flush()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "users": users,
+        "rounds": rounds,
+        "updates": sum(sent),
+        "seconds": elapsed,
+        "updates_per_sec": sum(sent) / elapsed if elapsed else 0.0,
+        "handlers": timings.report(),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def bench_load(args) -> dict:
+    """
+    Сценарий load: нагрузка синтетическими пользователями.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        storage = make_storage(args.storage, directory, args.durability)
+        storage.load()
+        charts = ChartRenderer(workers=args.chart_workers)
+        bot = FinanceBot("bench", storage=storage, charts=charts)
+        try:
+            report = asyncio.run(run_load(bot, args.users, args.rounds,
+                                          args.seed))
+        finally:
+            charts.close()
+            storage.close()
+    report["storage"] = args.storage
+    report["durability"] = args.durability
+    return report
+
+
+# Выполняется в отдельном процессе, чтобы импорты были холодными
+STARTUP_CHILD = """
+import asyncio, json, sys, time
+start = time.perf_counter()
+import FinFlow_main
+imported = time.perf_counter()
+from fakes import FakeContext, FakeUpdate
+from charts import ChartRenderer
+from storage import JsonStorage
+
+path, background = sys.argv[1], sys.argv[2] == "background"
+marks = {"import_s": imported - start}
+
+
+def mark(name):
+    marks[name] = time.perf_counter() - start
+
+
+async def scenario(bot):
+    replies = []
+    await bot.start(FakeUpdate(1, "/start", replies), FakeContext())
+    mark("first_start_s")
+    context = FakeContext()
+    for text in ("Расход", "Еда", "100"):
+        await bot.hand_mess(FakeUpdate(1, text, replies), context)
+    mark("first_record_s")
+    await bot.storage.loaded()
+    mark("loaded_s")
+    await bot.hand_mess(FakeUpdate(1, "Статистика", replies), context)
+    mark("first_chart_s")
+
+
+marks["pyplot_at_import"] = "matplotlib.pyplot" in sys.modules
+bot = FinFlow_main.FinanceBot("bench", storage=JsonStorage(path),
+                              charts=ChartRenderer(workers=0),
+                              background_load=background)
+mark("bot_ready_s")
+asyncio.run(scenario(bot))
+sys.stdout.write(json.dumps(marks))
+"""
+
+
+def make_snapshot(path: str, users: int, records: int, seed: int = 1):
+    """
+    Записывает снимок data.json с синтетической историей.
+
+    :param path: Путь к файлу снимка
+    :type path: str
+    :param users: Количество пользователей
+    :type users: int
+    :param records: Количество записей у каждого пользователя
+    :type records: int
+    :param seed: Начальное значение генератора случайных чисел
+    :type seed: int
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+        for i in range(users):
+            history = [{
+                "type": "expense" if rng.random() < 0.7 else "income",
+                "amount": rng.randint(1, 5000),
+                "category": rng.choice(["Еда", "Транспорт", "Зарплата"]),
+                "ts": now - rng.randint(0, 365 * 86400),
+            } for _ in range(records)]
+            if i:
+                f.write(",")
+            f.write(json.dumps(str(200000 + i)) + ":")
+            f.write(json.dumps(history, ensure_ascii=False,
+                               separators=(",", ":")))
+        f.write("}")
+
+
+def bench_startup(args) -> dict:
+    """
+    Сценарий startup: холодный старт с обычной и фоновой загрузкой.
+
+    Каждый замер идет в новом процессе. Время отсчитывается от
+    начала импорта бота до первого ответа на /start, первой
+    сохраненной операции, окончания загрузки и первой диаграммы.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    report = {"users": args.users, "records": args.records}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "data.json")
+        make_snapshot(path, args.users, args.records, args.seed)
+        report["snapshot_bytes"] = os.path.getsize(path)
+        for mode in ("sync", "background"):
+            shutil.copy(path, path + ".orig")
+            out = subprocess.run(
+                [sys.executable, "-c", STARTUP_CHILD, path, mode],
+                cwd=here, capture_output=True, text=True, check=True
+            ).stdout
+            shutil.move(path + ".orig", path)
+            report[mode] = json.loads(out)
+    return report
+
+
+def make_statement(path: str, rows: int, seed: int = 1):
+    """
+    Записывает синтетическую банковскую выписку в формате CSV.
+
+    :param path: Путь к файлу
+    :type path: str
+    :param rows: Количество операций
+    :type rows: int
+    :param seed: Начальное значение генератора случайных чисел
+    :type seed: int
+    """
+    rng = random.Random(seed)
+    shops = ["Пятерочка", "Яндекс Такси", "Аптека 36,6", "ЖКХ оплата",
+             "Кинотеатр", "Кофейня", "Перевод"]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("Дата операции;Сумма;Описание\n")
+        for i in range(rows):
+            day = f"{1 + i % 28:02d}.{1 + i % 12:02d}.2025"
+            if rng.random() < 0.1:
+                amount, text = rng.randint(10000, 90000), "Зарплата"
+            else:
+                amount, text = -rng.randint(50, 5000), rng.choice(shops)
+            f.write(f"{day};{amount},00;{text}\n")
+
+
+def bench_import(args) -> dict:
+    """
+    Сценарий import: импорт выписки одного пользователя.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "statement.csv")
+        make_statement(path, args.rows, args.seed)
+        storage = make_storage(args.storage, directory)
+        storage.load()
+        bot = FinanceBot("bench", storage=storage,
+                         charts=ChartRenderer(workers=0))
+        bot.importer.chunk_size = args.chunk
+        rss_before = peak_rss_kb()
+        start = time.perf_counter()
+        stats = asyncio.run(bot.importer.import_file(storage, "1", path))
+        elapsed = time.perf_counter() - start
+        storage.close()
+        report = {
+            "rows": args.rows,
+            "storage": args.storage,
+            "chunk": args.chunk,
+            "file_bytes": os.path.getsize(path),
+            "seconds": elapsed,
+            "rows_per_sec": args.rows / elapsed if elapsed else 0.0,
+            "peak_rss_growth_kb": peak_rss_kb() - rss_before,
+        }
+    report.update(stats)
+    return report
+
+
+async def max_stall(task_factory, interval: float = 0.001) -> tuple:
+    """
+    Выполняет корутину и замеряет самую долгую паузу цикла событий.
+
+    :param task_factory: Функция без аргументов, возвращающая корутину
+    :param interval: Период фоновой задачи-метронома в секундах
+    :type interval: float
+    :return: Результат корутины и пауза в секундах
+    :rtype: tuple
+    """
+    stall = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal stall
+        last = time.perf_counter()
+        while not done:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            stall = max(stall, now - last - interval)
+            last = now
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    try:
+        result = await task_factory()
+    finally:
+        done = True
+        await tick
+    return result, stall
+
+
+def bench_export(args) -> dict:
+    """
+    Сценарий export: выгрузка длинной истории одного пользователя.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    rng = random.Random(args.seed)
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as directory:
+        storage = make_storage(args.storage, directory, "batched")
+        storage.load()
+        for start in range(0, args.records, 10000):
+            storage.append_many("1", [{
+                "type": "expense" if rng.random() < 0.7 else "income",
+                "amount": rng.randint(1, 5000),
+                "category": rng.choice(["Еда", "Транспорт", "Зарплата"]),
+                "ts": now - rng.randint(0, 365 * 86400),
+            } for _ in range(min(10000, args.records - start))])
+        storage.flush()
+        bot = FinanceBot("bench", storage=storage,
+                         charts=ChartRenderer(workers=0))
+        replies = []
+        context = FakeContext(args=["итоги"] if args.totals else [])
+        start = time.perf_counter()
+        _, stall = asyncio.run(max_stall(lambda: bot.hand_export(
+            FakeUpdate(1, "/export", replies), context
+        )))
+        elapsed = time.perf_counter() - start
+        storage.close()
+    return {
+        "records": args.records,
+        "storage": args.storage,
+        "seconds": elapsed,
+        "bytes": sum(len(data) for kind, data in replies
+                     if kind == "document"),
+        "files": len(replies),
+        "max_loop_stall_ms": stall * 1000,
+    }
+
+
+def pyplot_pie(kind: str, by_category: dict) -> bytes:
+    """
+    Прежняя отрисовка через pyplot, для сравнения в сценарии render.
+
+    :param kind: Вид диаграммы: "income" или "expense"
+    :type kind: str
+    :param by_category: Словарь с категориями и суммами
+    :type by_category: dict
+    :rtype: bytes
+    """
+    import io
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    colors, title = PALETTES[kind]
+    categories = list(by_category.keys())
+    plt.figure(figsize=(8, 6))
+    plt.pie(list(by_category.values()), labels=categories,
+            autopct='%1.1f%%', startangle=90,
+            colors=colors[:len(categories)], textprops={'fontsize': 10})
+    plt.title(title, fontsize=14, fontweight='bold')
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', dpi=80, bbox_inches='tight')
+    plt.close()
+    return buf.getvalue()
+
+
+def bench_render(args) -> dict:
+    """
+    Сценарий render: время и память одной отрисовки диаграммы.
+
+    Сравнивает прежний pyplot, заготовки Agg с PNG и векторный SVG.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    rng = random.Random(args.seed)
+    names = ["Еда", "Транспорт", "Жилье", "Развлечения", "Одежда",
+             "Здоровье", "Образование", "Прочее"]
+    datasets = [
+        (rng.choice(["income", "expense"]),
+         {name: rng.randint(1, 5000)
+          for name in rng.sample(names, rng.randint(1, len(names)))})
+        for _ in range(args.renders)
+    ]
+    variants = {
+        "pyplot_png": pyplot_pie,
+        "agg_png": render_pie,
+        "agg_svg": functools.partial(render_pie, fmt="svg"),
+    }
+    report = {"renders": args.renders}
+    for name, render in variants.items():
+        for kind, data in datasets[:3]:
+            render(kind, data)
+        samples = []
+        size = 0
+        for kind, data in datasets:
+            start = time.perf_counter()
+            size += len(render(kind, data))
+            samples.append(time.perf_counter() - start)
+        peaks = []
+        tracemalloc.start()
+        for kind, data in datasets[:20]:
+            tracemalloc.reset_peak()
+            render(kind, data)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        ordered = sorted(samples)
+        report[name] = {
+            "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": percentile(ordered, 50) * 1000,
+            "p95_ms": percentile(ordered, 95) * 1000,
+            "mean_bytes": size // len(samples),
+            "peak_alloc_kb": max(peaks) // 1024,
+        }
+    report["peak_rss_kb"] = peak_rss_kb()
+    return report
+
+
+def rescan_check(bot: FinanceBot, user_id: str, record: dict) -> str:
+    """
+    Проверка бюджета проходом по истории - для сравнения
+    с FinanceBot.check_budget.
+
+    :param bot: Бот под нагрузкой
+    :type bot: FinFlow_main.FinanceBot
+    :param user_id: ID пользователя
+    :type user_id: str
+    :param record: Добавленная запись
+    :type record: dict
+    :rtype: str
+    """
+    category = record["category"]
+    limit = bot.budgets.get(user_id).get(category)
+    if record["type"] != "expense" or limit is None:
+        return None
+    start = time.localtime(record["ts"])
+    spent = 0
+    for r in bot.storage.records(user_id):
+        if (r["type"] == "expense" and r["category"] == category
+                and "ts" in r):
+            ts = time.localtime(r["ts"])
+            if (ts.tm_year, ts.tm_mon) == (start.tm_year, start.tm_mon):
+                spent += r["amount"]
+    threshold = bot.budgets.check(user_id, category,
+                                  (start.tm_year, start.tm_mon), spent)
+    return None if threshold is None else f"{threshold:.0%}"
+
+
+def bench_budgets(args) -> dict:
+    """
+    Сценарий budgets: цена записи расхода без бюджетов, с проверкой
+    по сводке месяца и с проверкой проходом по истории.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    categories = ["Еда", "Транспорт", "Жилье", "Развлечения"]
+    now = int(time.time())
+    report = {"users": args.users, "history": args.history,
+              "writes": args.writes, "storage": args.storage}
+    for mode in ("off", "incremental", "rescan"):
+        rng = random.Random(args.seed)
+        with tempfile.TemporaryDirectory() as directory:
+            storage = make_storage(args.storage, directory, "batched")
+            storage.load()
+            budgets = Budgets(os.path.join(directory, "budgets.json"))
+            bot = FinanceBot("bench", storage=storage,
+                             charts=ChartRenderer(workers=0),
+                             budgets=budgets)
+            if mode == "rescan":
+                bot.check_budget = functools.partial(rescan_check, bot)
+            users = [str(100000 + i) for i in range(args.users)]
+            for user in users:
+                storage.append_many(user, [
+                    {"type": "expense", "amount": rng.randint(1, 500),
+                     "category": rng.choice(categories),
+                     "ts": now - rng.randint(0, 365 * 86400)}
+                    for _ in range(args.history)
+                ])
+                if mode != "off":
+                    budgets.limits[user] = {
+                        name: rng.randint(5, 40) * 1000
+                        for name in categories
+                    }
+            storage.flush()
+
+            async def write(user):
+                context = FakeContext({"action": "expense",
+                                       "category": rng.choice(categories)})
+                replies = []
+                text = str(rng.randint(1, 500))
+                start = time.perf_counter()
+                await bot.hand_amnt(FakeUpdate(int(user), text, replies),
+                                    context, user, text)
+                return time.perf_counter() - start, "\n" in replies[0][1]
+
+            async def run():
+                for user in users:
+                    await write(user)
+                return [await write(rng.choice(users))
+                        for _ in range(args.writes)]
+
+            results = asyncio.run(run())
+            storage.close()
+        samples = sorted(seconds for seconds, _ in results)
+        report[mode] = {
+            "mean_us": sum(samples) / len(samples) * 1e6,
+            "p50_us": percentile(samples, 50) * 1e6,
+            "p99_us": percentile(samples, 99) * 1e6,
+            "alerts": sum(alert for _, alert in results),
+        }
+    report["overhead_pct"] = (
+        report["incremental"]["mean_us"] / report["off"]["mean_us"] - 1
+    ) * 100
+    report["peak_rss_kb"] = peak_rss_kb()
+    return report
+
+
+def bench_snapshot(args) -> dict:
+    """
+    Сценарий snapshot: размер, время сохранения и загрузки снимка
+    в JSON и в двоичном формате с разным сжатием.
+
+    Загрузка меряется в новом экземпляре JsonStorage, включая
+    построение сводок, и проверяется совпадение данных. Для режима
+    журнала меряется самая долгая пауза цикла событий, пока снимок
+    пишется в фоновом потоке.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    variants = [
+        ("json", {}),
+        ("json_compact", {"journal": True}),
+        ("binary", {"fmt": "binary"}),
+        ("binary_zlib", {"fmt": "binary", "compression": "zlib"}),
+    ]
+    if snapshot.zstandard is not None:
+        variants.append(("binary_zstd",
+                         {"fmt": "binary", "compression": "zstd"}))
+    report = {"users": args.users, "records": args.users * args.records}
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.json")
+        make_snapshot(source, args.users, args.records, args.seed)
+        data = JsonStorage(source).load()
+        for name, options in variants:
+            path = os.path.join(directory, name)
+            storage = JsonStorage(path, **options)
+            storage.data = data
+            storage.rebuild()
+            start = time.perf_counter()
+            storage.save()
+            save_s = time.perf_counter() - start
+            storage.close()
+
+            fresh = JsonStorage(path, **options)
+            start = time.perf_counter()
+            loaded = fresh.load()
+            load_s = time.perf_counter() - start
+            fresh.close()
+            report[name] = {
+                "bytes": os.path.getsize(path),
+                "save_s": save_s,
+                "load_s": load_s,
+                "same": loaded == data,
+            }
+            if name != "json":
+                options = dict(options, journal=True)
+                storage = JsonStorage(path, **options)
+                storage.data = data
+
+                async def compact():
+                    storage.compact()
+                    while storage._compactor.is_alive():
+                        await asyncio.sleep(0.001)
+
+                _, stall = asyncio.run(max_stall(compact))
+                storage.close()
+                report[name]["compact_loop_stall_ms"] = stall * 1000
+            os.remove(path)
+    report["peak_rss_kb"] = peak_rss_kb()
+    return report
+
+
+def bench_recurring(args) -> dict:
+    """
+    Сценарий recurring: проход расписания, на котором наступают
+    сроки всех правил (начало месяца или запуск после простоя
+    в --missed месяцев), и пустой проход.
+
+    Для сравнения первые --sample правил записываются по одному,
+    как при отдельной задаче на каждое правило.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    rng = random.Random(args.seed)
+    categories = ["Жилье", "Транспорт", "Образование", "Прочее"]
+    start = time.time()
+    # первые сроки всех правил не дальше месяца, за каждый
+    # месяц простоя добавляется еще по операции
+    now = start + (args.missed + 1) * 31 * 86400
+    report = {"users": args.users, "rules": args.users * args.rules,
+              "missed": args.missed, "storage": args.storage}
+    with tempfile.TemporaryDirectory() as directory:
+        storage = make_storage(args.storage, directory)
+        storage.load()
+        recurring = Recurring(os.path.join(directory, "recurring.json"))
+        users = [str(300000 + i) for i in range(args.users)]
+        for user in users:
+            storage.summary(user)
+            for _ in range(args.rules):
+                recurring.add(user, "expense", rng.choice(categories),
+                              rng.randint(100, 50000), rng.randint(1, 28),
+                              now=start, save=False)
+        recurring.save()
+        bot = FinanceBot("bench", storage=storage,
+                         charts=ChartRenderer(workers=0),
+                         recurring=recurring)
+
+        flushes = storage.flush_stats["flushes"]
+        begin = time.perf_counter()
+        count = asyncio.run(bot.tick_recurring(now=now))
+        tick_s = time.perf_counter() - begin
+        report["batched"] = {
+            "records": count,
+            "tick_s": tick_s,
+            "us_per_record": tick_s / count * 1e6,
+            "flushes": storage.flush_stats["flushes"] - flushes,
+        }
+
+        begin = time.perf_counter()
+        for _ in range(100):
+            asyncio.run(bot.tick_recurring(now=now + 1))
+        report["idle_tick_us"] = (time.perf_counter() - begin) / 100 * 1e6
+        report["recurring_bytes"] = os.path.getsize(recurring.path)
+
+        sample = [(user, rule) for user in users
+                  for rule in recurring.get(user)][:args.sample]
+        flushes = storage.flush_stats["flushes"]
+        begin = time.perf_counter()
+        for user, rule in sample:
+            storage.append(user, {"type": rule["type"],
+                                  "amount": rule["amount"],
+                                  "category": rule["category"],
+                                  "ts": rule["next"]})
+        per_rule_s = time.perf_counter() - begin
+        report["per_rule"] = {
+            "records": len(sample),
+            "seconds": per_rule_s,
+            "us_per_record": per_rule_s / max(len(sample), 1) * 1e6,
+            "flushes": storage.flush_stats["flushes"] - flushes,
+        }
+        storage.close()
+    report["peak_rss_kb"] = peak_rss_kb()
+    return report
+
+
+def bench_ledger(args) -> dict:
+    """
+    Сценарий ledger: память истории и время сводки для списка
+    словарей и для Ledger.
+
+    :param args: Аргументы командной строки
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    rng = random.Random(args.seed)
+    categories = [("expense", "Еда"), ("expense", "Транспорт"),
+                  ("income", "Зарплата"), ("expense", "Жилье"),
+                  ("income", "Премия")]
+    records = []
+    for _ in range(args.records):
+        kind, category = rng.choice(categories)
+        records.append({"type": kind, "amount": rng.randint(1, 99999) / 100,
+                        "category": category})
+    ledger = Ledger.from_records(records)
+    dict_bytes = sys.getsizeof(records) + sum(
+        sys.getsizeof(r) + sys.getsizeof(r["amount"]) for r in records
+    )
+
+    def best(func):
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    loop_time = best(lambda: Summary.from_records(records))
+    numpy_time = best(ledger.summary)
+    return {
+        "records": args.records,
+        "dict_bytes": dict_bytes,
+        "ledger_bytes": ledger.nbytes,
+        "summary_dicts_ms": loop_time * 1000,
+        "summary_ledger_ms": numpy_time * 1000,
+        "speedup": loop_time / numpy_time,
+        "matches": ledger.summary().matches(Summary.from_records(records)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    load = sub.add_parser("load", help="синтетические пользователи")
+    load.add_argument("--users", type=int, default=100)
+    load.add_argument("--rounds", type=int, default=5)
+    load.add_argument("--storage", default="json",
+                      choices=["json", "journal", "sqlite", "sharded"])
+    load.add_argument("--durability", default="strict",
+                      choices=["strict", "batched"])
+    load.add_argument("--chart-workers", type=int, default=2)
+    load.add_argument("--seed", type=int, default=1)
+    load.set_defaults(func=bench_load)
+
+    startup = sub.add_parser("startup", help="холодный старт бота")
+    startup.add_argument("--users", type=int, default=1000)
+    startup.add_argument("--records", type=int, default=200)
+    startup.add_argument("--seed", type=int, default=1)
+    startup.set_defaults(func=bench_startup)
+
+    imp = sub.add_parser("import", help="импорт CSV выписки")
+    imp.add_argument("--rows", type=int, default=100000)
+    imp.add_argument("--chunk", type=int, default=5000)
+    imp.add_argument("--storage", default="journal",
+                     choices=["json", "journal", "sqlite", "sharded"])
+    imp.add_argument("--seed", type=int, default=1)
+    imp.set_defaults(func=bench_import)
+
+    export = sub.add_parser("export", help="выгрузка истории в CSV")
+    export.add_argument("--records", type=int, default=200000)
+    export.add_argument("--storage", default="sqlite",
+                        choices=["json", "journal", "sqlite", "sharded"])
+    export.add_argument("--totals", action="store_true")
+    export.add_argument("--seed", type=int, default=1)
+    export.set_defaults(func=bench_export)
+
+    render = sub.add_parser("render", help="отрисовка диаграмм")
+    render.add_argument("--renders", type=int, default=100)
+    render.add_argument("--seed", type=int, default=1)
+    render.set_defaults(func=bench_render)
+
+    budget = sub.add_parser("budgets", help="проверка бюджетов при записи")
+    budget.add_argument("--users", type=int, default=100)
+    budget.add_argument("--history", type=int, default=2000)
+    budget.add_argument("--writes", type=int, default=20000)
+    budget.add_argument("--storage", default="journal",
+                        choices=["json", "journal", "sqlite", "sharded"])
+    budget.add_argument("--seed", type=int, default=1)
+    budget.set_defaults(func=bench_budgets)
+
+    snap = sub.add_parser("snapshot", help="форматы снимка данных")
+    snap.add_argument("--users", type=int, default=1000)
+    snap.add_argument("--records", type=int, default=1000)
+    snap.add_argument("--seed", type=int, default=1)
+    snap.set_defaults(func=bench_snapshot)
+
+    rec = sub.add_parser("recurring", help="регулярные операции")
+    rec.add_argument("--users", type=int, default=10000)
+    rec.add_argument("--rules", type=int, default=10)
+    rec.add_argument("--missed", type=int, default=0)
+    rec.add_argument("--sample", type=int, default=2000)
+    rec.add_argument("--storage", default="journal",
+                     choices=["json", "journal", "binary", "sqlite",
+                              "sharded"])
+    rec.add_argument("--seed", type=int, default=1)
+    rec.set_defaults(func=bench_recurring)
+
+    led = sub.add_parser("ledger", help="история в Ledger")
+    led.add_argument("--records", type=int, default=200000)
+    led.add_argument("--repeats", type=int, default=5)
+    led.add_argument("--seed", type=int, default=1)
+    led.set_defaults(func=bench_ledger)
+
+    parser.add_argument("--out", help="файл для JSON отчета")
+    args = parser.parse_args(argv)
+
+    report = args.func(args)
+    report["scenario"] = args.scenario
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import json
+import math
+import os
+
+from storage import write_atomic
+
+# Доли лимита, при достижении которых отправляется предупреждение
+THRESHOLDS = (0.8, 1.0)
+
+
+class Budgets:
+    """
+    Месячные лимиты расходов по категориям и отправленные предупреждения.
+
+    Проверка новой записи стоит O(1): потраченная сумма берется
+    из поддерживаемой сводки месяца, а для каждой пары (месяц,
+    категория) хранится последний пройденный порог, поэтому
+    предупреждение о каждом пороге приходит один раз.
+    :ivar path: Путь к файлу бюджетов
+    :type path: str
+    :ivar limits: Лимиты: user_id -> {категория: сумма}
+    :type limits: dict
+    :ivar fired: Пройденные пороги: user_id -> {"ГГГГ-ММ": {категория: доля}}
+    :type fired: dict
+    :ivar dirty: Есть ли несохраненные пройденные пороги
+    :type dirty: bool
+    """
+
+    def __init__(self, path: str = "budgets.json"):
+        """
+        Загружает бюджеты из файла, если он есть.
+
+        :param path: Путь к файлу бюджетов
+        :type path: str
+        """
+        self.path = path
+        self.limits = {}
+        self.fired = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.limits = data.get("limits", {})
+            self.fired = data.get("fired", {})
+
+    def save(self):
+        """
+        Атомарно сохраняет бюджеты.
+
+        :raises OSError: При проблемах с записью
+        """
+        payload = {"limits": self.limits, "fired": self.fired}
+        write_atomic(self.path, json.dumps(
+            payload, ensure_ascii=False, indent=2).encode("utf-8"))
+        self.dirty = False
+
+    def flush(self):
+        """
+        Сохраняет бюджеты, если с прошлого сохранения пройдены новые пороги.
+
+        :raises OSError: При проблемах с записью
+        """
+        if self.dirty:
+            self.save()
+
+    def get(self, user_id: str) -> dict:
+        """
+        Возвращает лимиты пользователя.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :return: Категория -> месячный лимит
+        :rtype: dict
+        """
+        return self.limits.get(user_id, {})
+
+    def set(self, user_id: str, category: str, limit: float):
+        """
+        Устанавливает лимит категории; 0 удаляет его.
+
+        Пройденные пороги категории сбрасываются, чтобы о новом
+        лимите снова пришли предупреждения.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param category: Категория расходов
+        :type category: str
+        :param limit: Месячный лимит в рублях
+        :type limit: float
+        :raises ValueError: Если лимит отрицательный или не конечный
+        """
+        if not math.isfinite(limit) or limit < 0:
+            raise ValueError("Лимит должен быть неотрицательным числом")
+        limits = self.limits.setdefault(user_id, {})
+        if limit:
+            limits[category] = limit
+        else:
+            limits.pop(category, None)
+            if not limits:
+                del self.limits[user_id]
+        for months in self.fired.get(user_id, {}).values():
+            months.pop(category, None)
+        self.save()
+
+    def check(self, user_id: str, category: str, month: tuple,
+              spent: float):
+        """
+        Возвращает новый пройденный порог или None.
+
+        Если за одну запись пройдены оба порога, возвращается
+        старший, и младший больше не срабатывает. Пройденный порог
+        запоминается в памяти, на диск его записывает flush.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param category: Категория расходов
+        :type category: str
+        :param month: Пара (год, месяц)
+        :type month: tuple
+        :param spent: Расходы категории за месяц с учетом новой записи
+        :type spent: float
+        :rtype: float
+        """
+        limit = self.limits.get(user_id, {}).get(category)
+        if limit is None:
+            return None
+        key = f"{month[0]:04d}-{month[1]:02d}"
+        user_fired = self.fired.get(user_id, {})
+        done = user_fired.get(key, {}).get(category, 0)
+        crossed = None
+        for threshold in THRESHOLDS:
+            if threshold > done and spent >= threshold * limit:
+                crossed = threshold
+        if crossed is None:
+            return None
+        # пороги прошлых месяцев больше не нужны
+        self.fired[user_id] = {key: dict(user_fired.get(key, {}))}
+        self.fired[user_id][key][category] = crossed
+        self.dirty = True
+        return crossed
+
+    def pop(self, user_id: str) -> dict:
+        """
+        Удаляет и возвращает все данные пользователя
+        (для переноса между узлами кластера). Файл не сохраняется:
+        это делает вызывающий, когда данные записаны на новом месте.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :return: Словарь с ключами limits и fired
+        :rtype: dict
+        """
+        return {"limits": self.limits.pop(user_id, {}),
+                "fired": self.fired.pop(user_id, {})}
+
+    def put(self, user_id: str, entry: dict):
+        """
+        Записывает данные пользователя, полученные от pop.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param entry: Словарь с ключами limits и fired
+        :type entry: dict
+        """
+        if not entry["limits"] and not entry["fired"]:
+            return
+        if entry["limits"]:
+            self.limits[user_id] = entry["limits"]
+        if entry["fired"]:
+            self.fired[user_id] = entry["fired"]
+        self.save()
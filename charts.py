@@ -0,0 +1,437 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+PALETTES = {
+    "income": (
+        ['#90EE90', '#98FB98', '#8FBC8F', '#3CB371', '#2E8B57', '#228B22'],
+        'Доходы по категориям'
+    ),
+    "expense": (
+        ['#FFB6C1', '#FF69B4', '#FF1493', '#DC143C', '#B22222', '#8B0000'],
+        'Расходы по категориям'
+    ),
+}
+
+
+def warm_up():
+    """
+    Импортирует matplotlib и готовит заготовки диаграмм.
+
+    Импорт и первая отрисовка (загрузка шрифтов) занимают заметное
+    время, поэтому они откладываются до первой диаграммы или
+    выполняются заранее в фоне (см. ChartRenderer.warm_up),
+    а не при запуске бота.
+    """
+    for kind in PALETTES:
+        render_pie(kind, {"": 1})
+
+
+class PieTemplate:
+    """
+    Заготовка круговой диаграммы одной палитры.
+
+    Фигура, холст Agg и оси с заголовком создаются один раз,
+    при отрисовке на оси добавляются только сектора и подписи,
+    которые затем удаляются. Глобальное состояние pyplot
+    и пересчет bbox_inches="tight" не используются.
+    :ivar figure: Фигура matplotlib
+    :type figure: matplotlib.figure.Figure
+    :ivar canvas: Холст Agg фигуры
+    :type canvas: matplotlib.backends.backend_agg.FigureCanvasAgg
+    :ivar axes: Оси диаграммы
+    :type axes: matplotlib.axes.Axes
+    """
+
+    def __init__(self, kind: str):
+        """
+        Создает фигуру с заголовком палитры.
+
+        :param kind: Вид диаграммы: "income" или "expense"
+        :type kind: str
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.colors, title = PALETTES[kind]
+        self.figure = Figure(figsize=(8, 6), dpi=80)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_axes((0.05, 0.02, 0.9, 0.86))
+        self.axes.set_title(title, fontsize=14, fontweight='bold')
+
+    def render(self, by_category: dict, fmt: str = "png") -> bytes:
+        """
+        Рисует диаграмму и возвращает содержимое файла.
+
+        :param by_category: Словарь с категориями и суммами
+        :type by_category: dict
+        :param fmt: Формат: "png" или векторный "svg"
+        :type fmt: str
+        :rtype: bytes
+        """
+        import matplotlib
+
+        categories = list(by_category.keys())
+        wedges, texts, autotexts = self.axes.pie(
+            list(by_category.values()),
+            labels=categories,
+            autopct='%1.1f%%',
+            startangle=90,
+            colors=self.colors[:len(categories)],
+            textprops={'fontsize': 10}
+        )
+        buf = io.BytesIO()
+        try:
+            if fmt == "png":
+                self.canvas.print_png(buf)
+            else:
+                # текст остается текстом, а не набором кривых
+                with matplotlib.rc_context({"svg.fonttype": "none"}):
+                    self.figure.savefig(buf, format=fmt)
+        finally:
+            for artist in (*wedges, *texts, *autotexts):
+                artist.remove()
+        return buf.getvalue()
+
+
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+
+
+def render_pie(kind: str, by_category: dict, fmt: str = "png") -> bytes:
+    """
+    Рисует круговую диаграмму на заготовке палитры.
+
+    Функция не зависит от бота и вызывается в отдельном процессе;
+    заготовки создаются в каждом процессе один раз.
+
+    :param kind: Вид диаграммы: "income" или "expense"
+    :type kind: str
+    :param by_category: Словарь с категориями и суммами
+    :type by_category: dict
+    :param fmt: Формат: "png" или векторный "svg"
+    :type fmt: str
+    :return: Содержимое PNG или SVG файла
+    :rtype: bytes
+    :raises ValueError: При неизвестном формате
+    """
+    if fmt not in ("png", "svg"):
+        raise ValueError(f"Неизвестный формат диаграммы: {fmt}")
+    with _TEMPLATES_LOCK:
+        template = _TEMPLATES.get(kind)
+        if template is None:
+            template = _TEMPLATES[kind] = PieTemplate(kind)
+        return template.render(by_category, fmt)
+
+
+def chart_key(kind: str, by_category: dict, fmt: str = "png") -> str:
+    """
+    Вычисляет ключ диаграммы по ее содержимому.
+
+    Порядок категорий входит в ключ, так как от него зависит
+    расположение секторов.
+
+    :param kind: Вид диаграммы: "income" или "expense"
+    :type kind: str
+    :param by_category: Словарь с категориями и суммами
+    :type by_category: dict
+    :param fmt: Формат: "png" или "svg"
+    :type fmt: str
+    :rtype: str
+    """
+    raw = json.dumps([kind, fmt, list(by_category.items())],
+                     ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ChartCache:
+    """
+    LRU кэш готовых диаграмм, ограниченный суммарным размером PNG.
+
+    Одинаковые данные разных пользователей дают одну запись кэша;
+    запись удаляется, когда ее не использует ни один пользователь.
+    :ivar max_bytes: Максимальный суммарный размер PNG
+    :type max_bytes: int
+    :ivar size: Текущий суммарный размер PNG
+    :type size: int
+    :ivar hits: Количество попаданий
+    :type hits: int
+    :ivar misses: Количество промахов
+    :type misses: int
+    """
+
+    def __init__(self, max_bytes: int = 32 << 20):
+        """
+        Создает пустой кэш.
+
+        :param max_bytes: Максимальный суммарный размер PNG
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._owners = {}
+        self._by_user = {}
+
+    def get(self, key: str):
+        """
+        Возвращает PNG по ключу и поднимает его в начало очереди.
+
+        :param key: Ключ из chart_key
+        :type key: str
+        :return: PNG или None при промахе
+        :rtype: bytes
+        """
+        png = self._items.get(key)
+        if png is None:
+            self.misses += 1
+            metrics.CHART_CACHE.inc(result="miss")
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        metrics.CHART_CACHE.inc(result="hit")
+        return png
+
+    def put(self, key: str, png: bytes, user_id: str = None):
+        """
+        Кладет PNG в кэш, вытесняя самые старые записи.
+
+        :param key: Ключ из chart_key
+        :type key: str
+        :param png: Содержимое PNG файла
+        :type png: bytes
+        :param user_id: Пользователь, которому принадлежит диаграмма
+        :type user_id: str
+        """
+        if len(png) > self.max_bytes:
+            return
+        if key not in self._items:
+            self._items[key] = png
+            self.size += len(png)
+        self._items.move_to_end(key)
+        if user_id is not None:
+            self._owners.setdefault(key, set()).add(user_id)
+            self._by_user.setdefault(user_id, set()).add(key)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._items)))
+
+    def invalidate(self, user_id: str):
+        """
+        Забывает диаграммы пользователя после изменения его данных.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        """
+        for key in self._by_user.pop(user_id, ()):
+            owners = self._owners.get(key)
+            if owners is None:
+                continue
+            owners.discard(user_id)
+            if not owners:
+                self._drop(key)
+
+    def _drop(self, key: str):
+        self.size -= len(self._items.pop(key))
+        for user_id in self._owners.pop(key, ()):
+            keys = self._by_user.get(user_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_user[user_id]
+
+
+class ChartRenderer:
+    """
+    Рисует диаграммы в пуле процессов (при workers=0 - в потоке),
+    не блокируя цикл событий.
+
+    Число ожидающих диаграмм ограничено: если пул перегружен,
+    диаграмма не готова за timeout секунд или отрисовка упала,
+    render возвращает None, и бот отвечает только текстом. Пул,
+    процесс которого погиб, заменяется новым при следующей диаграмме.
+    :ivar workers: Количество процессов (0 - рисовать в потоке)
+    :type workers: int
+    :ivar max_pending: Максимум диаграмм в очереди и в работе
+    :type max_pending: int
+    :ivar timeout: Время ожидания одной диаграммы в секундах
+    :type timeout: float
+    :ivar pending: Диаграммы, которые сейчас в очереди или в работе
+    :type pending: int
+    :ivar cache: Кэш готовых диаграмм
+    :type cache: ChartCache
+    :ivar warm: Импортировать matplotlib заранее при запуске бота
+    :type warm: bool
+    :ivar fmt: Формат диаграмм: "png" или векторный "svg"
+    :type fmt: str
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 8,
+                 timeout: float = 5.0, cache: ChartCache = None,
+                 warm: bool = False, fmt: str = "png"):
+        """
+        Создает рендерер. Пул процессов запускается при первом вызове.
+
+        :param workers: Количество процессов (0 - рисовать в потоке)
+        :type workers: int
+        :param max_pending: Максимум диаграмм в очереди и в работе
+        :type max_pending: int
+        :param timeout: Время ожидания одной диаграммы в секундах
+        :type timeout: float
+        :param cache: Кэш готовых диаграмм, по умолчанию 32 МБ
+        :type cache: ChartCache
+        :param warm: Импортировать matplotlib заранее при запуске бота
+        :type warm: bool
+        :param fmt: Формат диаграмм: "png" или векторный "svg"
+        :type fmt: str
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.cache = cache if cache is not None else ChartCache()
+        self.warm = warm
+        self.fmt = fmt
+        self._pool = None
+
+    def warm_up(self):
+        """
+        Запускает импорт matplotlib в фоне, не дожидаясь его.
+
+        С пулом процессов запускает все процессы пула, каждый из
+        которых готовит заготовки диаграмм при старте; без пула
+        готовит их в фоновом потоке.
+        """
+        if not self.workers:
+            threading.Thread(target=warm_up, daemon=True).start()
+            return
+        pool = self._get_pool()
+        for _ in range(self.workers):
+            pool.submit(warm_up)
+
+    async def render(self, kind: str, by_category: dict,
+                     user_id: str = None):
+        """
+        Возвращает диаграмму из кэша или рисует ее в пуле процессов.
+
+        :param kind: Вид диаграммы: "income" или "expense"
+        :type kind: str
+        :param by_category: Словарь с категориями и суммами
+        :type by_category: dict
+        :param user_id: Пользователь, для которого рисуется диаграмма
+        :type user_id: str
+        :return: PNG (SVG при fmt="svg") или None, если пул перегружен,
+            истек timeout или отрисовка не удалась
+        :rtype: bytes
+        """
+        key = chart_key(kind, by_category, self.fmt)
+        png = self.cache.get(key)
+        if png is None:
+            png = await self._render(kind, by_category)
+            if png is None:
+                return None
+        self.cache.put(key, png, user_id)
+        return png
+
+    def invalidate(self, user_id: str):
+        """
+        Забывает диаграммы пользователя после изменения его данных.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        """
+        self.cache.invalidate(user_id)
+
+    async def _render(self, kind: str, by_category: dict):
+        start = time.perf_counter()
+        png = await self._submit(kind, by_category)
+        if png is None:
+            metrics.CHART_RENDERS.inc(kind=kind, result="fallback")
+        else:
+            metrics.CHART_RENDERS.inc(kind=kind, result="ok")
+            metrics.CHART_SECONDS.observe(time.perf_counter() - start,
+                                          kind=kind)
+        return png
+
+    async def _submit(self, kind: str, by_category: dict):
+        if self.pending >= self.max_pending:
+            return None
+        loop = asyncio.get_running_loop()
+        pool = None
+        if not self.workers:
+            # без пула рисуем в потоке: отрисовка не держит цикл событий,
+            # а render_pie сам не пускает потоки к заготовке одновременно
+            future = loop.run_in_executor(None, render_pie, kind,
+                                          dict(by_category), self.fmt)
+        else:
+            pool = self._get_pool()
+            try:
+                future = pool.submit(render_pie, kind, dict(by_category),
+                                     self.fmt)
+            except BrokenProcessPool:
+                self._drop_pool(pool)
+                return None
+        self.pending += 1
+        # место в очереди освобождается, только когда отрисовка
+        # закончилась, даже если мы перестали ждать по timeout
+        future.add_done_callback(lambda _: self._release(loop))
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), self.timeout
+            )
+        except asyncio.TimeoutError:
+            return None
+        except BrokenProcessPool:
+            logger.error("Процесс пула диаграмм завершился аварийно")
+            self._drop_pool(pool)
+            return None
+        except Exception:
+            logger.exception("Не удалось нарисовать диаграмму %s", kind)
+            return None
+
+    def close(self):
+        """
+        Останавливает пул процессов.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=warm_up
+            )
+        return self._pool
+
+    def _drop_pool(self, pool):
+        # остальные ожидающие этого пула получат BrokenProcessPool сами
+        if self._pool is pool:
+            self._pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, loop):
+        try:
+            loop.call_soon_threadsafe(self._dec)
+        except RuntimeError:
+            # цикл событий уже закрыт
+            self._dec()
+
+    def _dec(self):
+        self.pending -= 1
@@ -0,0 +1,458 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from FinFlow_main import FinanceBot
+from budgets import Budgets
+from charts import ChartRenderer
+from outbox import GLOBAL_BURST, GLOBAL_RATE, Outbox
+from recurring import Recurring
+from storage import JsonStorage, write_atomic
+
+
+def journal_storage(directory: str):
+    """
+    Хранилище узла по умолчанию: data.json с журналом.
+
+    :param directory: Каталог узла
+    :type directory: str
+    :rtype: storage.JsonStorage
+    """
+    os.makedirs(directory, exist_ok=True)
+    return JsonStorage(os.path.join(directory, "data.json"), journal=True)
+
+
+def node_budgets(directory: str) -> Budgets:
+    """
+    Бюджеты пользователей узла: budgets.json в каталоге узла.
+
+    :param directory: Каталог узла
+    :type directory: str
+    :rtype: budgets.Budgets
+    """
+    os.makedirs(directory, exist_ok=True)
+    return Budgets(os.path.join(directory, "budgets.json"))
+
+
+def node_recurring(directory: str) -> Recurring:
+    """
+    Регулярные операции пользователей узла: recurring.json в каталоге узла.
+
+    :param directory: Каталог узла
+    :type directory: str
+    :rtype: recurring.Recurring
+    """
+    os.makedirs(directory, exist_ok=True)
+    return Recurring(os.path.join(directory, "recurring.json"))
+
+
+def node_names(workers: int) -> list:
+    """
+    Возвращает имена узлов кластера из workers процессов.
+
+    :param workers: Количество процессов
+    :type workers: int
+    :rtype: list
+    """
+    return [f"worker-{i}" for i in range(workers)]
+
+
+def ring_hash(key: str) -> int:
+    """
+    Хэш ключа на кольце: первые 8 байт BLAKE2b.
+
+    :param key: Ключ
+    :type key: str
+    :rtype: int
+    """
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HashRing:
+    """
+    Консистентное хэширование пользователей по узлам.
+
+    Каждый узел занимает vnodes точек на кольце, пользователь
+    принадлежит узлу первой точки после хэша его ID. При добавлении
+    или удалении узла переезжает примерно 1/N пользователей,
+    а не почти все, как при user_id % N.
+    :ivar nodes: Имена узлов
+    :type nodes: list
+    :ivar vnodes: Количество точек одного узла
+    :type vnodes: int
+    """
+
+    def __init__(self, nodes: list, vnodes: int = 64):
+        """
+        Строит кольцо.
+
+        :param nodes: Имена узлов
+        :type nodes: list
+        :param vnodes: Количество точек одного узла
+        :type vnodes: int
+        :raises ValueError: Если узлов нет
+        """
+        if not nodes:
+            raise ValueError("Кольцо без узлов")
+        self.nodes = list(nodes)
+        self.vnodes = vnodes
+        points = sorted((ring_hash(f"{node}#{i}"), node)
+                        for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node(self, user_id) -> str:
+        """
+        Возвращает узел, которому принадлежит пользователь.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :rtype: str
+        """
+        i = bisect.bisect(self._hashes, ring_hash(str(user_id)))
+        return self._owners[i % len(self._owners)]
+
+
+def rebalance(directory: str, workers: int,
+              storage_factory=journal_storage, vnodes: int = 64) -> int:
+    """
+    Переносит пользователей между узлами после изменения их числа.
+
+    Число узлов хранится в ``<directory>/cluster.json``. Если оно
+    изменилось, истории, бюджеты и регулярные операции пользователей,
+    сменивших узел, копируются на новый узел и удаляются со старого.
+    Прерванный перенос можно повторить: пока пользователь не удален
+    со старого узла, его неполная копия на новом узле перезаписывается.
+
+    :param directory: Каталог кластера
+    :type directory: str
+    :param workers: Новое количество узлов
+    :type workers: int
+    :param storage_factory: Функция, создающая хранилище по каталогу узла
+    :param vnodes: Количество точек одного узла на кольце
+    :type vnodes: int
+    :return: Количество перенесенных пользователей
+    :rtype: int
+    """
+    os.makedirs(directory, exist_ok=True)
+    state_path = os.path.join(directory, "cluster.json")
+    state = {"workers": workers, "vnodes": vnodes}
+    old = None
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            old = json.load(f)
+
+    moved = 0
+    if old is not None and old != state:
+        ring = HashRing(node_names(workers), vnodes)
+        names = set(node_names(old["workers"])) | set(ring.nodes)
+        stores = {}
+        budgets = {}
+        rules = {}
+        for name in sorted(names):
+            stores[name] = storage_factory(os.path.join(directory, name))
+            stores[name].load()
+            budgets[name] = node_budgets(os.path.join(directory, name))
+            rules[name] = node_recurring(os.path.join(directory, name))
+        try:
+            for name in node_names(old["workers"]):
+                source = stores[name]
+                # у пользователя могут быть бюджеты или правила,
+                # но еще не быть записей
+                users = list(dict.fromkeys([
+                    *source.users(), *budgets[name].limits,
+                    *budgets[name].fired, *rules[name].rules
+                ]))
+                for user_id in users:
+                    node = ring.node(user_id)
+                    target = stores[node]
+                    if target is source:
+                        continue
+                    if target.has_user(user_id):
+                        target.remove(user_id)
+                    if source.has_user(user_id):
+                        target.append_many(user_id,
+                                           list(source.records(user_id)))
+                        target.flush()
+                    budgets[node].put(user_id, budgets[name].pop(user_id))
+                    rules[node].put(user_id, rules[name].pop(user_id))
+                    if source.has_user(user_id):
+                        source.remove(user_id)
+                    moved += 1
+        finally:
+            for store in stores.values():
+                store.close()
+            for node in budgets.values():
+                node.save()
+            for node in rules.values():
+                node.save()
+
+    write_atomic(state_path, json.dumps(state).encode("utf-8"))
+    return moved
+
+
+def worker_outbox(workers: int) -> Outbox:
+    """
+    Очередь исходящих запросов узла.
+
+    Лимит Bot API на все запросы бота делится поровну между узлами,
+    иначе N узлов отправляли бы в N раз больше. Лимиты чатов
+    не делятся: личный чат пользователя обслуживает один узел.
+
+    :param workers: Количество узлов
+    :type workers: int
+    :rtype: outbox.Outbox
+    """
+    return Outbox(global_rate=GLOBAL_RATE / workers,
+                  global_burst=max(1, GLOBAL_BURST // workers))
+
+
+def run_worker(name: str, token: str, updates, directory: str,
+               storage_factory=journal_storage, base_url: str = None,
+               concurrency: int = 64, workers: int = 1):
+    """
+    Точка входа процесса-узла: свой FinanceBot со своим хранилищем.
+
+    :param name: Имя узла
+    :type name: str
+    :param token: Токен бота
+    :type token: str
+    :param updates: Очередь обновлений в JSON, None - остановка
+    :type updates: multiprocessing.Queue
+    :param directory: Каталог кластера
+    :type directory: str
+    :param storage_factory: Функция, создающая хранилище по каталогу узла
+    :param base_url: Адрес Bot API, по умолчанию api.telegram.org
+    :type base_url: str
+    :param concurrency: Сколько сообщений обрабатывать одновременно
+    :type concurrency: int
+    :param workers: Количество узлов, между которыми делится лимит Bot API
+    :type workers: int
+    """
+    storage = storage_factory(os.path.join(directory, name))
+    budgets = node_budgets(os.path.join(directory, name))
+    recurring = node_recurring(os.path.join(directory, name))
+    # узел сам является единицей масштабирования, поэтому диаграммы
+    # рисуются в его процессе, а не в отдельном пуле
+    bot = FinanceBot(token, storage=storage, charts=ChartRenderer(workers=0),
+                     budgets=budgets, recurring=recurring,
+                     outbox=worker_outbox(workers))
+    asyncio.run(serve_updates(bot, updates, concurrency, base_url))
+
+
+async def serve_updates(bot: FinanceBot, updates, concurrency: int = 64,
+                        base_url: str = None):
+    """
+    Обрабатывает обновления из очереди диспетчера до получения None.
+
+    :param bot: Бот узла
+    :type bot: FinFlow_main.FinanceBot
+    :param updates: Очередь обновлений в JSON
+    :type updates: multiprocessing.Queue
+    :param concurrency: Сколько сообщений обрабатывать одновременно
+    :type concurrency: int
+    :param base_url: Адрес Bot API, по умолчанию api.telegram.org
+    :type base_url: str
+    """
+    app = bot.build_app(concurrency, base_url=base_url)
+    loop = asyncio.get_running_loop()
+    await app.initialize()
+    await bot.post_init(app)
+    await app.start()
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            update = Update.de_json(json.loads(raw), app.bot)
+            await app.update_queue.put(update)
+    finally:
+        await app.stop()
+        await bot.post_stop(app)
+        await app.shutdown()
+        bot.storage.close()
+        bot.charts.close()
+
+
+class Cluster:
+    """
+    Диспетчер обновлений и N процессов-узлов.
+
+    Диспетчер получает обновления (polling или webhook) и по
+    консистентному хэшу ID пользователя передает их узлу. Каждый
+    узел - отдельный процесс со своим FinanceBot, хранилищем
+    в ``<directory>/worker-<i>`` и кэшем сводок, поэтому узлы
+    загружают разные ядра. Ответы узлы отправляют в Bot API сами.
+    :ivar ring: Кольцо узлов
+    :type ring: HashRing
+    :ivar directory: Каталог кластера
+    :type directory: str
+    :ivar routed: Количество обновлений, переданных каждому узлу
+    :type routed: dict
+    """
+
+    def __init__(self, token: str, workers: int = 2,
+                 directory: str = "cluster",
+                 storage_factory=journal_storage, vnodes: int = 64,
+                 base_url: str = None, concurrency: int = 64):
+        """
+        Настраивает кластер. Процессы запускаются методом start.
+
+        :param token: Токен бота
+        :type token: str
+        :param workers: Количество процессов-узлов
+        :type workers: int
+        :param directory: Каталог кластера
+        :type directory: str
+        :param storage_factory: Функция уровня модуля, создающая
+            хранилище по каталогу узла (передается в процессы)
+        :param vnodes: Количество точек одного узла на кольце
+        :type vnodes: int
+        :param base_url: Адрес Bot API, по умолчанию api.telegram.org
+        :type base_url: str
+        :param concurrency: Сколько сообщений узел обрабатывает одновременно
+        :type concurrency: int
+        """
+        self.token = token
+        self.directory = directory
+        self.storage_factory = storage_factory
+        self.vnodes = vnodes
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.ring = HashRing(node_names(workers), vnodes)
+        self.routed = dict.fromkeys(self.ring.nodes, 0)
+        self._queues = {}
+        self._processes = {}
+
+    def start(self) -> int:
+        """
+        Переносит пользователей при изменении числа узлов
+        и запускает процессы-узлы.
+
+        :return: Количество перенесенных пользователей
+        :rtype: int
+        """
+        moved = rebalance(self.directory, len(self.ring.nodes),
+                          self.storage_factory, self.vnodes)
+        context = multiprocessing.get_context("spawn")
+        for name in self.ring.nodes:
+            updates = context.Queue()
+            process = context.Process(
+                target=run_worker,
+                args=(name, self.token, updates, self.directory,
+                      self.storage_factory, self.base_url,
+                      self.concurrency, len(self.ring.nodes)),
+                name=f"finflow-{name}",
+                daemon=True
+            )
+            process.start()
+            self._queues[name] = updates
+            self._processes[name] = process
+        return moved
+
+    def route(self, user_id, raw: str) -> str:
+        """
+        Передает обновление узлу пользователя.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: int
+        :param raw: Обновление в JSON
+        :type raw: str
+        :return: Имя узла
+        :rtype: str
+        """
+        name = self.ring.node(user_id)
+        self._queues[name].put(raw)
+        self.routed[name] += 1
+        return name
+
+    async def dispatch(self, update: Update, context):
+        """
+        Обработчик диспетчера: передает любое обновление узлу.
+
+        :param update: Входящее обновление
+        :type update: telegram.Update
+        :param context: Контекст выполнения
+        :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
+        """
+        user = update.effective_user
+        self.route(user.id if user is not None else 0, update.to_json())
+
+    def build_app(self, request=None):
+        """
+        Создает приложение диспетчера.
+
+        Обновления обрабатываются по одному, чтобы сообщения
+        пользователя попадали в очередь узла в порядке получения.
+
+        :param request: Транспорт Bot API (для тестов), по умолчанию HTTP
+        :type request: telegram.request.BaseRequest
+        :rtype: telegram.ext.Application
+        """
+        builder = Application.builder().token(self.token)
+        if request is not None:
+            builder = builder.request(request).get_updates_request(request)
+        if self.base_url is not None:
+            builder = builder.base_url(self.base_url)
+        app = builder.build()
+        app.add_handler(TypeHandler(Update, self.dispatch))
+        return app
+
+    def stop(self, timeout: float = 30.0):
+        """
+        Останавливает узлы, дождавшись обработки их очередей.
+
+        :param timeout: Время ожидания одного процесса в секундах
+        :type timeout: float
+        """
+        for updates in self._queues.values():
+            updates.put(None)
+        for process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._queues = {}
+        self._processes = {}
+
+    def run(self, mode: str = "polling", host: str = "127.0.0.1",
+            port: int = 8443, path: str = "webhook",
+            webhook_url: str = None, secret_token: str = None):
+        """
+        Запускает узлы и диспетчер, см. FinanceBot.run.
+
+        :param mode: Режим получения обновлений: "polling" или "webhook"
+        :type mode: str
+        :param host: Адрес, на котором слушает webhook
+        :type host: str
+        :param port: Порт webhook
+        :type port: int
+        :param path: Путь webhook
+        :type path: str
+        :param webhook_url: Внешний URL, который сообщается Telegram
+        :type webhook_url: str
+        :param secret_token: Секрет для проверки запросов Telegram
+        :type secret_token: str
+        """
+        self.start()
+        try:
+            app = self.build_app()
+            print(f"Кластер запущен: {len(self.ring.nodes)} узлов")
+            if mode == "webhook":
+                app.run_webhook(
+                    listen=host,
+                    port=port,
+                    url_path=path,
+                    webhook_url=webhook_url,
+                    secret_token=secret_token
+                )
+            else:
+                app.run_polling()
+        finally:
+            self.stop()
@@ -0,0 +1,493 @@
+import asyncio
+import codecs
+import csv
+import functools
+import io
+import math
+import re
+import time
+from datetime import datetime, timedelta
+
+from storage import Storage
+
+
+# Названия столбцов выписок разных банков, в нижнем регистре
+HEADERS = {
+    "date": ("date", "дата", "дата операции", "дата платежа",
+             "дата транзакции"),
+    "amount": ("amount", "сумма", "сумма операции", "сумма платежа",
+               "сумма в валюте счета"),
+    "expense": ("debit", "расход", "списание", "сумма списания"),
+    "income": ("credit", "приход", "зачисление", "поступление",
+               "сумма зачисления"),
+    "type": ("type", "тип", "тип операции"),
+    "description": ("description", "описание", "назначение платежа",
+                    "назначение", "комментарий", "описание операции"),
+    "category": ("category", "категория"),
+}
+
+TYPE_WORDS = {
+    "income": "income", "доход": "income", "приход": "income",
+    "зачисление": "income", "пополнение": "income",
+    "expense": "expense", "расход": "expense", "списание": "expense",
+    "покупка": "expense", "оплата": "expense",
+}
+
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                "%d.%m.%Y", "%d.%m.%Y %H:%M", "%d.%m.%Y %H:%M:%S",
+                "%d/%m/%Y")
+
+EXPORT_HEADER = ["Дата операции", "Тип операции", "Сумма", "Категория"]
+EXPORT_TYPES = {"income": "Доход", "expense": "Расход"}
+
+# Правила по умолчанию: (тип операции, регулярное выражение, категория)
+DEFAULT_RULES = [
+    ("expense", r"пят[её]рочк|магнит|перекр[её]ст|ашан|лента|вкусвилл"
+                r"|продукт|супермаркет|кафе|ресторан|кофе|еда|food|cafe",
+     "Еда"),
+    ("expense", r"такси|taxi|uber|метро|metro|транспорт|проезд|бензин"
+                r"|азс|fuel|parking|парковк", "Транспорт"),
+    ("expense", r"жкх|аренд|квартплат|коммунал|электроэнерг|rent",
+     "Жилье"),
+    ("expense", r"кино|театр|концерт|музе|steam|netflix|cinema",
+     "Развлечения"),
+    ("expense", r"одежд|обув|zara|uniqlo|lamoda", "Одежда"),
+    ("expense", r"аптек|клиник|врач|стомат|анализ|pharm", "Здоровье"),
+    ("expense", r"курс|школ|универ|книг|обучен|образов", "Образование"),
+    ("income", r"зарплат|заработн|аванс|salary", "Зарплата"),
+    ("income", r"преми|бонус|bonus", "Премия"),
+    ("income", r"дивиденд|купон|процент|вклад|invest", "Инвестиции"),
+    ("income", r"подар|gift", "Подарок"),
+    ("income", r"выручк|оплата по сч[её]т|invoice", "Бизнес"),
+]
+
+
+class CategoryRules:
+    """
+    Правила выбора категории по описанию операции.
+
+    Правила проверяются по порядку, побеждает первое совпадение;
+    если ни одно правило не подошло, используется fallback.
+    :ivar rules: Тройки (тип, скомпилированное выражение, категория)
+    :type rules: list
+    :ivar fallback: Категория по умолчанию
+    :type fallback: str
+    """
+
+    def __init__(self, rules: list = None, fallback: str = "Прочее"):
+        """
+        Компилирует правила.
+
+        :param rules: Тройки (тип операции, выражение, категория),
+            по умолчанию DEFAULT_RULES
+        :type rules: list
+        :param fallback: Категория по умолчанию
+        :type fallback: str
+        """
+        self.rules = [
+            (kind, re.compile(pattern, re.IGNORECASE), category)
+            for kind, pattern, category in (
+                DEFAULT_RULES if rules is None else rules
+            )
+        ]
+        self.fallback = fallback
+
+    def match(self, kind: str, text: str) -> str:
+        """
+        Выбирает категорию операции.
+
+        :param kind: Тип операции: "income" или "expense"
+        :type kind: str
+        :param text: Описание операции
+        :type text: str
+        :rtype: str
+        """
+        for rule_kind, pattern, category in self.rules:
+            if rule_kind == kind and pattern.search(text):
+                return category
+        return self.fallback
+
+
+def parse_amount(text: str) -> float:
+    """
+    Разбирает сумму в записи банков: "1 234,56", "1.234,56",
+    "1,234.56", "-500.00 ₽", "−12".
+
+    Если в сумме есть и точка, и запятая, десятичный знак - последний
+    из них; разделитель, повторенный несколько раз, отделяет тысячи.
+
+    :param text: Сумма из выписки
+    :type text: str
+    :rtype: float
+    :raises ValueError: Если сумма не распознана или не конечна
+        ("nan", "inf", "1e400")
+    """
+    text = text.strip().replace("−", "-")
+    text = re.sub(r"\s|руб\.?|rub|₽", "", text, flags=re.IGNORECASE)
+    if "," in text and "." in text:
+        text = text.replace("." if text.rfind(",") > text.rfind(".")
+                            else ",", "")
+    for mark in ",.":
+        if text.count(mark) > 1:
+            text = text.replace(mark, "")
+    amount = float(text.replace(",", "."))
+    if not math.isfinite(amount):
+        raise ValueError(f"Сумма не распознана: {text}")
+    return amount
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(text: str) -> int:
+    """
+    Разбирает дату операции в метку времени.
+
+    В выписке одна дата повторяется у многих операций, а strptime
+    медленный, поэтому результаты кэшируются.
+
+    :param text: Дата из выписки
+    :type text: str
+    :rtype: int
+    :raises ValueError: Если дата не распознана
+    """
+    text = text.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return int(datetime.strptime(text, fmt).timestamp())
+        except ValueError:
+            continue
+    raise ValueError(f"Неизвестный формат даты: {text}")
+
+
+def open_text(path: str):
+    """
+    Открывает выписку в UTF-8 или, если это не UTF-8, в cp1251.
+
+    Кодировка определяется по первым 64 КБ, файл читается потоком.
+
+    :param path: Путь к файлу
+    :type path: str
+    :rtype: io.TextIOWrapper
+    """
+    with open(path, "rb") as f:
+        head = f.read(1 << 16)
+    try:
+        codecs.getincrementaldecoder("utf-8-sig")().decode(head)
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1251"
+    return open(path, "r", encoding=encoding, errors="replace", newline="")
+
+
+class CsvImporter:
+    """
+    Потоковый импорт банковских выписок в формате CSV.
+
+    Файл читается построчно, записи добавляются в хранилище пачками
+    по chunk_size через append_many, то есть сохраняются одним
+    сохранением на пачку. Между пачками управление возвращается
+    циклу событий, и бот продолжает отвечать другим пользователям.
+    :ivar rules: Правила выбора категории
+    :type rules: CategoryRules
+    :ivar columns: Явные названия столбцов, например {"date": "Когда"}
+    :type columns: dict
+    :ivar categories: Допустимые категории по типам операций
+    :type categories: dict
+    :ivar chunk_size: Количество записей в одной пачке
+    :type chunk_size: int
+    """
+
+    def __init__(self, rules: CategoryRules = None, columns: dict = None,
+                 categories: dict = None, chunk_size: int = 5000):
+        """
+        Настраивает импорт.
+
+        :param rules: Правила выбора категории, по умолчанию DEFAULT_RULES
+        :type rules: CategoryRules
+        :param columns: Явные названия столбцов по полям HEADERS
+        :type columns: dict
+        :param categories: Категории по типам операций; категория
+            из выписки, совпавшая с допустимой, берется как есть
+        :type categories: dict
+        :param chunk_size: Количество записей в одной пачке
+        :type chunk_size: int
+        """
+        self.rules = rules if rules is not None else CategoryRules()
+        self.columns = columns or {}
+        self.categories = categories or {}
+        self.chunk_size = chunk_size
+
+    def map_header(self, header: list) -> dict:
+        """
+        Сопоставляет полям HEADERS номера столбцов выписки.
+
+        :param header: Первая строка выписки
+        :type header: list
+        :return: Номера столбцов по полям
+        :rtype: dict
+        :raises ValueError: Если нет столбца с датой или суммой
+        """
+        names = [name.strip().lower() for name in header]
+        mapping = {}
+        for field, aliases in HEADERS.items():
+            wanted = self.columns.get(field)
+            aliases = (wanted.strip().lower(),) if wanted else aliases
+            for alias in aliases:
+                if alias in names:
+                    mapping[field] = names.index(alias)
+                    break
+        if "date" not in mapping:
+            raise ValueError("В выписке нет столбца с датой")
+        if "amount" not in mapping and not (
+            "expense" in mapping or "income" in mapping
+        ):
+            raise ValueError("В выписке нет столбца с суммой")
+        return mapping
+
+    def parse_row(self, row: list, mapping: dict):
+        """
+        Превращает строку выписки в запись data.json.
+
+        :param row: Значения строки
+        :type row: list
+        :param mapping: Номера столбцов из map_header
+        :type mapping: dict
+        :return: Запись или None для пустых и нулевых операций
+        :rtype: dict
+        :raises ValueError: Если дата или сумма не распознаны
+        :raises IndexError: Если в строке не хватает столбцов
+        """
+        def cell(field):
+            index = mapping.get(field)
+            return row[index].strip() if index is not None else ""
+
+        if "amount" in mapping:
+            amount = parse_amount(cell("amount"))
+            kind = TYPE_WORDS.get(cell("type").lower())
+            if kind is None:
+                kind = "expense" if amount < 0 else "income"
+        else:
+            # банки часто пишут 0,00 в неиспользованный столбец
+            spent = parse_amount(cell("expense") or "0")
+            got = parse_amount(cell("income") or "0")
+            kind = "expense" if spent else "income"
+            amount = spent or got
+        amount = abs(amount)
+        if not amount:
+            return None
+
+        bank_category = cell("category")
+        if bank_category in self.categories.get(kind, ()):
+            category = bank_category
+        else:
+            text = f"{cell('description')} {bank_category}"
+            category = self.rules.match(kind, text)
+        return {
+            "type": kind,
+            "amount": amount,
+            "category": category,
+            "ts": parse_date(cell("date")),
+        }
+
+    def iter_records(self, lines, stats: dict):
+        """
+        Перебирает записи выписки, не загружая ее целиком.
+
+        Разделитель (";", "," или табуляция) определяется
+        по заголовку. Нераспознанные строки пропускаются
+        и считаются в stats["skipped"].
+
+        :param lines: Строки файла
+        :type lines: iterable
+        :param stats: Счетчики импорта
+        :type stats: dict
+        :return: Записи в формате data.json
+        :rtype: iterable
+        :raises ValueError: Если заголовок выписки не распознан
+        """
+        lines = iter(lines)
+        first = next(lines, "")
+        delimiter = max(";,\t", key=first.count)
+        header = next(csv.reader([first], delimiter=delimiter), [])
+        mapping = self.map_header(header)
+        for row in csv.reader(lines, delimiter=delimiter):
+            if not any(value.strip() for value in row):
+                continue
+            try:
+                record = self.parse_row(row, mapping)
+            except (ValueError, IndexError):
+                stats["skipped"] += 1
+                continue
+            if record is None:
+                stats["skipped"] += 1
+                continue
+            yield record
+
+    async def import_lines(self, storage: Storage, user_id: str,
+                           lines) -> dict:
+        """
+        Импортирует выписку в историю пользователя.
+
+        :param storage: Хранилище данных
+        :type storage: storage.Storage
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param lines: Строки файла
+        :type lines: iterable
+        :return: Счетчики: imported, skipped, chunks, income, expense,
+            commit_seconds
+        :rtype: dict
+        :raises ValueError: Если заголовок выписки не распознан
+        """
+        stats = {"imported": 0, "skipped": 0, "chunks": 0,
+                 "income": 0, "expense": 0, "commit_seconds": 0.0}
+        chunk = []
+        for record in self.iter_records(lines, stats):
+            chunk.append(record)
+            stats[record["type"]] += record["amount"]
+            if len(chunk) >= self.chunk_size:
+                self._commit(storage, user_id, chunk, stats)
+                chunk = []
+                await asyncio.sleep(0)
+        if chunk:
+            self._commit(storage, user_id, chunk, stats)
+        return stats
+
+    async def import_file(self, storage: Storage, user_id: str,
+                          path: str) -> dict:
+        """
+        Импортирует выписку из файла, см. import_lines.
+
+        :param storage: Хранилище данных
+        :type storage: storage.Storage
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param path: Путь к файлу выписки
+        :type path: str
+        :rtype: dict
+        """
+        with open_text(path) as f:
+            return await self.import_lines(storage, user_id, f)
+
+    @staticmethod
+    def _commit(storage: Storage, user_id: str, chunk: list, stats: dict):
+        start = time.perf_counter()
+        storage.append_many(user_id, chunk)
+        stats["imported"] += len(chunk)
+        stats["chunks"] += 1
+        stats["commit_seconds"] += time.perf_counter() - start
+
+
+def filter_period(records, start, end):
+    """
+    Оставляет записи за период с start по end включительно.
+
+    Записи без метки времени в период не попадают, как и в отчетах.
+
+    :param records: Записи пользователя
+    :type records: iterable
+    :param start: Первый день периода
+    :type start: datetime.date
+    :param end: Последний день периода
+    :type end: datetime.date
+    :rtype: iterable
+    """
+    lo = datetime(start.year, start.month, start.day).timestamp()
+    hi = (datetime(end.year, end.month, end.day)
+          + timedelta(days=1)).timestamp()
+    for record in records:
+        ts = record.get("ts")
+        if ts is not None and lo <= ts < hi:
+            yield record
+
+
+def record_rows(records):
+    """
+    Перебирает строки таблицы операций для экспорта.
+
+    Формат совпадает с тем, что понимает CsvImporter, поэтому
+    выгруженный файл можно загрузить обратно.
+
+    :param records: Записи пользователя
+    :type records: iterable
+    :rtype: iterable
+    """
+    yield EXPORT_HEADER
+    for record in records:
+        ts = record.get("ts")
+        day = (datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+               if ts is not None else "")
+        yield [day, EXPORT_TYPES[record["type"]], record["amount"],
+               record["category"]]
+
+
+def summary_rows(summ):
+    """
+    Перебирает строки таблицы итогов по категориям.
+
+    Суммы и доли те же, что в отчете "Категории": категории
+    отсортированы по убыванию суммы, доли в процентах от итога.
+
+    :param summ: Сводка пользователя
+    :type summ: summary.Summary
+    :rtype: iterable
+    """
+    yield ["Тип операции", "Категория", "Сумма", "Доля, %"]
+    for kind, by_cat in (("expense", summ.exp_by_cat),
+                         ("income", summ.inc_by_cat)):
+        total = sum(by_cat.values())
+        for category, amount in sorted(by_cat.items(), key=lambda x: x[1],
+                                       reverse=True):
+            yield [EXPORT_TYPES[kind], category, amount,
+                   f"{amount / total * 100:.1f}"]
+    yield ["Итого", "Доходы", summ.income, ""]
+    yield ["Итого", "Расходы", summ.expense, ""]
+    yield ["Итого", "Баланс", summ.income - summ.expense, ""]
+
+
+def iter_csv(rows, chunk_rows: int = 1000):
+    """
+    Кодирует строки таблицы в CSV частями по chunk_rows строк.
+
+    Файл начинается с BOM и использует разделитель ";", чтобы
+    Excel сразу открывал его с кириллицей и по столбцам.
+
+    :param rows: Строки таблицы
+    :type rows: iterable
+    :param chunk_rows: Количество строк в одной части
+    :type chunk_rows: int
+    :return: Части файла
+    :rtype: iterable
+    """
+    yield codecs.BOM_UTF8
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=";", lineterminator="\n")
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count == chunk_rows:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+            count = 0
+    if count:
+        yield buf.getvalue().encode("utf-8")
+
+
+async def write_chunks(chunks, f) -> int:
+    """
+    Записывает части файла, возвращая управление циклу событий
+    после каждой части.
+
+    :param chunks: Части файла
+    :type chunks: iterable
+    :param f: Файл, открытый на запись в двоичном режиме
+    :return: Количество записанных байт
+    :rtype: int
+    """
+    size = 0
+    for chunk in chunks:
+        f.write(chunk)
+        size += len(chunk)
+        await asyncio.sleep(0)
+    return size
@@ -0,0 +1,282 @@
+"""
+Заглушки Telegram для тестов и нагрузочных замеров без сети.
+"""
+import email.policy
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import InputFile
+from telegram.request import BaseRequest
+
+
+class FakeUser:
+    """Пользователь Telegram с одним полем id"""
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeDocument:
+    """Присланный файл, который "скачивается" копированием с диска"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file_size = os.path.getsize(path)
+
+    async def get_file(self):
+        return self
+
+    async def download_to_drive(self, custom_path: str):
+        shutil.copy(self.path, custom_path)
+
+
+class FakeMessage:
+    """
+    Входящее сообщение, ответы которого складываются в список.
+
+    :ivar replies: Отправленные ответы: пары (метод, текст или подпись)
+    :type replies: list
+    """
+
+    def __init__(self, user_id: int, text: str, replies: list = None,
+                 document: FakeDocument = None):
+        self.text = text
+        self.from_user = FakeUser(user_id)
+        self.chat_id = user_id
+        self.document = document
+        self.replies = replies if replies is not None else []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(("text", text))
+
+    async def reply_photo(self, photo, caption=None, **kwargs):
+        self.replies.append(("photo", caption))
+
+    async def reply_document(self, document, filename=None, **kwargs):
+        if isinstance(document, InputFile):
+            document = document.input_file_content
+        if not isinstance(document, bytes):
+            document = document.read()
+        self.replies.append(("document", document))
+
+    async def reply_media_group(self, media, caption=None, **kwargs):
+        captions = [item.caption for item in media]
+        if caption is not None:
+            captions[0] = caption
+        self.replies.append(("media", captions))
+
+
+class FakeUpdate:
+    """Update с одним текстовым сообщением"""
+
+    def __init__(self, user_id: int, text: str, replies: list = None,
+                 document: FakeDocument = None):
+        self.message = FakeMessage(user_id, text, replies, document)
+        self.effective_user = self.message.from_user
+        self.effective_chat = self.message.from_user
+
+
+class FakeContext:
+    """Контекст обработчика с user_data и аргументами команды"""
+
+    def __init__(self, user_data: dict = None, args: list = None):
+        self.user_data = user_data if user_data is not None else {}
+        self.args = args or []
+
+
+class FakeBotApi(BaseRequest):
+    """
+    Транспорт Bot API, отвечающий из памяти без сети.
+
+    Подставляется в Application.builder().request(...), все вызовы
+    send* складываются в sent.
+    :ivar sent: Пары (метод Bot API, параметры запроса)
+    :type sent: list
+    :ivar flood: Сколько следующих send* отклонить с ошибкой 429
+    :type flood: int
+    :ivar retry_after: Пауза в секундах, которую просит ошибка 429
+    :type retry_after: int
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.flood = 0
+        self.retry_after = 1
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None,
+                         read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        return self.answer(api_method, params)
+
+    def answer(self, api_method: str, params: dict) -> tuple:
+        """
+        Выполняет вызов Bot API.
+
+        :param api_method: Метод Bot API, например sendMessage
+        :type api_method: str
+        :param params: Параметры запроса
+        :type params: dict
+        :return: Код HTTP и тело ответа
+        :rtype: tuple
+        """
+        with self._lock:
+            if api_method.startswith("send") and self.flood:
+                self.flood -= 1
+                return 429, json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests",
+                    "parameters": {"retry_after": self.retry_after},
+                }).encode()
+            if api_method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "FinFlow",
+                          "username": "finflow_bot"}
+            elif api_method == "sendMediaGroup":
+                self.sent.append((api_method, params))
+                result = [self.message(params) for _ in params["media"]]
+            elif api_method.startswith("send"):
+                self.sent.append((api_method, params))
+                result = self.message(params)
+            else:
+                result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def message(self, params: dict) -> dict:
+        """
+        Формирует ответ Bot API с отправленным сообщением.
+
+        :param params: Параметры запроса send*
+        :type params: dict
+        :rtype: dict
+        """
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+
+class FakeBotApiServer:
+    """
+    HTTP сервер Bot API на localhost поверх FakeBotApi.
+
+    Нужен, когда бот работает в других процессах: им передается
+    base_url сервера, а вызовы складываются в api.sent.
+    :ivar api: Обработчик вызовов
+    :type api: FakeBotApi
+    :ivar base_url: Адрес для Application.builder().base_url(...)
+    :type base_url: str
+    """
+
+    def __init__(self, api: FakeBotApi = None):
+        self.api = api if api is not None else FakeBotApi()
+        api = self.api
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                params = parse_body(self.headers.get("Content-Type", ""),
+                                    self.rfile.read(length))
+                status, body = api.answer(self.path.rsplit("/", 1)[-1],
+                                          params)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/bot"
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        """
+        Останавливает сервер.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def parse_body(content_type: str, body: bytes) -> dict:
+    """
+    Разбирает тело запроса Bot API: форму, multipart или JSON.
+
+    Объекты и массивы, переданные строкой JSON, раскрываются;
+    файлы из multipart попадают в параметры в виде байтов.
+
+    :param content_type: Заголовок Content-Type
+    :type content_type: str
+    :param body: Тело запроса
+    :type body: bytes
+    :rtype: dict
+    """
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=email.policy.default).parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is not None:
+                params[name] = part.get_payload(decode=True)
+            else:
+                params[name] = part.get_content().strip()
+    else:
+        params = dict(urllib.parse.parse_qsl(body.decode("utf-8")))
+    for name, value in params.items():
+        if isinstance(value, str) and value.startswith(("[", "{")):
+            params[name] = json.loads(value)
+    return params
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    """
+    Формирует JSON обновления Telegram с текстовым сообщением.
+
+    :param update_id: Номер обновления
+    :type update_id: int
+    :param user_id: ID пользователя
+    :type user_id: int
+    :param text: Текст сообщения
+    :type text: str
+    :rtype: dict
+    """
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0,
+                                 "length": len(command)}]
+    return {"update_id": update_id, "message": message}
@@ -0,0 +1,183 @@
+import numpy as np
+from summary import Summary
+
+
+TYPES = ("income", "expense")
+
+# Категории из клавиатур бота получают постоянные коды,
+# незнакомые добавляются в таблицу при первой встрече.
+CATEGORIES = [
+    "Еда", "Транспорт", "Жилье", "Развлечения", "Одежда", "Здоровье",
+    "Образование", "Прочее", "Подарки",
+    "Зарплата", "Бизнес", "Инвестиции", "Подарок", "Премия",
+]
+CATEGORY_CODES = {name: code for code, name in enumerate(CATEGORIES)}
+
+
+def category_code(name: str) -> int:
+    """
+    Возвращает код категории, добавляя ее в таблицу при необходимости.
+
+    :param name: Название категории
+    :type name: str
+    :rtype: int
+    """
+    code = CATEGORY_CODES.get(name)
+    if code is None:
+        code = CATEGORY_CODES[name] = len(CATEGORIES)
+        CATEGORIES.append(name)
+    return code
+
+
+class Ledger:
+    """
+    Компактная история операций одного пользователя.
+
+    Суммы хранятся в массиве float64, тип и категория - в виде
+    небольших целых кодов. Запись занимает 20 байт вместо сотен
+    байт у словаря, а сводка считается через numpy.bincount.
+    :ivar amounts: Суммы операций
+    :type amounts: numpy.ndarray
+    :ivar kinds: Коды типов операций (индексы в TYPES)
+    :type kinds: numpy.ndarray
+    :ivar cats: Коды категорий (индексы в CATEGORIES)
+    :type cats: numpy.ndarray
+    :ivar ints: Была ли сумма целым числом в исходной записи
+    :type ints: numpy.ndarray
+    :ivar stamps: Метки времени записей, -1 у записей без метки
+    :type stamps: numpy.ndarray
+    :ivar size: Количество записей
+    :type size: int
+    """
+
+    __slots__ = ("amounts", "kinds", "cats", "ints", "stamps", "size")
+
+    def __init__(self, capacity: int = 16):
+        """
+        Создает пустую историю.
+
+        :param capacity: Начальная вместимость массивов
+        :type capacity: int
+        """
+        self.amounts = np.empty(capacity, dtype=np.float64)
+        self.kinds = np.empty(capacity, dtype=np.uint8)
+        self.cats = np.empty(capacity, dtype=np.uint16)
+        self.ints = np.empty(capacity, dtype=np.bool_)
+        self.stamps = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_records(cls, records: list):
+        """
+        Строит историю из записей в формате data.json.
+
+        :param records: Записи пользователя
+        :type records: list
+        :rtype: Ledger
+        """
+        ledger = cls(max(len(records), 16))
+        n = len(records)
+        ledger.amounts[:n] = [r["amount"] for r in records]
+        ledger.kinds[:n] = [r["type"] == "expense" for r in records]
+        ledger.cats[:n] = [category_code(r["category"]) for r in records]
+        ledger.ints[:n] = [isinstance(r["amount"], int) for r in records]
+        ledger.stamps[:n] = [r.get("ts", -1) for r in records]
+        ledger.size = n
+        return ledger
+
+    def to_records(self, start: int = 0, stop: int = None) -> list:
+        """
+        Возвращает записи в формате data.json.
+
+        :param start: Номер первой записи
+        :type start: int
+        :param stop: Номер записи после последней, по умолчанию до конца
+        :type stop: int
+        :rtype: list
+        """
+        n = self.size if stop is None else min(stop, self.size)
+        records = []
+        for amount, kind, cat, is_int, ts in zip(
+            self.amounts[start:n].tolist(), self.kinds[start:n].tolist(),
+            self.cats[start:n].tolist(), self.ints[start:n].tolist(),
+            self.stamps[start:n].tolist()
+        ):
+            record = {
+                "type": TYPES[kind],
+                "amount": int(amount) if is_int else amount,
+                "category": CATEGORIES[cat]
+            }
+            if ts >= 0:
+                record["ts"] = ts
+            records.append(record)
+        return records
+
+    def append(self, record: dict):
+        """
+        Добавляет запись, увеличивая массивы вдвое при нехватке места.
+
+        :param record: Запись о доходе или расходе
+        :type record: dict
+        """
+        if self.size == len(self.amounts):
+            self._grow(2 * self.size)
+        i = self.size
+        self.amounts[i] = record["amount"]
+        self.kinds[i] = record["type"] == "expense"
+        self.cats[i] = category_code(record["category"])
+        self.ints[i] = isinstance(record["amount"], int)
+        self.stamps[i] = record.get("ts", -1)
+        self.size += 1
+
+    def summary(self) -> Summary:
+        """
+        Считает сводку векторными операциями numpy.
+
+        Категории в сводке идут в порядке первого появления,
+        как и при сложении записей по одной.
+
+        :rtype: summary.Summary
+        """
+        n = self.size
+        summ = Summary()
+        summ.count = n
+        if not n:
+            return summ
+
+        amounts = self.amounts[:n]
+        kinds = self.kinds[:n]
+        totals = np.bincount(kinds, weights=amounts, minlength=2).tolist()
+        counts = np.bincount(kinds, minlength=2).tolist()
+        if counts[0]:
+            summ.income = totals[0]
+        if counts[1]:
+            summ.expense = totals[1]
+
+        keys = self.cats[:n].astype(np.int64) * 2 + kinds
+        sums = np.bincount(keys, weights=amounts)
+        present, first = np.unique(keys, return_index=True)
+        for key in present[np.argsort(first)].tolist():
+            cat, kind = divmod(key, 2)
+            target = summ.exp_by_cat if kind else summ.inc_by_cat
+            target[CATEGORIES[cat]] = sums[key].item()
+        return summ
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Объем памяти, занятый массивами.
+
+        :rtype: int
+        """
+        return (self.amounts.nbytes + self.kinds.nbytes
+                + self.cats.nbytes + self.ints.nbytes + self.stamps.nbytes)
+
+    def _grow(self, capacity: int):
+        for name in ("amounts", "kinds", "cats", "ints", "stamps"):
+            old = getattr(self, name)
+            new = np.empty(max(capacity, 16), dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
@@ -0,0 +1,411 @@
+import asyncio
+import bisect
+import functools
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Registry:
+    """
+    Набор метрик бота и их вывод в текстовом формате Prometheus.
+
+    Если enabled равно False, метрики не обновляются и замеры
+    времени сводятся к одной проверке флага.
+    :ivar enabled: Включен ли сбор метрик
+    :type enabled: bool
+    :ivar metrics: Зарегистрированные метрики в порядке создания
+    :type metrics: list
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics = []
+
+    def counter(self, name: str, description: str):
+        """
+        Создает и регистрирует счетчик.
+
+        :param name: Имя метрики
+        :type name: str
+        :param description: Описание метрики
+        :type description: str
+        :rtype: Counter
+        """
+        metric = Counter(self, name, description)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, description: str):
+        """
+        Создает и регистрирует показатель текущего значения.
+
+        :param name: Имя метрики
+        :type name: str
+        :param description: Описание метрики
+        :type description: str
+        :rtype: Gauge
+        """
+        metric = Gauge(self, name, description)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, description: str, buckets: tuple = None):
+        """
+        Создает и регистрирует гистограмму.
+
+        :param name: Имя метрики
+        :type name: str
+        :param description: Описание метрики
+        :type description: str
+        :param buckets: Верхние границы корзин, по умолчанию для секунд
+        :type buckets: tuple
+        :rtype: Histogram
+        """
+        metric = Histogram(self, name, description,
+                           buckets or LATENCY_BUCKETS)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Выводит все метрики в текстовом формате Prometheus.
+
+        :rtype: str
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        Обнуляет значения всех метрик.
+        """
+        for metric in self.metrics:
+            with metric.lock:
+                metric.values.clear()
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """
+        Отдает метрики по HTTP на /metrics из фонового потока.
+
+        :param port: Порт (0 - выбрать свободный)
+        :type port: int
+        :param host: Адрес для прослушивания
+        :type host: str
+        :return: Запущенный сервер, порт в server.server_port
+        :rtype: http.server.ThreadingHTTPServer
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def write_periodically(self, path: str, interval: float = 15.0):
+        """
+        Раз в interval секунд записывает метрики в файл
+        (например, для textfile collector у node_exporter).
+
+        :param path: Путь к файлу
+        :type path: str
+        :param interval: Интервал записи в секундах
+        :type interval: float
+        :return: Событие, установка которого останавливает запись
+        :rtype: threading.Event
+        """
+        stop = threading.Event()
+
+        def loop():
+            while not stop.is_set():
+                self.write(path)
+                stop.wait(interval)
+            self.write(path)
+
+        threading.Thread(target=loop, daemon=True).start()
+        return stop
+
+    def write(self, path: str):
+        """
+        Атомарно записывает метрики в файл.
+
+        :param path: Путь к файлу
+        :type path: str
+        """
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+class Counter:
+    """
+    Монотонный счетчик с необязательными метками.
+    """
+
+    kind = "counter"
+
+    def __init__(self, registry: Registry, name: str, description: str):
+        self.registry = registry
+        self.name = name
+        self.help = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Увеличивает счетчик.
+
+        :param amount: Величина увеличения
+        :type amount: float
+        :param labels: Метки значения
+        """
+        if not self.registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """
+        Возвращает текущее значение.
+
+        :param labels: Метки значения
+        :rtype: float
+        """
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def lines(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [f"{self.name}{format_labels(key)} {value}"
+                for key, value in items]
+
+
+class Gauge(Counter):
+    """
+    Текущее значение, которое может как расти, так и уменьшаться.
+    """
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        """
+        Устанавливает значение.
+
+        :param value: Новое значение
+        :type value: float
+        :param labels: Метки значения
+        """
+        if not self.registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        """
+        Уменьшает значение.
+
+        :param amount: Величина уменьшения
+        :type amount: float
+        :param labels: Метки значения
+        """
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами и необязательными метками.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, registry: Registry, name: str, description: str,
+                 buckets: tuple):
+        self.registry = registry
+        self.name = name
+        self.help = description
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """
+        Добавляет наблюдение.
+
+        :param value: Наблюдаемое значение
+        :type value: float
+        :param labels: Метки значения
+        """
+        if not self.registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def time(self, **labels):
+        """
+        Контекстный менеджер, замеряющий время блока.
+
+        :param labels: Метки значения
+        :rtype: Timer
+        """
+        return Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        """
+        Возвращает количество наблюдений.
+
+        :param labels: Метки значения
+        :rtype: int
+        """
+        state = self.values.get(tuple(sorted(labels.items())))
+        return state[1] if state else 0
+
+    def lines(self):
+        with self.lock:
+            items = [(key, list(counts), count, total)
+                     for key, (counts, count, total) in self.values.items()]
+        lines = []
+        for key, counts, count, total in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                labels = format_labels(key + (("le", repr(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(key + (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+class Timer:
+    """
+    Замер времени блока with для гистограммы.
+    """
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if self.histogram.registry.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.histogram.observe(time.perf_counter() - self.start,
+                                   **self.labels)
+
+
+def format_labels(key: tuple) -> str:
+    """
+    Форматирует метки в виде {name="value",...}.
+
+    :param key: Пары (имя, значение)
+    :type key: tuple
+    :rtype: str
+    """
+    if not key:
+        return ""
+    parts = []
+    for name, value in key:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def timed(handler: str):
+    """
+    Декоратор, записывающий время вызова в HANDLER_SECONDS.
+
+    :param handler: Значение метки handler
+    :type handler: str
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not REGISTRY.enabled:
+                    return await func(*args, **kwargs)
+                with HANDLER_SECONDS.time(handler=handler):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not REGISTRY.enabled:
+                    return func(*args, **kwargs)
+                with HANDLER_SECONDS.time(handler=handler):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+REGISTRY = Registry()
+
+UPDATES = REGISTRY.counter(
+    "finflow_updates_total", "Обработанные входящие сообщения")
+HANDLER_SECONDS = REGISTRY.histogram(
+    "finflow_handler_seconds", "Время работы обработчиков")
+RECORDS_WRITTEN = REGISTRY.counter(
+    "finflow_records_written_total", "Записи, сохраненные на диск")
+BYTES_PERSISTED = REGISTRY.counter(
+    "finflow_bytes_persisted_total", "Байты, записанные хранилищем")
+FLUSH_SECONDS = REGISTRY.histogram(
+    "finflow_flush_seconds", "Время одного сохранения пачки записей")
+FLUSH_BATCH = REGISTRY.histogram(
+    "finflow_flush_batch_records", "Размер пачки записей при сохранении",
+    SIZE_BUCKETS)
+CHART_RENDERS = REGISTRY.counter(
+    "finflow_chart_renders_total", "Запросы на отрисовку диаграмм")
+CHART_SECONDS = REGISTRY.histogram(
+    "finflow_chart_render_seconds", "Время отрисовки одной диаграммы")
+CHART_CACHE = REGISTRY.counter(
+    "finflow_chart_cache_total", "Обращения к кэшу диаграмм")
+SEND_QUEUE = REGISTRY.gauge(
+    "finflow_send_queue_depth", "Исходящие запросы, ожидающие отправки")
+SEND_SECONDS = REGISTRY.histogram(
+    "finflow_send_seconds", "Время от постановки в очередь до ответа Bot API")
+SEND_RETRIES = REGISTRY.counter(
+    "finflow_send_retries_total", "Повторы запросов после RetryAfter")
+RECURRING_RECORDS = REGISTRY.counter(
+    "finflow_recurring_records_total", "Записи, добавленные по расписанию")
+RECURRING_SECONDS = REGISTRY.histogram(
+    "finflow_recurring_tick_seconds", "Время одного прохода расписания")
@@ -0,0 +1,250 @@
+import asyncio
+import datetime
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+# Ограничение Bot API на все исходящие запросы одного бота
+GLOBAL_RATE = 30.0
+GLOBAL_BURST = 30
+
+
+class TokenBucket:
+    """
+    Ведро токенов: в среднем rate запросов в секунду, до burst подряд.
+
+    :ivar rate: Скорость пополнения, токенов в секунду
+    :type rate: float
+    :ivar burst: Емкость ведра
+    :type burst: int
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def reserve(self, now: float = None) -> float:
+        """
+        Забирает токен и возвращает, сколько секунд ждать до его появления.
+
+        Токен можно взять в долг: следующие запросы ждут дольше,
+        поэтому ожидающие не обгоняют друг друга.
+
+        :param now: Текущее время time.monotonic()
+        :type now: float
+        :rtype: float
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def full(self, now: float) -> bool:
+        """
+        Проверяет, что ведро успело наполниться.
+
+        :param now: Текущее время time.monotonic()
+        :type now: float
+        :rtype: bool
+        """
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class ChatQueue:
+    """
+    Очередь запросов одного чата.
+
+    :ivar lock: Очередь в порядке постановки (asyncio.Lock честный)
+    :type lock: asyncio.Lock
+    :ivar bucket: Ограничение скорости чата
+    :type bucket: TokenBucket
+    :ivar waiting: Запросы в очереди, включая отправляемый
+    :type waiting: int
+    """
+
+    __slots__ = ("lock", "bucket", "waiting")
+
+    def __init__(self, bucket: TokenBucket):
+        self.lock = asyncio.Lock()
+        self.bucket = bucket
+        self.waiting = 0
+
+
+def retry_seconds(error: RetryAfter) -> float:
+    """
+    Возвращает паузу из RetryAfter в секундах.
+
+    :param error: Ошибка Bot API
+    :type error: telegram.error.RetryAfter
+    :rtype: float
+    """
+    value = error.retry_after
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class Outbox(BaseRateLimiter):
+    """
+    Очередь исходящих запросов Bot API с ограничением скорости.
+
+    Подключается через Application.builder().rate_limiter(...), поэтому
+    через нее проходят все send* бота. Запросы одного чата уходят по
+    очереди не чаще chat_rate в секунду (в группах - group_rate),
+    все вместе - не чаще global_rate. После RetryAfter отправка
+    приостанавливается для всех чатов на указанное время, и запрос
+    повторяется до max_retries раз.
+    :ivar queued: Запросы, ожидающие своей очереди
+    :type queued: int
+    """
+
+    def __init__(self, chat_rate: float = 1.0, chat_burst: int = 5,
+                 group_rate: float = 20 / 60, group_burst: int = 3,
+                 global_rate: float = GLOBAL_RATE,
+                 global_burst: int = GLOBAL_BURST,
+                 max_retries: int = 3, max_chats: int = 10000):
+        """
+        Настраивает ограничения.
+
+        :param chat_rate: Запросов в секунду в личный чат
+        :type chat_rate: float
+        :param chat_burst: Запросов подряд в личный чат
+        :type chat_burst: int
+        :param group_rate: Запросов в секунду в группу
+        :type group_rate: float
+        :param group_burst: Запросов подряд в группу
+        :type group_burst: int
+        :param global_rate: Запросов в секунду всего
+        :type global_rate: float
+        :param global_burst: Запросов подряд всего
+        :type global_burst: int
+        :param max_retries: Повторов после RetryAfter
+        :type max_retries: int
+        :param max_chats: После скольких чатов удалять простаивающие очереди
+        :type max_chats: int
+        """
+        self.chat_limits = (chat_rate, chat_burst)
+        self.group_limits = (group_rate, group_burst)
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.queued = 0
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chats = {}
+
+    def chat(self, chat_id) -> ChatQueue:
+        """
+        Возвращает очередь чата, создавая ее при необходимости.
+
+        :param chat_id: ID чата (у групп отрицательный или @username)
+        :rtype: ChatQueue
+        """
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            if len(self._chats) >= self.max_chats:
+                self.prune()
+            try:
+                group = int(chat_id) < 0
+            except ValueError:
+                group = True
+            limits = self.group_limits if group else self.chat_limits
+            entry = self._chats[chat_id] = ChatQueue(TokenBucket(*limits))
+        return entry
+
+    def prune(self):
+        """
+        Удаляет очереди чатов без запросов и с полным ведром.
+        """
+        now = time.monotonic()
+        self._chats = {
+            chat_id: entry for chat_id, entry in self._chats.items()
+            if entry.waiting or not entry.bucket.full(now)
+        }
+
+    async def throttle(self, entry: ChatQueue):
+        """
+        Ждет токена чата, общего токена и окончания паузы после RetryAfter.
+
+        :param entry: Очередь чата
+        :type entry: ChatQueue
+        """
+        delay = entry.bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        now = time.monotonic()
+        delay = max(self._global.reserve(now), self._paused_until - now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint,
+                              data, rate_limit_args):
+        """
+        Ставит запрос в очередь чата и выполняет его в свой черед.
+
+        :param callback: Корутина, выполняющая запрос
+        :param args: Позиционные аргументы callback
+        :type args: tuple
+        :param kwargs: Именованные аргументы callback
+        :type kwargs: dict
+        :param endpoint: Метод Bot API, например sendMessage
+        :type endpoint: str
+        :param data: Параметры запроса
+        :type data: dict
+        :param rate_limit_args: Число повторов вместо max_retries
+        :type rate_limit_args: int
+        :return: Результат callback
+        """
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        retries = (self.max_retries if rate_limit_args is None
+                   else rate_limit_args)
+        start = time.perf_counter()
+        entry = self.chat(chat_id)
+        entry.waiting += 1
+        self.queued += 1
+        metrics.SEND_QUEUE.inc()
+        queued = True
+        try:
+            async with entry.lock:
+                for attempt in range(retries + 1):
+                    await self.throttle(entry)
+                    if queued:
+                        queued = False
+                        self.queued -= 1
+                        metrics.SEND_QUEUE.dec()
+                    try:
+                        result = await callback(*args, **kwargs)
+                        break
+                    except RetryAfter as error:
+                        if attempt == retries:
+                            raise
+                        metrics.SEND_RETRIES.inc(method=endpoint)
+                        self._paused_until = max(
+                            self._paused_until,
+                            time.monotonic() + retry_seconds(error)
+                        )
+        finally:
+            entry.waiting -= 1
+            if queued:
+                self.queued -= 1
+                metrics.SEND_QUEUE.dec()
+        metrics.SEND_SECONDS.observe(time.perf_counter() - start,
+                                     method=endpoint)
+        return result
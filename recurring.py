@@ -0,0 +1,258 @@
+import calendar
+import functools
+import heapq
+import json
+import math
+import os
+from datetime import date, datetime
+
+from storage import write_atomic
+
+KINDS = ("income", "expense")
+
+
+def occurrence(year: int, month: int, day: int) -> int:
+    """
+    Метка времени полуночи дня операции в заданном месяце.
+
+    Если в месяце меньше дней, операция переносится на последний.
+
+    :param year: Год
+    :type year: int
+    :param month: Месяц
+    :type month: int
+    :param day: День месяца из правила, 1-31
+    :type day: int
+    :rtype: int
+    """
+    day = min(day, calendar.monthrange(year, month)[1])
+    return int(datetime(year, month, day).timestamp())
+
+
+# сроки - полночи, и различных пар (срок, день) за проход единицы
+@functools.lru_cache(maxsize=4096)
+def following(ts: int, day: int) -> int:
+    """
+    Срок операции в месяце, следующем за месяцем ts.
+
+    :param ts: Текущий срок
+    :type ts: int
+    :param day: День месяца из правила
+    :type day: int
+    :rtype: int
+    """
+    current = date.fromtimestamp(ts)
+    year, month = divmod(current.year * 12 + current.month, 12)
+    return occurrence(year, month + 1, day)
+
+
+class Recurring:
+    """
+    Ежемесячные операции пользователей: зарплата, аренда, подписки.
+
+    Сроки правил лежат в куче, поэтому due стоит O(k log n) для
+    k наступивших сроков, а не проход по всем правилам. Сроки,
+    пропущенные, пока бот не работал, выдаются все сразу.
+    :ivar path: Путь к файлу правил
+    :type path: str
+    :ivar rules: Правила: user_id -> список правил
+    :type rules: dict
+    :ivar seq: Последний выданный ID правила
+    :type seq: int
+    :ivar dirty: Есть ли несохраненные сдвиги сроков
+    :type dirty: bool
+    """
+
+    def __init__(self, path: str = "recurring.json"):
+        """
+        Загружает правила из файла, если он есть.
+
+        :param path: Путь к файлу правил
+        :type path: str
+        """
+        self.path = path
+        self.load()
+
+    def load(self):
+        """
+        Загружает правила из файла, отбрасывая несохраненные изменения.
+        """
+        self.rules = {}
+        self.seq = 0
+        self.dirty = False
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.rules = data.get("rules", {})
+            self.seq = data.get("seq", 0)
+        self._rebuild()
+
+    def save(self):
+        """
+        Атомарно сохраняет правила.
+
+        :raises OSError: При проблемах с записью
+        """
+        payload = {"seq": self.seq, "rules": self.rules}
+        write_atomic(self.path, json.dumps(
+            payload, ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8"))
+        self.dirty = False
+
+    def get(self, user_id: str) -> list:
+        """
+        Возвращает правила пользователя.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :rtype: list
+        """
+        return self.rules.get(user_id, [])
+
+    def add(self, user_id: str, kind: str, category: str, amount: float,
+            day: int, now: float = None, save: bool = True) -> dict:
+        """
+        Добавляет правило. Первая операция - в ближайший такой день
+        после сегодняшнего.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param kind: "income" или "expense"
+        :type kind: str
+        :param category: Категория
+        :type category: str
+        :param amount: Сумма в рублях
+        :type amount: float
+        :param day: День месяца, 1-31
+        :type day: int
+        :param now: Текущее время (для тестов и замеров)
+        :type now: float
+        :param save: Сохранить файл сразу
+        :type save: bool
+        :return: Новое правило
+        :rtype: dict
+        :raises ValueError: Если тип, сумма или день некорректны
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Неизвестный тип операции: {kind}")
+        if not math.isfinite(amount) or amount <= 0:
+            raise ValueError("Сумма должна быть положительной")
+        if not 1 <= day <= 31:
+            raise ValueError("День месяца должен быть от 1 до 31")
+        today = date.fromtimestamp(now) if now is not None else date.today()
+        ts = occurrence(today.year, today.month, day)
+        if date.fromtimestamp(ts) <= today:
+            ts = following(ts, day)
+        self.seq += 1
+        rule = {"id": self.seq, "type": kind, "amount": amount,
+                "category": category, "day": day, "next": ts}
+        self.rules.setdefault(user_id, []).append(rule)
+        self._push(user_id, rule)
+        if save:
+            self.save()
+        return rule
+
+    def delete(self, user_id: str, number: int) -> dict:
+        """
+        Удаляет правило по номеру в списке пользователя.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param number: Номер правила, начиная с 1
+        :type number: int
+        :return: Удаленное правило
+        :rtype: dict
+        :raises ValueError: Если правила с таким номером нет
+        """
+        rules = self.rules.get(user_id, [])
+        if not 1 <= number <= len(rules):
+            raise ValueError(f"Нет правила с номером {number}")
+        rule = rules.pop(number - 1)
+        if not rules:
+            del self.rules[user_id]
+        self._index.pop(rule["id"], None)
+        self.save()
+        return rule
+
+    def due(self, now: float) -> dict:
+        """
+        Выдает операции всех наступивших сроков и сдвигает сроки.
+
+        Сдвиги остаются в памяти: их сохраняет save после того,
+        как операции записаны в хранилище. Откатывать их при ошибке
+        записи нельзя - операции уже в очереди хранилища, и
+        следующий проход добавил бы их второй раз.
+
+        :param now: Текущее время
+        :type now: float
+        :return: user_id -> список новых записей
+        :rtype: dict
+        """
+        batch = {}
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            ts, rule_id, user_id = heapq.heappop(heap)
+            rule = self._index.get(rule_id)
+            # удаленные и перенесенные правила остаются в куче до срока
+            if rule is None or rule["next"] != ts:
+                continue
+            records = batch.setdefault(user_id, [])
+            while rule["next"] <= now:
+                records.append({"type": rule["type"],
+                                "amount": rule["amount"],
+                                "category": rule["category"],
+                                "ts": rule["next"]})
+                rule["next"] = following(rule["next"], rule["day"])
+            heapq.heappush(heap, (rule["next"], rule_id, user_id))
+        if batch:
+            self.dirty = True
+        return batch
+
+    def pop(self, user_id: str) -> list:
+        """
+        Удаляет и возвращает правила пользователя
+        (для переноса между узлами кластера). Файл не сохраняется.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :rtype: list
+        """
+        rules = self.rules.pop(user_id, [])
+        for rule in rules:
+            self._index.pop(rule["id"], None)
+        return rules
+
+    def put(self, user_id: str, rules: list):
+        """
+        Записывает правила пользователя, полученные от pop,
+        вместо имеющихся у него на этом узле.
+
+        ID правил выдаются заново, чтобы не совпасть с правилами узла.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param rules: Список правил
+        :type rules: list
+        """
+        if not rules:
+            return
+        self.pop(user_id)
+        for rule in rules:
+            self.seq += 1
+            rule = dict(rule, id=self.seq)
+            self.rules.setdefault(user_id, []).append(rule)
+            self._push(user_id, rule)
+        self.save()
+
+    def _push(self, user_id: str, rule: dict):
+        self._index[rule["id"]] = rule
+        heapq.heappush(self._heap, (rule["next"], rule["id"], user_id))
+
+    def _rebuild(self):
+        self._index = {}
+        self._heap = []
+        for user_id, rules in self.rules.items():
+            for rule in rules:
+                self._index[rule["id"]] = rule
+                self._heap.append((rule["next"], rule["id"], user_id))
+        heapq.heapify(self._heap)
@@ -0,0 +1,260 @@
+"""
+Двоичный формат снимка данных пользователей.
+
+Файл состоит из заголовка и полезной нагрузки::
+
+    заголовок (36 байт, little-endian)
+        magic "FFSN", версия u16, сжатие u16, seq u64,
+        длина нагрузки до сжатия u64, длина в файле u64, CRC32 u32
+    нагрузка (после распаковки)
+        число записей u64, пользователей u32, категорий u32
+        суммы float64[N], метки времени int64[N] (-1 - без метки),
+        коды категорий uint16[N], типы uint8[N], целая ли сумма uint8[N]
+        длины ID пользователей uint16[U], число записей uint64[U],
+        длины категорий uint16[C], затем ID и категории в UTF-8 подряд
+
+Записи пользователей идут подряд в порядке таблицы пользователей,
+поэтому столбцы разбираются numpy.frombuffer без цикла по байтам.
+Любое расхождение длины, контрольной суммы или структуры
+приводит к SnapshotError, а не к пустым данным.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b"FFSN"
+VERSION = 1
+HEADER = struct.Struct("<4sHHQQQI")
+COUNTS = struct.Struct("<QII")
+
+CODECS = {None: 0, "zlib": 1, "zstd": 2}
+TYPES = ("income", "expense")
+TYPE_CODES = {name: code for code, name in enumerate(TYPES)}
+FIELDS = {"type", "amount", "category", "ts"}
+
+# (столбец, тип numpy) в порядке записи в файл
+COLUMNS = (
+    ("amounts", np.float64),
+    ("stamps", np.int64),
+    ("cats", np.uint16),
+    ("kinds", np.uint8),
+    ("ints", np.uint8),
+)
+
+
+class SnapshotError(ValueError):
+    """Снимок поврежден или записан в неизвестном формате"""
+
+
+def is_snapshot(head: bytes) -> bool:
+    """
+    Проверяет, начинаются ли байты с сигнатуры двоичного снимка.
+
+    :param head: Первые байты файла
+    :type head: bytes
+    :rtype: bool
+    """
+    return head[:len(MAGIC)] == MAGIC
+
+
+def dumps(data: dict, seq: int = 0, compression: str = None,
+          level: int = None) -> bytes:
+    """
+    Упаковывает данные пользователей в двоичный снимок.
+
+    :param data: user_id -> список записей
+    :type data: dict
+    :param seq: Номер последней записи журнала, учтенной в снимке
+    :type seq: int
+    :param compression: None, "zlib" или "zstd"
+    :type compression: str
+    :param level: Уровень сжатия, по умолчанию 1 для zlib и 3 для zstd
+    :type level: int
+    :rtype: bytes
+    :raises ValueError: Если запись нельзя упаковать без потерь
+        или сжатие недоступно
+    """
+    codec = codec_id(compression)
+    flat = [record for records in data.values() for record in records]
+    counts = [len(records) for records in data.values()]
+    categories = {}
+    try:
+        for record in flat:
+            if len(record) != 3 + ("ts" in record):
+                raise KeyError(next(iter(record.keys() - FIELDS), "ts"))
+            if type(record["amount"]) not in (int, float):
+                raise TypeError(f"сумма {record['amount']!r}")
+        amounts = np.array([r["amount"] for r in flat], dtype=np.float64)
+        stamps = np.array([r.get("ts", -1) for r in flat], dtype=np.int64)
+        cats = np.array([
+            categories.setdefault(r["category"], len(categories))
+            for r in flat
+        ], dtype=np.uint16)
+        kinds = np.array([TYPE_CODES[r["type"]] for r in flat],
+                         dtype=np.uint8)
+        ints = np.array([isinstance(r["amount"], int) for r in flat],
+                        dtype=np.uint8)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Запись нельзя упаковать без потерь: {e}") from e
+
+    users = [user_id.encode("utf-8") for user_id in data]
+    names = [name.encode("utf-8") for name in categories]
+    raw = b"".join([
+        COUNTS.pack(len(flat), len(users), len(names)),
+        amounts.tobytes(), stamps.tobytes(), cats.tobytes(),
+        kinds.tobytes(), ints.tobytes(),
+        np.array([len(u) for u in users], dtype=np.uint16).tobytes(),
+        np.array(counts, dtype=np.uint64).tobytes(),
+        np.array([len(c) for c in names], dtype=np.uint16).tobytes(),
+        b"".join(users), b"".join(names),
+    ])
+    stored = _compress(raw, codec, level)
+    header = HEADER.pack(MAGIC, VERSION, codec, seq, len(raw), len(stored),
+                         zlib.crc32(stored))
+    return header + stored
+
+
+def loads(payload: bytes):
+    """
+    Разбирает двоичный снимок.
+
+    :param payload: Содержимое файла
+    :type payload: bytes
+    :return: Пара (user_id -> список записей, seq)
+    :rtype: tuple
+    :raises SnapshotError: Если снимок поврежден
+    """
+    if len(payload) < HEADER.size or not is_snapshot(payload):
+        raise SnapshotError("Нет заголовка снимка")
+    (_, version, codec, seq, raw_len, stored_len,
+     crc) = HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise SnapshotError(f"Неизвестная версия снимка: {version}")
+    stored = memoryview(payload)[HEADER.size:]
+    if len(stored) != stored_len:
+        raise SnapshotError(
+            f"Снимок обрезан: {len(stored)} байт вместо {stored_len}")
+    if zlib.crc32(stored) != crc:
+        raise SnapshotError("Контрольная сумма снимка не совпадает")
+    raw = _decompress(stored, codec, raw_len)
+
+    try:
+        return unpack(raw), seq
+    except (ValueError, IndexError, UnicodeDecodeError, struct.error) as e:
+        raise SnapshotError(f"Снимок поврежден: {e}") from e
+
+
+def unpack(raw: bytes) -> dict:
+    """
+    Восстанавливает записи из распакованной нагрузки.
+
+    :param raw: Нагрузка снимка после распаковки
+    :type raw: bytes
+    :rtype: dict
+    :raises ValueError: Если длины частей не сходятся
+    """
+    n, user_count, cat_count = COUNTS.unpack_from(raw)
+    pos = COUNTS.size
+    columns = {}
+    for name, dtype in COLUMNS:
+        columns[name] = np.frombuffer(raw, dtype=dtype, count=n, offset=pos)
+        pos += n * np.dtype(dtype).itemsize
+    user_lens = np.frombuffer(raw, np.uint16, user_count, pos).tolist()
+    pos += 2 * user_count
+    counts = np.frombuffer(raw, np.uint64, user_count, pos).tolist()
+    pos += 8 * user_count
+    cat_lens = np.frombuffer(raw, np.uint16, cat_count, pos).tolist()
+    pos += 2 * cat_count
+    users = []
+    for size in user_lens:
+        users.append(raw[pos:pos + size].decode("utf-8"))
+        pos += size
+    names = []
+    for size in cat_lens:
+        names.append(raw[pos:pos + size].decode("utf-8"))
+        pos += size
+    if pos != len(raw) or sum(counts) != n:
+        raise ValueError("длины частей не сходятся")
+    if n and (int(columns["cats"].max()) >= cat_count
+              or int(columns["kinds"].max()) >= len(TYPES)):
+        raise ValueError("неизвестный код категории или типа")
+
+    records = []
+    for amount, ts, cat, kind, is_int in zip(
+        columns["amounts"].tolist(), columns["stamps"].tolist(),
+        columns["cats"].tolist(), columns["kinds"].tolist(),
+        columns["ints"].tolist()
+    ):
+        record = {
+            "type": TYPES[kind],
+            "amount": int(amount) if is_int else amount,
+            "category": names[cat]
+        }
+        if ts >= 0:
+            record["ts"] = ts
+        records.append(record)
+
+    data = {}
+    start = 0
+    for user_id, count in zip(users, counts):
+        data[user_id] = records[start:start + count]
+        start += count
+    return data
+
+
+def codec_id(compression: str) -> int:
+    """
+    Возвращает код сжатия для заголовка.
+
+    :param compression: None, "zlib" или "zstd"
+    :type compression: str
+    :rtype: int
+    :raises ValueError: Если сжатие неизвестно или zstandard
+        не установлен
+    """
+    if compression not in CODECS:
+        raise ValueError(f"Неизвестное сжатие: {compression}")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("Для сжатия zstd нужен пакет zstandard")
+    return CODECS[compression]
+
+
+def _compress(raw: bytes, codec: int, level: int = None) -> bytes:
+    if codec == CODECS["zlib"]:
+        return zlib.compress(raw, 1 if level is None else level)
+    if codec == CODECS["zstd"]:
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level).compress(raw)
+    return raw
+
+
+def _decompress(stored, codec: int, raw_len: int) -> bytes:
+    if codec == CODECS["zstd"] and zstandard is None:
+        raise SnapshotError("Снимок сжат zstd, а пакет zstandard "
+                            "не установлен")
+    try:
+        if codec == CODECS["zlib"]:
+            raw = zlib.decompress(stored)
+        elif codec == CODECS["zstd"]:
+            raw = zstandard.ZstdDecompressor().decompress(
+                stored, max_output_size=raw_len)
+        elif codec == CODECS[None]:
+            raw = bytes(stored)
+        else:
+            raise SnapshotError(f"Неизвестное сжатие: {codec}")
+    except SnapshotError:
+        raise
+    except Exception as e:
+        # zlib.error, zstandard.ZstdError и нехватка памяти на мусорной длине
+        raise SnapshotError(f"Не удалось распаковать снимок: {e}") from e
+    if len(raw) != raw_len:
+        raise SnapshotError(
+            f"Длина нагрузки {len(raw)} байт вместо {raw_len}")
+    return raw
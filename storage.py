@@ -0,0 +1,1241 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+import metrics
+import snapshot
+from ledger import Ledger
+from summary import PeriodIndex, Summary
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path: str, payload):
+    """
+    Атомарно записывает байты в файл (временный файл + rename).
+
+    При сбое во время записи на диске остается либо старая,
+    либо новая версия файла, но не обрезанная смесь.
+
+    :param path: Путь к файлу
+    :type path: str
+    :param payload: Содержимое файла или итератор его частей
+    :type payload: bytes
+    """
+    if isinstance(payload, bytes):
+        payload = (payload,)
+    size = 0
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        for chunk in payload:
+            f.write(chunk)
+            size += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    metrics.BYTES_PERSISTED.inc(size)
+
+
+# Сколько записей кодируется одним вызовом json.dumps при сжатии
+# журнала: C-кодировщик держит GIL весь вызов, и без разбиения
+# цикл событий стоял бы все время записи снимка
+SNAPSHOT_CHUNK = 1000
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_json_items(text: str):
+    """
+    Перебирает пары ключ-значение JSON объекта верхнего уровня.
+
+    Значения разбираются по одному, поэтому фоновый поток загрузки
+    отпускает GIL между пользователями, а не держит его на время
+    разбора всего снимка, как json.loads.
+
+    :param text: Текст JSON объекта
+    :type text: str
+    :return: Пары (ключ, значение)
+    :rtype: iterable
+    :raises ValueError: При ошибке в JSON
+    """
+    decoder = json.JSONDecoder()
+    pos = _WHITESPACE.match(text, 0).end()
+    if text[pos:pos + 1] != "{":
+        raise ValueError("Ожидался JSON объект")
+    pos = _WHITESPACE.match(text, pos + 1).end()
+    if text[pos:pos + 1] == "}":
+        return
+    while True:
+        key, pos = decoder.raw_decode(text, pos)
+        if not isinstance(key, str):
+            raise ValueError(f"Ключ должен быть строкой: {pos}")
+        pos = _WHITESPACE.match(text, pos).end()
+        if text[pos:pos + 1] != ":":
+            raise ValueError(f"Ожидалось ':' в позиции {pos}")
+        pos = _WHITESPACE.match(text, pos + 1).end()
+        value, pos = decoder.raw_decode(text, pos)
+        yield key, value
+        pos = _WHITESPACE.match(text, pos).end()
+        char = text[pos:pos + 1]
+        pos = _WHITESPACE.match(text, pos + 1).end()
+        if char == "}":
+            return
+        if char != ",":
+            raise ValueError(f"Ожидалось ',' в позиции {pos}")
+
+
+class Storage:
+    """
+    Базовый интерфейс хранилища финансовых данных.
+
+    FinanceBot добавляет записи через append и получает сводки
+    через summary, не зная, как устроено хранение. Сводки
+    пользователей кэшируются и обновляются при каждой записи.
+
+    В режиме durability="strict" каждая запись сразу сохраняется
+    на диск. В режиме "batched" append только ставит запись
+    в очередь, а корутина flusher сохраняет очередь одной пачкой
+    раз в flush_interval секунд или при flush_records записях.
+
+    load_background загружает данные в фоновом потоке: пока загрузка
+    идет, новые записи откладываются и добавляются после нее,
+    а чтение сводок ждет окончания загрузки.
+    :ivar durability: Режим сохранения: "strict" или "batched"
+    :type durability: str
+    :ivar ready: Установлено, когда данные загружены
+    :type ready: threading.Event
+    :ivar load_error: Ошибка фоновой загрузки или None
+    :type load_error: Exception
+    :ivar pending: Записи, еще не сохраненные на диск
+    :type pending: list
+    :ivar flush_stats: Количество сохранений, размеры пачек и задержки
+    :type flush_stats: dict
+    """
+
+    def __init__(self, durability: str = "strict",
+                 flush_interval: float = 1.0, flush_records: int = 100):
+        """
+        Настраивает режим сохранения.
+
+        :param durability: Режим сохранения: "strict" или "batched"
+        :type durability: str
+        :param flush_interval: Максимальная задержка сохранения, секунды
+        :type flush_interval: float
+        :param flush_records: Размер очереди, при котором сохранение
+            запускается досрочно
+        :type flush_records: int
+        :raises ValueError: При неизвестном режиме сохранения
+        """
+        if durability not in ("strict", "batched"):
+            raise ValueError(f"Неизвестный режим сохранения: {durability}")
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.pending = []
+        self.flush_stats = {
+            "flushes": 0,
+            "records": 0,
+            "max_batch": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+        self._summ = {}
+        self._periods = {}
+        self._wake = None
+        self._loop = None
+        # очередь меняют цикл событий и поток фоновой загрузки
+        self._flush_lock = threading.RLock()
+        self.ready = threading.Event()
+        self.ready.set()
+        self.load_error = None
+        self._early = []
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """
+        Загружает данные, которые хранилище держит в памяти.
+
+        :return: Словарь с данными пользователей
+        :rtype: dict
+        """
+        return {}
+
+    def save(self, data: dict = None):
+        """
+        Сохраняет все накопленные изменения.
+
+        :param data: Новые данные, заменяющие текущие
+        :type data: dict
+        """
+
+    def load_background(self):
+        """
+        Запускает load в фоновом потоке и сразу возвращает управление.
+
+        :return: Поток загрузки
+        :rtype: threading.Thread
+        """
+        self.ready.clear()
+        self.load_error = None
+        thread = threading.Thread(target=self._load_in_background,
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def wait_loaded(self, timeout: float = None) -> bool:
+        """
+        Ждет окончания фоновой загрузки.
+
+        :param timeout: Максимальное время ожидания в секундах
+        :type timeout: float
+        :return: Загружены ли данные
+        :rtype: bool
+        :raises OSError: Если фоновая загрузка завершилась ошибкой
+        """
+        loaded = self.ready.wait(timeout)
+        if self.load_error is not None:
+            raise OSError(f"Не удалось загрузить данные: {self.load_error}")
+        return loaded
+
+    async def loaded(self):
+        """
+        Ждет окончания фоновой загрузки, не блокируя цикл событий.
+
+        :raises OSError: Если фоновая загрузка завершилась ошибкой
+        """
+        if not self.ready.is_set():
+            await asyncio.to_thread(self.ready.wait)
+        self.wait_loaded()
+
+    def append(self, user_id: str, record: dict):
+        """
+        Добавляет запись пользователя и обновляет его сводку.
+
+        Во время фоновой загрузки запись откладывается до ее окончания.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param record: Запись о доходе или расходе
+        :type record: dict
+        """
+        self.append_many(user_id, (record,))
+
+    def append_many(self, user_id: str, records):
+        """
+        Добавляет пачку записей пользователя.
+
+        В режиме "strict" вся пачка сохраняется одним flush,
+        а не отдельной записью на диск для каждой операции.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param records: Записи о доходах и расходах
+        :type records: iterable
+        :raises OSError: Если фоновая загрузка завершилась ошибкой
+        """
+        self.append_batch({user_id: records})
+
+    def append_batch(self, batch: dict):
+        """
+        Добавляет записи нескольких пользователей.
+
+        Сводки каждого пользователя обновляются по его записям,
+        а в режиме "strict" вся пачка сохраняется одним flush.
+
+        :param batch: user_id -> записи о доходах и расходах
+        :type batch: dict
+        :raises OSError: Если фоновая загрузка завершилась ошибкой
+        """
+        if not self.ready.is_set():
+            with self._load_lock:
+                if not self.ready.is_set():
+                    self._early.extend(
+                        (user_id, r)
+                        for user_id, records in batch.items()
+                        for r in records
+                    )
+                    return
+        # после неудачной загрузки сохранение перезаписало бы
+        # нечитаемый снимок почти пустыми данными
+        self.wait_loaded()
+        for user_id, records in batch.items():
+            for record in records:
+                self._add(user_id, record)
+        self._commit()
+
+    def _add(self, user_id: str, record: dict):
+        self._stage(user_id, record)
+        self.pending.append((user_id, record))
+        summ = self._summ.get(user_id)
+        if summ is not None:
+            summ.add(record)
+        index = self._periods.get(user_id)
+        if index is not None:
+            index.add(record)
+
+    def _commit(self):
+        if self.durability == "strict":
+            self.flush()
+        elif len(self.pending) >= self.flush_records:
+            self._wake_flusher()
+
+    def _wake_flusher(self):
+        wake, loop = self._wake, self._loop
+        if wake is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            wake.set()
+            return
+        # asyncio.Event можно трогать только из потока его цикла
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            pass
+
+    def flush(self):
+        """
+        Сохраняет очередь записей одной пачкой.
+
+        Если запись не удалась, пачка возвращается в начало очереди
+        и сохраняется следующим flush.
+
+        :raises OSError: При проблемах с записью
+        """
+        with self._flush_lock:
+            if not self.pending:
+                return
+            batch = self.pending
+            self.pending = []
+            start = time.perf_counter()
+            try:
+                self._write_batch(batch)
+            except Exception:
+                self.pending = batch + self.pending
+                raise
+            latency = time.perf_counter() - start
+
+            stats = self.flush_stats
+            stats["flushes"] += 1
+            stats["records"] += len(batch)
+            stats["max_batch"] = max(stats["max_batch"], len(batch))
+            stats["latency_total"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+        metrics.RECORDS_WRITTEN.inc(len(batch))
+        metrics.FLUSH_SECONDS.observe(latency)
+        metrics.FLUSH_BATCH.observe(len(batch))
+
+    async def flusher(self):
+        """
+        Фоновая задача режима "batched": периодически вызывает flush.
+
+        Работает до отмены; при отмене сохраняет остаток очереди.
+        Ошибка записи не останавливает задачу: она записывается
+        в лог, а пачка сохраняется на следующем проходе.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        try:
+            while True:
+                # wait_for в Python 3.11 теряет отмену, пришедшую вместе
+                # с пробуждением, и задача не останавливалась бы
+                wake = asyncio.ensure_future(self._wake.wait())
+                try:
+                    await asyncio.wait((wake,), timeout=self.flush_interval)
+                finally:
+                    wake.cancel()
+                self._wake.clear()
+                try:
+                    self.flush()
+                except OSError:
+                    logger.exception("Не удалось сохранить %d записей",
+                                     len(self.pending))
+        finally:
+            self._wake = None
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Не удалось сохранить %d записей",
+                                 len(self.pending))
+
+    def has_user(self, user_id: str) -> bool:
+        """
+        Проверяет, есть ли у пользователя операции.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def summary(self, user_id: str):
+        """
+        Возвращает поддерживаемую сводку пользователя.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :return: Сводка или None, если у пользователя нет операций
+        :rtype: summary.Summary
+        """
+        self.wait_loaded()
+        summ = self._summ.get(user_id)
+        if summ is None:
+            if not self.has_user(user_id):
+                return None
+            summ = self._summ[user_id] = self.compute_summary(user_id)
+        return summ
+
+    def period_summary(self, user_id: str, start, end):
+        """
+        Возвращает сводку пользователя за период по индексу дней
+        и месяцев. Индекс строится при первом запросе.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param start: Первый день периода
+        :type start: datetime.date
+        :param end: Последний день периода
+        :type end: datetime.date
+        :return: Сводка или None, если у пользователя нет операций
+        :rtype: summary.Summary
+        """
+        index = self.period_index(user_id)
+        return index.query(start, end) if index is not None else None
+
+    def month_summary(self, user_id: str, year: int, month: int):
+        """
+        Возвращает поддерживаемую сводку пользователя за месяц.
+
+        После построения индекса стоит O(1): сводка месяца
+        обновляется при каждой новой записи.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :param year: Год
+        :type year: int
+        :param month: Месяц
+        :type month: int
+        :return: Сводка или None, если операций в этом месяце нет
+        :rtype: summary.Summary
+        """
+        index = self.period_index(user_id)
+        return index.months.get((year, month)) if index is not None else None
+
+    def period_index(self, user_id: str):
+        """
+        Возвращает индекс дней и месяцев пользователя, при первом
+        обращении строя его проходом по истории.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :return: Индекс или None, если у пользователя нет операций
+        :rtype: summary.PeriodIndex
+        """
+        self.wait_loaded()
+        index = self._periods.get(user_id)
+        if index is None:
+            if not self.has_user(user_id):
+                return None
+            index = PeriodIndex.from_records(self.records(user_id))
+            self._periods[user_id] = index
+        return index
+
+    def users(self):
+        """
+        Возвращает ID всех пользователей, у которых есть операции.
+
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def remove(self, user_id: str):
+        """
+        Удаляет все операции пользователя и сохраняет изменение.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :raises OSError: При проблемах с записью
+        """
+        raise NotImplementedError
+
+    def records(self, user_id: str):
+        """
+        Перебирает записи пользователя в порядке добавления.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :return: Записи в формате data.json
+        :rtype: iterable
+        """
+        raise NotImplementedError
+
+    def compute_summary(self, user_id: str) -> Summary:
+        """
+        Считает сводку пользователя заново по всем его записям.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :rtype: summary.Summary
+        """
+        raise NotImplementedError
+
+    def check_summary(self):
+        """
+        Сверяет кэшированные сводки с полным пересчетом.
+
+        :return: ID пользователей, у которых сводка разошлась
+        :rtype: list
+        """
+        return [user_id for user_id, summ in self._summ.items()
+                if not summ.matches(self.compute_summary(user_id))]
+
+    def close(self):
+        """
+        Сохраняет очередь и освобождает ресурсы хранилища.
+        """
+        self.flush()
+
+    def _load_in_background(self):
+        try:
+            self.load()
+        except Exception as exc:
+            self.load_error = exc
+        finally:
+            with self._load_lock:
+                early, self._early = self._early, []
+                try:
+                    if self.load_error is None:
+                        # flush цикла событий не должен забрать
+                        # очередь посреди переноса
+                        with self._flush_lock:
+                            for user_id, record in early:
+                                self._add(user_id, record)
+                        self._commit()
+                finally:
+                    self.ready.set()
+
+    def _forget(self):
+        self._summ = {}
+        self._periods = {}
+
+    def _stage(self, user_id: str, record: dict):
+        pass
+
+    def _write_batch(self, batch: list):
+        raise NotImplementedError
+
+
+class JsonStorage(Storage):
+    """
+    Хранилище финансовых данных пользователей в JSON файле.
+
+    В обычном режиме каждое изменение переписывает файл целиком.
+    В режиме журнала новая запись дописывается одной строкой
+    в ``<path>.journal``, а снимок пересобирается в фоновом потоке,
+    когда журнал превышает заданный размер. Снимок пишется в JSON
+    или, при fmt="binary", в двоичном формате snapshot; при загрузке
+    формат определяется по содержимому файла.
+    :ivar path: Путь к файлу снимка
+    :type path: str
+    :ivar fmt: Формат снимка: "json" или "binary"
+    :type fmt: str
+    :ivar compression: Сжатие двоичного снимка: None, "zlib" или "zstd"
+    :type compression: str
+    :ivar data: Данные всех пользователей
+    :type data: dict
+    :ivar journal: Включен ли режим журнала
+    :type journal: bool
+    :ivar seq: Номер последней записи журнала
+    :type seq: int
+    """
+
+    def __init__(self, path: str = "data.json", journal: bool = False,
+                 journal_limit: int = 1 << 20, fsync: bool = True,
+                 fmt: str = "json", compression: str = None, **kwargs):
+        """
+        Создает хранилище. Данные читаются методом load.
+
+        :param path: Путь к файлу снимка
+        :type path: str
+        :param journal: Дописывать записи в журнал вместо перезаписи
+        :type journal: bool
+        :param journal_limit: Размер журнала в байтах, после которого
+            запускается фоновое сжатие
+        :type journal_limit: int
+        :param fsync: Сбрасывать журнал на диск после каждого сохранения
+        :type fsync: bool
+        :param fmt: Формат снимка: "json" или "binary"
+        :type fmt: str
+        :param compression: Сжатие двоичного снимка: None, "zlib" или "zstd"
+        :type compression: str
+        :param kwargs: Параметры режима сохранения, см. Storage
+        :raises ValueError: Если формат или сжатие неизвестны
+        """
+        super().__init__(**kwargs)
+        if fmt not in ("json", "binary"):
+            raise ValueError(f"Неизвестный формат снимка: {fmt}")
+        if compression is not None and fmt != "binary":
+            raise ValueError("Сжатие поддерживается только для fmt='binary'")
+        snapshot.codec_id(compression)
+        self.path = path
+        self.fmt = fmt
+        self.compression = compression
+        self.journal = journal
+        self.journal_path = f"{path}.journal"
+        self.journal_limit = journal_limit
+        self.fsync = fsync
+        self.data = {}
+        self.seq = 0
+        self._jf = None
+        self._compactor = None
+
+    def load(self):
+        """
+        Загружает снимок и, в режиме журнала, проигрывает журнал.
+
+        Сводки всех пользователей строятся один раз после загрузки.
+        Оборванная последняя строка журнала отрезается, любая другая
+        нечитаемая строка считается повреждением.
+
+        :return: Словарь с данными пользователей
+        :rtype: dict
+        :raises snapshot.SnapshotError: Если снимок или журнал поврежден
+        """
+        self.data, self.seq = self._read_snapshot()
+        if self.journal:
+            for name in self._segments() + [self.journal_path]:
+                self._replay(name)
+        self.rebuild()
+        return self.data
+
+    def save(self, data: dict = None):
+        """
+        Полностью сохраняет данные на диск.
+
+        В режиме журнала выполняет синхронное сжатие.
+
+        :param data: Новые данные, заменяющие текущие
+        :type data: dict
+        :raises OSError: При проблемах с записью в файл
+        """
+        if data is not None and data is not self.data:
+            self.data = data
+            self.rebuild()
+        # полный снимок покрывает все записи из очереди
+        self.pending = []
+        try:
+            if self.journal:
+                self.compact(wait=True)
+            else:
+                write_atomic(self.path, self._dump(self.data, 0))
+        except Exception:
+            raise OSError
+
+    def rebuild(self):
+        """
+        Пересчитывает сводки всех пользователей по self.data.
+        """
+        self._summ = {user_id: Summary.from_records(records)
+                      for user_id, records in self.data.items()}
+        self._periods = {}
+
+    def _stage(self, user_id: str, record: dict):
+        self.data.setdefault(user_id, []).append(record)
+
+    def _write_batch(self, batch: list):
+        if not self.journal:
+            self.save()
+            return
+
+        seq = self.seq
+        lines = []
+        for user_id, record in batch:
+            seq += 1
+            lines.append(json.dumps(
+                {"seq": seq, "user": user_id, "rec": record},
+                ensure_ascii=False
+            ) + "\n")
+        if self._jf is None:
+            self._jf = open(self.journal_path, "ab")
+        payload = "".join(lines).encode("utf-8")
+        start = self._jf.tell()
+        try:
+            self._jf.write(payload)
+            self._jf.flush()
+            if self.fsync:
+                os.fsync(self._jf.fileno())
+        except OSError:
+            self._truncate_journal(start)
+            raise
+        self.seq = seq
+        metrics.BYTES_PERSISTED.inc(len(payload))
+        if self._jf.tell() >= self.journal_limit:
+            # пачка уже в журнале: ошибка сжатия не должна вернуть ее
+            # в очередь, иначе при повторе записи задвоятся
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("Не удалось сжать журнал %s",
+                                 self.journal_path)
+
+    def _truncate_journal(self, size: int):
+        # недописанная пачка отрезается: при повторе она оказалась бы
+        # оборванной строкой посреди журнала
+        try:
+            self._jf.close()
+        except OSError:
+            pass
+        self._jf = None
+        try:
+            os.truncate(self.journal_path, size)
+        except OSError:
+            logger.exception("Не удалось обрезать журнал %s",
+                             self.journal_path)
+
+    def has_user(self, user_id: str) -> bool:
+        return user_id in self.data
+
+    def users(self):
+        return list(self.data)
+
+    def remove(self, user_id: str):
+        self.flush()
+        self.data.pop(user_id, None)
+        self._summ.pop(user_id, None)
+        self._periods.pop(user_id, None)
+        # в режиме журнала снимок заменяет журнал, иначе при загрузке
+        # записи удаленного пользователя проигрались бы снова
+        self.save()
+
+    def records(self, user_id: str):
+        return self.data.get(user_id, [])
+
+    def compute_summary(self, user_id: str) -> Summary:
+        return Summary.from_records(self.data.get(user_id, []))
+
+    def compact(self, wait: bool = False):
+        """
+        Переносит журнал в новый снимок.
+
+        Текущий журнал переименовывается в сегмент ``<journal>.<seq>``,
+        копия данных записывается в снимок атомарно, после чего
+        покрытые снимком сегменты удаляются. Если процесс упадет
+        посередине, load проигнорирует уже учтенные записи по seq.
+
+        :param wait: Дождаться окончания записи снимка
+        :type wait: bool
+        """
+        if self._compactor is not None and self._compactor.is_alive():
+            if not wait:
+                return
+            self._compactor.join()
+
+        if self._jf is not None:
+            self._jf.close()
+            self._jf = None
+        if os.path.exists(self.journal_path):
+            os.replace(self.journal_path, f"{self.journal_path}.{self.seq}")
+
+        snapshot = {user: list(recs) for user, recs in self.data.items()}
+        self._compactor = threading.Thread(
+            target=self._write_snapshot,
+            args=(snapshot, self.seq),
+            daemon=True
+        )
+        self._compactor.start()
+        if wait:
+            self._compactor.join()
+
+    def close(self):
+        """
+        Сохраняет очередь, дожидается фонового сжатия и закрывает журнал.
+        """
+        self.flush()
+        if self._compactor is not None:
+            self._compactor.join()
+        if self._jf is not None:
+            self._jf.close()
+            self._jf = None
+
+    def _write_snapshot(self, data: dict, seq: int):
+        write_atomic(self.path, self._dump(data, seq))
+        for name in self._segments():
+            if int(name.rsplit(".", 1)[1]) <= seq:
+                os.remove(name)
+
+    def _dump(self, data: dict, seq: int):
+        if self.fmt == "binary":
+            return snapshot.dumps(data, seq, self.compression)
+        if not self.journal:
+            return json.dumps(data, ensure_ascii=False,
+                              indent=2).encode("utf-8")
+        return self._iter_json(data, seq)
+
+    @staticmethod
+    def _iter_json(data: dict, seq: int):
+        yield b'{"_seq":%d' % seq
+        for user_id, records in data.items():
+            parts = [",", json.dumps(user_id), ":["]
+            for start in range(0, len(records), SNAPSHOT_CHUNK):
+                chunk = json.dumps(records[start:start + SNAPSHOT_CHUNK],
+                                   ensure_ascii=False, separators=(",", ":"))
+                parts.append(("," if start else "") + chunk[1:-1])
+                yield "".join(parts).encode("utf-8")
+                parts = []
+            parts.append("]")
+            yield "".join(parts).encode("utf-8")
+        yield b"}"
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.path):
+            return {}, 0
+        with open(self.path, "rb") as f:
+            payload = f.read()
+        if snapshot.is_snapshot(payload):
+            return snapshot.loads(payload)
+        try:
+            data = dict(iter_json_items(payload.decode("utf-8")))
+        except ValueError as e:
+            raise snapshot.SnapshotError(
+                f"Снимок {self.path} поврежден: {e}") from e
+        return data, data.pop("_seq", 0)
+
+    def _segments(self):
+        names = glob.glob(glob.escape(self.journal_path) + ".*")
+        names = [n for n in names if n.rsplit(".", 1)[1].isdigit()]
+        return sorted(names, key=lambda n: int(n.rsplit(".", 1)[1]))
+
+    def _replay(self, name: str):
+        if not os.path.exists(name):
+            return
+        good = 0
+        with open(name, "rb") as f:
+            for number, line in enumerate(f, 1):
+                if not line.endswith(b"\n"):
+                    # запись оборвалась при сбое и не была подтверждена;
+                    # хвост отрезается, чтобы следующая запись журнала
+                    # не склеилась с ним
+                    os.truncate(name, good)
+                    break
+                try:
+                    entry = json.loads(line)
+                    seq, user_id, record = (entry["seq"], entry["user"],
+                                            entry["rec"])
+                except (ValueError, KeyError, TypeError) as e:
+                    raise snapshot.SnapshotError(
+                        f"Журнал {name} поврежден в строке {number}: {e}"
+                    ) from e
+                good += len(line)
+                if seq <= self.seq:
+                    continue
+                self.data.setdefault(user_id, []).append(record)
+                self.seq = seq
+
+
+class SqliteStorage(Storage):
+    """
+    Хранилище финансовых данных в базе SQLite.
+
+    Данные не загружаются в память целиком: записи добавляются
+    одной вставкой, а сводки считаются запросами GROUP BY
+    по индексу (user_id, type, category).
+    :ivar path: Путь к файлу базы
+    :type path: str
+    :ivar conn: Соединение с базой
+    :type conn: sqlite3.Connection
+    """
+
+    def __init__(self, path: str = "data.db", **kwargs):
+        """
+        Открывает базу и создает таблицу с индексом при необходимости.
+
+        :param path: Путь к файлу базы
+        :type path: str
+        :param kwargs: Параметры режима сохранения, см. Storage
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                type TEXT NOT NULL,
+                amount REAL NOT NULL,
+                category TEXT NOT NULL,
+                ts INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS transactions_user
+                ON transactions (user_id, type, category);
+            CREATE INDEX IF NOT EXISTS transactions_user_id
+                ON transactions (user_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        columns = [row[1] for row in
+                   self.conn.execute("PRAGMA table_info(transactions)")]
+        if "ts" not in columns:
+            self.conn.execute("ALTER TABLE transactions ADD COLUMN ts INTEGER")
+        self.conn.commit()
+
+    def save(self, data: dict = None):
+        """
+        Фиксирует изменения. Если переданы данные, заменяет ими
+        содержимое таблицы в одной транзакции.
+
+        :param data: Новые данные, заменяющие текущие
+        :type data: dict
+        """
+        if data:
+            self.pending = []
+            with self.conn:
+                self.conn.execute("DELETE FROM transactions")
+                self._insert(data)
+            self._forget()
+        self.flush()
+        self.conn.commit()
+
+    def _write_batch(self, batch: list):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO transactions "
+                "(user_id, type, amount, category, ts) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(user_id, r["type"], r["amount"], r["category"], r.get("ts"))
+                 for user_id, r in batch]
+            )
+
+    # чтение не сохраняет очередь, иначе в режиме "batched" каждый
+    # запрос баланса был бы отдельным коммитом: записи из очереди
+    # добавляются к результату запроса из памяти
+
+    def has_user(self, user_id: str) -> bool:
+        if any(uid == user_id for uid, _ in self.pending):
+            return True
+        row = self.conn.execute(
+            "SELECT 1 FROM transactions WHERE user_id = ? LIMIT 1",
+            (user_id,)
+        ).fetchone()
+        return row is not None
+
+    def users(self):
+        with self._flush_lock:
+            pending = [user_id for user_id, _ in self.pending]
+            rows = self.conn.execute(
+                "SELECT DISTINCT user_id FROM transactions"
+            ).fetchall()
+        return list(dict.fromkeys([row[0] for row in rows] + pending))
+
+    def remove(self, user_id: str):
+        self.flush()
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM transactions WHERE user_id = ?", (user_id,)
+            )
+        self._summ.pop(user_id, None)
+        self._periods.pop(user_id, None)
+
+    def records(self, user_id: str):
+        # строки, сохраненные после вызова, уже есть в копии очереди
+        with self._flush_lock:
+            last, pending = self._snapshot(user_id)
+        rows = self.conn.execute(
+            "SELECT type, amount, category, ts FROM transactions "
+            "WHERE user_id = ? AND id <= ? ORDER BY id",
+            (user_id, last)
+        )
+        return self._iter_records(rows, pending)
+
+    @staticmethod
+    def _iter_records(rows, pending: list):
+        for kind, amount, cat, ts in rows:
+            record = {"type": kind, "amount": amount, "category": cat}
+            if ts is not None:
+                record["ts"] = ts
+            yield record
+        yield from pending
+
+    def compute_summary(self, user_id: str) -> Summary:
+        summ = Summary()
+        with self._flush_lock:
+            last, pending = self._snapshot(user_id)
+            rows = self.conn.execute(
+                "SELECT type, category, SUM(amount), COUNT(*) "
+                "FROM transactions WHERE user_id = ? AND id <= ? "
+                "GROUP BY type, category ORDER BY MIN(id)",
+                (user_id, last)
+            ).fetchall()
+        for kind, cat, amount, count in rows:
+            if kind == "expense":
+                summ.exp_by_cat[cat] = amount
+                summ.expense += amount
+            else:
+                summ.inc_by_cat[cat] = amount
+                summ.income += amount
+            summ.count += count
+        for record in pending:
+            summ.add(record)
+        return summ
+
+    def _snapshot(self, user_id: str):
+        last = self.conn.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM transactions"
+        ).fetchone()[0]
+        return last, [r for uid, r in self.pending if uid == user_id]
+
+    def migrate(self, json_path: str = "data.json") -> int:
+        """
+        Однократно переносит данные из JSON файла в базу.
+
+        Повторный вызов для того же файла ничего не делает.
+
+        :param json_path: Путь к data.json
+        :type json_path: str
+        :return: Количество перенесенных записей
+        :rtype: int
+        """
+        key = f"migrated:{os.path.abspath(json_path)}"
+        done = self.conn.execute(
+            "SELECT 1 FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        if done:
+            return 0
+
+        data = JsonStorage(json_path).load()
+        with self.conn:
+            count = self._insert(data)
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                (key, str(count))
+            )
+        self._forget()
+        return count
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def _insert(self, data: dict) -> int:
+        rows = [
+            (user_id, r["type"], r["amount"], r["category"], r.get("ts"))
+            for user_id, records in data.items()
+            for r in records
+        ]
+        self.conn.executemany(
+            "INSERT INTO transactions "
+            "(user_id, type, amount, category, ts) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        return len(rows)
+
+
+class ShardedStorage(Storage):
+    """
+    Хранилище, разбитое на файлы-шарды по хэшу ID пользователя.
+
+    История пользователя читается из его шарда при первом обращении
+    и держится в LRU кэше с ограничением по числу пользователей
+    и записей. Измененная история записывается обратно в шард
+    при сохранении или при вытеснении из кэша. Поэтому время запуска
+    и память зависят от активных пользователей, а не от всех.
+    В кэше история хранится компактно, в виде ledger.Ledger.
+    :ivar directory: Каталог с файлами шардов
+    :type directory: str
+    :ivar shards: Количество шардов
+    :type shards: int
+    :ivar max_users: Максимум пользователей в кэше
+    :type max_users: int
+    :ivar max_records: Максимум записей в кэше
+    :type max_records: int
+    """
+
+    def __init__(self, directory: str = "data", shards: int = 64,
+                 max_users: int = 1000, max_records: int = 1_000_000,
+                 **kwargs):
+        """
+        Создает хранилище. Шарды читаются по мере обращения.
+
+        :param directory: Каталог с файлами шардов
+        :type directory: str
+        :param shards: Количество шардов
+        :type shards: int
+        :param max_users: Максимум пользователей в кэше
+        :type max_users: int
+        :param max_records: Максимум записей в кэше
+        :type max_records: int
+        :param kwargs: Параметры режима сохранения, см. Storage
+        """
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.shards = shards
+        self.max_users = max_users
+        self.max_records = max_records
+        self._cache = OrderedDict()
+        self._records = 0
+        self._dirty = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, data: dict = None):
+        """
+        Сохраняет измененные истории. Если переданы данные,
+        раскладывает их по шардам, заменяя прежнее содержимое.
+
+        :param data: Данные пользователей
+        :type data: dict
+        :raises OSError: При проблемах с записью в файл
+        """
+        if data:
+            self.pending = []
+            self._cache.clear()
+            self._records = 0
+            self._dirty.clear()
+            self._forget()
+            by_shard = {}
+            for user_id, records in data.items():
+                path = self.shard_path(user_id)
+                by_shard.setdefault(path, {})[user_id] = records
+            for path in self._shard_files():
+                by_shard.setdefault(path, {})
+            for path, shard in by_shard.items():
+                self._write_shard(path, shard)
+        self.flush()
+
+    def shard_path(self, user_id: str) -> str:
+        """
+        Возвращает путь к шарду пользователя.
+
+        :param user_id: ID пользователя в Telegram
+        :type user_id: str
+        :rtype: str
+        """
+        bucket = zlib.crc32(user_id.encode("utf-8")) % self.shards
+        return os.path.join(self.directory, f"shard_{bucket:03d}.json")
+
+    def has_user(self, user_id: str) -> bool:
+        return self._ledger(user_id) is not None
+
+    def records(self, user_id: str):
+        ledger = self._ledger(user_id)
+        if ledger is None:
+            return
+        # записи собираются в словари частями, а не всей историей сразу
+        for start in range(0, len(ledger), 4096):
+            yield from ledger.to_records(start, start + 4096)
+
+    def compute_summary(self, user_id: str) -> Summary:
+        ledger = self._ledger(user_id)
+        return ledger.summary() if ledger is not None else Summary()
+
+    def users(self):
+        self.flush()
+        users = set(self._cache)
+        for path in self._shard_files():
+            users.update(self._read_shard(path))
+        return sorted(users)
+
+    def remove(self, user_id: str):
+        self.flush()
+        ledger = self._cache.pop(user_id, None)
+        if ledger is not None:
+            self._records -= len(ledger)
+        self._dirty.discard(user_id)
+        self._summ.pop(user_id, None)
+        self._periods.pop(user_id, None)
+        path = self.shard_path(user_id)
+        shard = self._read_shard(path)
+        if shard.pop(user_id, None) is not None:
+            self._write_shard(path, shard)
+
+    def cached_users(self):
+        """
+        Возвращает пользователей, чьи истории сейчас в памяти.
+
+        :rtype: list
+        """
+        return list(self._cache)
+
+    def close(self):
+        self.flush()
+        self._write_back(dict(self._cache))
+
+    def _stage(self, user_id: str, record: dict):
+        self._ledger(user_id, create=True).append(record)
+        self._records += 1
+        self._dirty.add(user_id)
+        self._evict()
+
+    def _write_batch(self, batch: list):
+        users = {user_id for user_id, _ in batch}
+        self._write_back({user_id: self._cache[user_id]
+                          for user_id in users if user_id in self._cache})
+
+    def _ledger(self, user_id: str, create: bool = False):
+        ledger = self._cache.get(user_id)
+        if ledger is not None:
+            self._cache.move_to_end(user_id)
+            return ledger
+
+        records = self._read_shard(self.shard_path(user_id)).get(user_id)
+        if records is None and not create:
+            return None
+        ledger = Ledger.from_records(records or [])
+        self._cache[user_id] = ledger
+        self._records += len(ledger)
+        self._evict()
+        return ledger
+
+    def _evict(self):
+        while len(self._cache) > 1 and (
+            len(self._cache) > self.max_users
+            or self._records > self.max_records
+        ):
+            user_id, ledger = self._cache.popitem(last=False)
+            self._records -= len(ledger)
+            self._summ.pop(user_id, None)
+            self._periods.pop(user_id, None)
+            self._write_back({user_id: ledger})
+
+    def _write_back(self, ledgers: dict):
+        by_shard = {}
+        for user_id, ledger in ledgers.items():
+            if user_id in self._dirty:
+                path = self.shard_path(user_id)
+                by_shard.setdefault(path, {})[user_id] = ledger
+        for path, changed in by_shard.items():
+            shard = self._read_shard(path)
+            for user_id, ledger in changed.items():
+                shard[user_id] = ledger.to_records()
+            self._write_shard(path, shard)
+            self._dirty.difference_update(changed)
+
+    def _read_shard(self, path: str) -> dict:
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_shard(self, path: str, shard: dict):
+        try:
+            payload = json.dumps(shard, ensure_ascii=False,
+                                 separators=(",", ":"))
+            write_atomic(path, payload.encode("utf-8"))
+        except Exception:
+            raise OSError
+
+    def _shard_files(self):
+        return glob.glob(os.path.join(glob.escape(self.directory),
+                                      "shard_*.json"))
@@ -0,0 +1,183 @@
+import math
+from datetime import date
+
+
+class Summary:
+    """
+    Сводка операций пользователя: итоги и суммы по категориям.
+
+    Обновляется при каждой новой записи, поэтому баланс и статистика
+    считаются за O(число категорий), а не O(длина истории).
+    :ivar income: Общие доходы
+    :type income: float
+    :ivar expense: Общие расходы
+    :type expense: float
+    :ivar inc_by_cat: Доходы по категориям
+    :type inc_by_cat: dict
+    :ivar exp_by_cat: Расходы по категориям
+    :type exp_by_cat: dict
+    :ivar count: Количество записей
+    :type count: int
+    """
+
+    __slots__ = ("income", "expense", "inc_by_cat", "exp_by_cat", "count")
+
+    def __init__(self):
+        self.income = 0
+        self.expense = 0
+        self.inc_by_cat = {}
+        self.exp_by_cat = {}
+        self.count = 0
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Строит сводку полным проходом по записям.
+
+        :param records: Записи пользователя
+        :type records: list
+        :rtype: Summary
+        """
+        summ = cls()
+        for record in records:
+            summ.add(record)
+        return summ
+
+    def add(self, record: dict):
+        """
+        Учитывает одну новую запись.
+
+        :param record: Запись о доходе или расходе
+        :type record: dict
+        """
+        cat = record["category"]
+        amount = record["amount"]
+
+        if record["type"] == "expense":
+            self.expense += amount
+            self.exp_by_cat[cat] = self.exp_by_cat.get(cat, 0) + amount
+        else:
+            self.income += amount
+            self.inc_by_cat[cat] = self.inc_by_cat.get(cat, 0) + amount
+        self.count += 1
+
+    def merge(self, other: "Summary"):
+        """
+        Прибавляет к сводке другую сводку.
+
+        :param other: Другая сводка
+        :type other: Summary
+        """
+        self.income += other.income
+        self.expense += other.expense
+        for cat, amount in other.inc_by_cat.items():
+            self.inc_by_cat[cat] = self.inc_by_cat.get(cat, 0) + amount
+        for cat, amount in other.exp_by_cat.items():
+            self.exp_by_cat[cat] = self.exp_by_cat.get(cat, 0) + amount
+        self.count += other.count
+
+    def matches(self, other: "Summary") -> bool:
+        """
+        Сравнивает сводки с учетом погрешности сложения float.
+
+        :param other: Другая сводка
+        :type other: Summary
+        :rtype: bool
+        """
+        if self.count != other.count:
+            return False
+        pairs = [(self.income, other.income), (self.expense, other.expense)]
+        for mine, theirs in ((self.inc_by_cat, other.inc_by_cat),
+                             (self.exp_by_cat, other.exp_by_cat)):
+            if mine.keys() != theirs.keys():
+                return False
+            pairs += [(mine[cat], theirs[cat]) for cat in mine]
+        return all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6)
+                   for a, b in pairs)
+
+
+class PeriodIndex:
+    """
+    Сводки операций пользователя по дням и месяцам.
+
+    Отчет за произвольный период складывается из сводок целых
+    месяцев и отдельных дней на краях периода, то есть стоит
+    O(месяцев + 62) вместо прохода по всей истории. Записи без
+    метки времени попадают в отдельную сводку legacy и учитываются
+    только в отчетах за все время.
+    :ivar days: Сводки по дням, ключ - date.toordinal()
+    :type days: dict
+    :ivar months: Сводки по месяцам, ключ - (год, месяц)
+    :type months: dict
+    :ivar legacy: Сводка записей без метки времени
+    :type legacy: Summary
+    """
+
+    __slots__ = ("days", "months", "legacy")
+
+    def __init__(self):
+        self.days = {}
+        self.months = {}
+        self.legacy = Summary()
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Строит индекс полным проходом по записям.
+
+        :param records: Записи пользователя
+        :type records: list
+        :rtype: PeriodIndex
+        """
+        index = cls()
+        for record in records:
+            index.add(record)
+        return index
+
+    def add(self, record: dict):
+        """
+        Учитывает одну новую запись.
+
+        :param record: Запись о доходе или расходе
+        :type record: dict
+        """
+        ts = record.get("ts")
+        if ts is None:
+            self.legacy.add(record)
+            return
+        day = date.fromtimestamp(ts)
+        for buckets, key in ((self.days, day.toordinal()),
+                             (self.months, (day.year, day.month))):
+            summ = buckets.get(key)
+            if summ is None:
+                summ = buckets[key] = Summary()
+            summ.add(record)
+
+    def query(self, start: date, end: date) -> Summary:
+        """
+        Считает сводку за период с start по end включительно.
+
+        :param start: Первый день периода
+        :type start: datetime.date
+        :param end: Последний день периода
+        :type end: datetime.date
+        :rtype: Summary
+        """
+        result = Summary()
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            first = date(year, month, 1)
+            nxt = date(year + month // 12, month % 12 + 1, 1)
+            if first >= start and nxt.toordinal() - 1 <= end.toordinal():
+                summ = self.months.get((year, month))
+                if summ is not None:
+                    result.merge(summ)
+            else:
+                lo = max(first, start).toordinal()
+                hi = min(nxt.toordinal() - 1, end.toordinal())
+                for day in range(lo, hi + 1):
+                    summ = self.days.get(day)
+                    if summ is not None:
+                        result.merge(summ)
+            year, month = nxt.year, nxt.month
+        return result
@@ -1,6 +1,37 @@
 from FinFlow_main import FinanceBot
+from budgets import Budgets
+from bench_fin import make_storage, run_load
+from fakes import (FakeBotApi, FakeBotApiServer, FakeContext, FakeDocument,
+                   FakeUpdate, make_update)
+import metrics
+import charts as charts_module
+from cluster import (Cluster, HashRing, journal_storage, node_budgets,
+                     node_names, node_recurring, rebalance, worker_outbox)
+from charts import ChartCache, ChartRenderer, render_pie
+from csv_io import CsvImporter, iter_csv
+from outbox import Outbox
+from recurring import Recurring
+from ledger import Ledger
+from storage import (JsonStorage, ShardedStorage, SqliteStorage,
+                     iter_json_items)
+from summary import PeriodIndex, Summary
+import snapshot
+from datetime import date, datetime
+from telegram import Update
+import asyncio
+import codecs
 import os
+import signal
 import json
+import sys
+import socket
+import subprocess
+import threading
+import time
+from types import SimpleNamespace
+import urllib.request
+import httpx
+import pytest
 
 def test_init_positive_valid_token():
     """Тест 1: Инициализация с валидным токеном"""
@@ -51,4 +82,1525 @@ def test_save_data_empty_dict():
     assert os.path.exists("data.json")
     with open("data.json", "r", encoding='utf-8') as f:
         saved_data = json.load(f)
-    assert saved_data == {}
\ No newline at end of file
+    assert saved_data == {}
+
+def test_journal_replay(tmp_path):
+    """Тест 4: записи из журнала восстанавливаются при загрузке"""
+    path = str(tmp_path / "data.json")
+    storage = JsonStorage(path, journal=True, fsync=False)
+    storage.load()
+    storage.append("user123", {"type": "income", "amount": 1000.0,
+                               "category": "Зарплата"})
+    storage.append("user123", {"type": "expense", "amount": 200.0,
+                               "category": "Еда"})
+    storage.close()
+    assert not os.path.exists(path)
+
+    data = JsonStorage(path, journal=True).load()
+    assert [r["amount"] for r in data["user123"]] == [1000.0, 200.0]
+
+
+def test_journal_compaction(tmp_path):
+    """Тест 5: сжатие журнала переносит записи в снимок без дублей"""
+    path = str(tmp_path / "data.json")
+    storage = JsonStorage(path, journal=True, journal_limit=1, fsync=False)
+    storage.load()
+    for i in range(5):
+        storage.append("user123", {"type": "expense", "amount": float(i),
+                                   "category": "Еда"})
+    storage.compact(wait=True)
+    storage.close()
+    assert not os.path.exists(storage.journal_path)
+    assert storage._segments() == []
+
+    data = JsonStorage(path, journal=True).load()
+    assert len(data["user123"]) == 5
+
+
+def test_journal_stale_segment(tmp_path):
+    """Негативный тест: сегмент, уже попавший в снимок, не дублируется"""
+    path = str(tmp_path / "data.json")
+    storage = JsonStorage(path, journal=True, fsync=False)
+    storage.load()
+    storage.append("user123", {"type": "income", "amount": 5.0,
+                               "category": "Премия"})
+    storage.compact(wait=True)
+    # имитируем сбой между записью снимка и удалением сегмента
+    with open(f"{storage.journal_path}.1", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"seq": 1, "user": "user123", "rec": {
+            "type": "income", "amount": 5.0, "category": "Премия"}}) + "\n")
+        f.write('{"seq": 2, "us')
+
+    data = JsonStorage(path, journal=True).load()
+    assert len(data["user123"]) == 1
+
+
+def test_sqlite_matches_json(tmp_path):
+    """Тест 6: SQLite считает те же суммы, что и JSON хранилище"""
+    records = [
+        {"type": "income", "amount": 1000.0, "category": "Зарплата"},
+        {"type": "expense", "amount": 150.0, "category": "Еда"},
+        {"type": "expense", "amount": 50.0, "category": "Еда"},
+        {"type": "income", "amount": 300.0, "category": "Премия"},
+    ]
+    js = JsonStorage(str(tmp_path / "data.json"))
+    db = SqliteStorage(str(tmp_path / "data.db"))
+    for record in records:
+        js.append("user123", record)
+        db.append("user123", record)
+
+    assert db.has_user("user123")
+    db_summ = db.compute_summary("user123")
+    js_summ = js.compute_summary("user123")
+    assert (db_summ.income, db_summ.expense) == (1300.0, 200.0)
+    assert db_summ.inc_by_cat == js_summ.inc_by_cat
+    assert db_summ.exp_by_cat == js_summ.exp_by_cat
+    assert db_summ.count == js_summ.count == 4
+    db.close()
+
+
+def test_sqlite_batched_reads_do_not_flush(tmp_path):
+    """Тест 49: чтение в режиме batched видит очередь и не сохраняет ее"""
+    db = SqliteStorage(str(tmp_path / "data.db"), durability="batched")
+    db.append("1", {"type": "income", "amount": 1000.0,
+                    "category": "Зарплата", "ts": 1})
+    db.flush()
+    db.append("1", {"type": "expense", "amount": 150.0, "category": "Еда",
+                    "ts": 2})
+    db.append("2", {"type": "expense", "amount": 5.0, "category": "Еда"})
+    flushes = db.flush_stats["flushes"]
+
+    assert db.has_user("2") and not db.has_user("3")
+    assert sorted(db.users()) == ["1", "2"]
+    assert [r["amount"] for r in db.records("1")] == [1000.0, 150.0]
+    summ = db.compute_summary("1")
+    assert (summ.income, summ.expense, summ.count) == (1000.0, 150.0, 2)
+    assert db.month_summary("1", 1970, 1).expense == 150.0
+    assert db.flush_stats["flushes"] == flushes
+    assert len(db.pending) == 2
+
+    # запрос, начатый до сохранения очереди, не видит записи дважды
+    rows = db.records("1")
+    db.flush()
+    assert [r["amount"] for r in rows] == [1000.0, 150.0]
+    assert db.compute_summary("1").count == 2
+    db.close()
+
+
+def test_sqlite_migrate_once(tmp_path):
+    """Негативный тест: повторная миграция не дублирует записи"""
+    path = str(tmp_path / "data.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"user123": [
+            {"type": "expense", "amount": 10, "category": "Транспорт"}
+        ]}, f)
+    db = SqliteStorage(str(tmp_path / "data.db"))
+    assert db.migrate(path) == 1
+    assert db.migrate(path) == 0
+    summ = db.summary("user123")
+    assert (summ.income, summ.expense) == (0, 10.0)
+    assert db.summary("user456") is None
+    db.close()
+
+
+def test_summary_incremental(tmp_path):
+    """Тест 7: сводка обновляется при записи и совпадает с пересчетом"""
+    storage = JsonStorage(str(tmp_path / "data.json"))
+    storage.load()
+    storage.append("user123", {"type": "income", "amount": 0.1,
+                               "category": "Подарок"})
+    summ = storage.summary("user123")
+    for _ in range(10):
+        storage.append("user123", {"type": "expense", "amount": 0.1,
+                                   "category": "Еда"})
+    assert storage.summary("user123") is summ
+    assert summ.count == 11
+    assert summ.exp_by_cat == {"Еда": summ.expense}
+    assert storage.check_summary() == []
+
+
+def test_summary_check_detects_drift(tmp_path):
+    """Негативный тест: проверка находит рассинхрон сводки"""
+    storage = JsonStorage(str(tmp_path / "data.json"))
+    storage.load()
+    storage.append("user123", {"type": "expense", "amount": 10.0,
+                               "category": "Еда"})
+    storage.summary("user123").add(
+        {"type": "expense", "amount": 1.0, "category": "Еда"}
+    )
+    assert storage.check_summary() == ["user123"]
+    assert Summary().matches(Summary())
+
+
+def test_render_pie_in_pool():
+    """Тест 8: диаграмма рисуется в пуле процессов и возвращается как PNG"""
+    charts = ChartRenderer(workers=1, timeout=60)
+    png = asyncio.run(charts.render("income", {"Зарплата": 1000.0}))
+    charts.close()
+    assert png.startswith(b"\x89PNG")
+    assert charts.pending == 0
+
+
+def test_render_pie_saturated():
+    """Негативный тест: при переполненной очереди диаграммы нет"""
+    charts = ChartRenderer(workers=1, max_pending=0)
+    assert asyncio.run(charts.render("expense", {"Еда": 10.0})) is None
+    charts = ChartRenderer(workers=1, timeout=0)
+    assert asyncio.run(charts.render("expense", {"Еда": 10.0})) is None
+    charts.close()
+
+
+def test_chart_cache_hit():
+    """Тест 9: повторная статистика берет диаграмму из кэша"""
+    charts = ChartRenderer(workers=0)
+    data = {"Еда": 100.0, "Транспорт": 50.0}
+    first = asyncio.run(charts.render("expense", data, "user123"))
+    second = asyncio.run(charts.render("expense", dict(data), "user123"))
+    assert first is second
+    assert (charts.cache.hits, charts.cache.misses) == (1, 1)
+
+    charts.invalidate("user123")
+    assert charts.cache.size == 0
+    asyncio.run(charts.render("expense", data, "user123"))
+    assert charts.cache.misses == 2
+
+
+def test_chart_cache_evicts_by_size():
+    """Негативный тест: кэш не превышает лимит по байтам"""
+    cache = ChartCache(max_bytes=10)
+    cache.put("a", b"12345", "user1")
+    cache.put("b", b"12345", "user2")
+    cache.get("a")
+    cache.put("c", b"12345", "user3")
+    assert cache.size == 10
+    assert cache.get("b") is None
+    assert cache.get("a") == b"12345"
+    cache.put("big", b"x" * 11)
+    assert cache.get("big") is None
+
+
+def test_batched_flush_by_count(tmp_path):
+    """Тест 10: пачка сохраняется фоновой задачей при flush_records"""
+    path = str(tmp_path / "data.json")
+    storage = JsonStorage(path, durability="batched",
+                          flush_interval=60, flush_records=3)
+    storage.load()
+
+    async def scenario():
+        task = asyncio.create_task(storage.flusher())
+        await asyncio.sleep(0)
+        for i in range(3):
+            storage.append("user123", {"type": "expense", "amount": 1.0,
+                                       "category": "Еда"})
+        assert not os.path.exists(path)
+        await asyncio.sleep(0.05)
+        assert storage.pending == []
+        storage.append("user123", {"type": "income", "amount": 5.0,
+                                   "category": "Премия"})
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    with open(path, "r", encoding="utf-8") as f:
+        assert len(json.load(f)["user123"]) == 4
+    assert storage.flush_stats["flushes"] == 2
+    assert storage.flush_stats["max_batch"] == 3
+
+
+def test_durability_unknown_mode(tmp_path):
+    """Негативный тест: неизвестный режим сохранения отклоняется"""
+    with pytest.raises(ValueError):
+        JsonStorage(str(tmp_path / "data.json"), durability="never")
+
+
+def test_sharded_lazy_load(tmp_path):
+    """Тест 11: история пользователя читается из шарда при обращении"""
+    directory = str(tmp_path / "data")
+    storage = ShardedStorage(directory, shards=4)
+    storage.save({str(i): [{"type": "income", "amount": float(i),
+                            "category": "Зарплата"}] for i in range(20)})
+
+    storage = ShardedStorage(directory, shards=4, max_users=3)
+    assert storage.cached_users() == []
+    assert storage.summary("7").income == 7.0
+    assert storage.cached_users() == ["7"]
+    assert storage.summary("unknown") is None
+
+
+def test_sharded_writes_back_on_eviction(tmp_path):
+    """Негативный тест: вытесненная история не теряет новые записи"""
+    directory = str(tmp_path / "data")
+    storage = ShardedStorage(directory, shards=2, max_users=1,
+                             durability="batched")
+    storage.append("user1", {"type": "expense", "amount": 10.0,
+                             "category": "Еда"})
+    storage.append("user2", {"type": "expense", "amount": 20.0,
+                             "category": "Еда"})
+    assert storage.cached_users() == ["user2"]
+
+    reopened = ShardedStorage(directory, shards=2)
+    assert reopened.summary("user1").expense == 10.0
+    assert reopened.summary("user2") is None
+    storage.close()
+    assert ShardedStorage(directory, shards=2).summary("user2").count == 1
+
+
+def make_records(n):
+    """Генерирует n записей разных типов и категорий"""
+    cats = [("expense", "Еда"), ("expense", "Транспорт"),
+            ("income", "Зарплата"), ("expense", "Жилье"),
+            ("income", "Премия")]
+    records = []
+    for i in range(n):
+        kind, cat = cats[i % len(cats)]
+        records.append({"type": kind, "amount": float(i % 997) + 0.25,
+                        "category": cat})
+    return records
+
+
+def test_ledger_roundtrip():
+    """Тест 12: Ledger без потерь конвертируется в записи и обратно"""
+    records = make_records(50) + [
+        {"type": "income", "amount": 1000, "category": "Новая категория"}
+    ]
+    ledger = Ledger.from_records(records[:10])
+    for record in records[10:]:
+        ledger.append(record)
+    assert ledger.to_records() == records
+    assert isinstance(ledger.to_records()[-1]["amount"], int)
+
+    fast = ledger.summary()
+    slow = Summary.from_records(records)
+    assert fast.matches(slow)
+    assert list(fast.exp_by_cat) == list(slow.exp_by_cat)
+
+
+def test_ledger_memory():
+    """Тест 13: Ledger меньше списка словарей и считает ту же сводку
+    (скорость сравнивает python bench_fin.py ledger)"""
+    records = make_records(200_000)
+    ledger = Ledger.from_records(records)
+
+    dict_bytes = sys.getsizeof(records) + sum(
+        sys.getsizeof(r) + sys.getsizeof(r["amount"]) for r in records
+    )
+    assert ledger.nbytes * 10 < dict_bytes
+    assert ledger.summary().matches(Summary.from_records(records))
+
+
+def test_ledger_empty_summary():
+    """Негативный тест: пустая история дает пустую сводку"""
+    summ = Ledger().summary()
+    assert (summ.income, summ.expense, summ.count) == (0, 0, 0)
+    assert summ.inc_by_cat == {} and summ.exp_by_cat == {}
+
+
+def test_period_index_matches_scan():
+    """Тест 14: сводка за период совпадает с фильтрацией записей"""
+    base = int(datetime(2026, 1, 1).timestamp())
+    records = make_records(3000)
+    for i, record in enumerate(records):
+        record["ts"] = base + i * 3 * 3600
+    records.append({"type": "expense", "amount": 7.0, "category": "Еда"})
+
+    index = PeriodIndex.from_records(records)
+    start, end = date(2026, 1, 20), date(2026, 3, 5)
+    expected = Summary.from_records(
+        r for r in records
+        if "ts" in r and start <= date.fromtimestamp(r["ts"]) <= end
+    )
+    assert index.query(start, end).matches(expected)
+    assert index.legacy.count == 1
+
+
+def test_parse_period():
+    """Тест 15: разбор периода из аргументов команды"""
+    today = date(2026, 10, 17)
+    assert FinanceBot.parse_period([], today) is None
+    assert FinanceBot.parse_period(["7"], today) == (date(2026, 10, 11),
+                                                     today)
+    assert FinanceBot.parse_period(["месяц"], today) == (date(2026, 10, 1),
+                                                         today)
+    assert FinanceBot.parse_period(["2026-01-01", "2026-01-31"], today) == (
+        date(2026, 1, 1), date(2026, 1, 31)
+    )
+
+
+def test_parse_period_invalid():
+    """Негативный тест: некорректный период отклоняется"""
+    for args in (["вчера"], ["0"], ["2026-02-01", "2026-01-01"]):
+        with pytest.raises(ValueError):
+            FinanceBot.parse_period(args, date(2026, 10, 17))
+
+
+def test_storage_period_summary(tmp_path):
+    """Тест 16: хранилище обновляет индекс периодов при записи"""
+    storage = SqliteStorage(str(tmp_path / "data.db"))
+    today = date.today()
+    storage.append("user123", {"type": "expense", "amount": 10.0,
+                               "category": "Еда"})
+    assert storage.period_summary("user123", today, today).count == 0
+    storage.append("user123", {"type": "expense", "amount": 5.0,
+                               "category": "Еда", "ts": int(time.time())})
+    summ = storage.period_summary("user123", today, today)
+    assert (summ.count, summ.expense) == (1, 5.0)
+    assert storage.period_summary("user456", today, today) is None
+    storage.close()
+
+
+def test_bench_load_report(tmp_path):
+    """Тест 17: нагрузочный прогон возвращает задержки по обработчикам"""
+    storage = make_storage("journal", str(tmp_path), "batched")
+    storage.load()
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0))
+    report = asyncio.run(run_load(bot, users=3, rounds=2))
+    storage.close()
+
+    assert report["updates"] > 0
+    assert report["handlers"]["hand_amnt"]["count"] == 6
+    assert report["handlers"]["show_bal"]["p99_ms"] >= 0
+    assert storage.check_summary() == []
+
+
+def test_bench_unknown_storage(tmp_path):
+    """Негативный тест: неизвестное хранилище в замере отклоняется"""
+    with pytest.raises(ValueError):
+        make_storage("redis", str(tmp_path))
+
+
+def test_metrics_exposition(tmp_path):
+    """Тест 18: обработчики и хранилище попадают в метрики Prometheus"""
+    metrics.REGISTRY.reset()
+    storage = JsonStorage(str(tmp_path / "data.json"), durability="batched")
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0))
+    context = FakeContext()
+
+    async def scenario():
+        for text in ("Расход", "Еда", "150", "Баланс"):
+            await bot.hand_mess(FakeUpdate(1, text), context)
+        await bot.hand_period(FakeUpdate(1, "/balance месяц"),
+                              FakeContext(args=["месяц"]))
+        await bot.hand_repeat(FakeUpdate(1, "/repeat"), FakeContext())
+
+    asyncio.run(scenario())
+    assert metrics.UPDATES.get() == 6
+    assert metrics.HANDLER_SECONDS.count(handler="show_bal") == 2
+    assert metrics.HANDLER_SECONDS.count(handler="hand_period") == 1
+    assert metrics.HANDLER_SECONDS.count(handler="hand_repeat") == 1
+    assert metrics.HANDLER_SECONDS.count(handler="hand_mess",
+                                         branch="amount") == 1
+
+    server = metrics.REGISTRY.serve(0)
+    url = f"http://127.0.0.1:{server.server_port}/metrics"
+    with urllib.request.urlopen(url) as response:
+        text = response.read().decode("utf-8")
+    server.shutdown()
+    assert "# TYPE finflow_handler_seconds histogram" in text
+    assert 'finflow_handler_seconds_count{handler="hand_amnt"} 1' in text
+    assert 'le="+Inf"' in text
+
+
+def test_metrics_disabled():
+    """Негативный тест: выключенные метрики не обновляются"""
+    metrics.REGISTRY.reset()
+    metrics.REGISTRY.enabled = False
+    try:
+        metrics.UPDATES.inc()
+        with metrics.HANDLER_SECONDS.time(handler="start"):
+            pass
+    finally:
+        metrics.REGISTRY.enabled = True
+    assert metrics.UPDATES.get() == 0
+    assert metrics.HANDLER_SECONDS.count(handler="start") == 0
+
+
+def free_port():
+    """Возвращает свободный TCP порт на localhost"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_webhook_processes_posted_updates(tmp_path):
+    """Тест 19: обновления, присланные на webhook, обрабатываются ботом"""
+    api = FakeBotApi()
+    bot = FinanceBot("123:ABC", storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    app = bot.build_app(request=api)
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/hook"
+
+    async def scenario():
+        await app.initialize()
+        await app.updater.start_webhook(listen="127.0.0.1", port=port,
+                                        url_path="hook")
+        await app.start()
+        async with httpx.AsyncClient() as client:
+            for i, text in enumerate(["Доход", "Премия", "500", "Баланс"]):
+                response = await client.post(url, json=make_update(i, 7, text))
+                assert response.status_code == 200
+        for _ in range(200):
+            if len(api.sent) == 4:
+                break
+            await asyncio.sleep(0.01)
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+
+    asyncio.run(scenario())
+    assert [method for method, _ in api.sent] == ["sendMessage"] * 4
+    assert "Баланс: 500.0 руб." in api.sent[-1][1]["text"]
+
+
+def test_user_lock_serializes_same_user(tmp_path):
+    """Негативный тест: сообщения одного пользователя не пересекаются"""
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    events = []
+
+    async def handler(update, context):
+        events.append(("start", update.message.text))
+        await asyncio.sleep(0.01)
+        events.append(("end", update.message.text))
+
+    wrapped = bot.locked(handler)
+
+    async def scenario():
+        await asyncio.gather(
+            wrapped(FakeUpdate(1, "a"), FakeContext()),
+            wrapped(FakeUpdate(1, "b"), FakeContext()),
+            wrapped(FakeUpdate(2, "c"), FakeContext()),
+        )
+
+    asyncio.run(scenario())
+    same_user = [e for e in events if e[1] in "ab"]
+    assert same_user == [("start", "a"), ("end", "a"),
+                         ("start", "b"), ("end", "b")]
+    assert events.index(("start", "c")) < events.index(("end", "a"))
+    assert bot.locks == {}
+
+
+def test_iter_json_items_matches_json_loads():
+    """Тест 20: потоковый разбор снимка совпадает с json.loads"""
+    data = {"1": make_records(5), "2": [], "_seq": 7}
+    for text in (json.dumps(data), json.dumps(data, indent=2), "{ }"):
+        assert dict(iter_json_items(text)) == json.loads(text)
+    with pytest.raises(ValueError):
+        dict(iter_json_items('{"1": [] "2": []}'))
+
+
+def test_background_load_serves_before_snapshot(tmp_path):
+    """Тест 21: бот отвечает и принимает операции до окончания загрузки"""
+    path = str(tmp_path / "d.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"1": [{"type": "income", "amount": 500,
+                          "category": "Премия"}]}, f)
+    storage = JsonStorage(path)
+    gate = threading.Event()
+    load = storage.load
+    storage.load = lambda: gate.wait() and load()
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0), background_load=True)
+
+    async def scenario():
+        replies = []
+        context = FakeContext()
+        for text in ("/start", "Расход", "Еда"):
+            if text == "/start":
+                await bot.start(FakeUpdate(1, text, replies), context)
+            else:
+                await bot.hand_mess(FakeUpdate(1, text, replies), context)
+        # операция принята сразу, подтверждение ждет загрузки
+        amount = asyncio.create_task(
+            bot.hand_mess(FakeUpdate(1, "100", replies), context))
+        await asyncio.sleep(0.05)
+        assert not storage.ready.is_set() and len(replies) == 3
+        assert storage._early
+        gate.set()
+        await amount
+        await bot.hand_mess(FakeUpdate(1, "Баланс", replies), context)
+        return replies
+
+    replies = asyncio.run(scenario())
+    assert replies[0] == ("text", "Выберите действие:")
+    assert replies[3][1] == "Еда 100.0 руб. добавлен!"
+    assert "Баланс: 400.0 руб." in replies[-1][1]
+    with open(path, encoding="utf-8") as f:
+        assert len(json.load(f)["1"]) == 2
+
+
+def test_background_load_with_running_flusher(tmp_path):
+    """Тест 47: отложенные записи переносятся при работающем flusher
+    без потерь и повторов"""
+    path = str(tmp_path / "d.json")
+    storage = JsonStorage(path, journal=True, durability="batched",
+                          flush_interval=0.001, flush_records=10)
+    gate = threading.Event()
+    load = storage.load
+    storage.load = lambda: gate.wait() is None or load()
+
+    async def scenario():
+        flusher = asyncio.create_task(storage.flusher())
+        await asyncio.sleep(0)
+        storage.load_background()
+        for i in range(20000):
+            storage.append(str(i % 7), {"type": "expense", "amount": 1,
+                                        "category": "Еда", "ts": i})
+        gate.set()
+        # пока поток переносит записи, flusher сохраняет очередь
+        while not storage.ready.is_set():
+            await asyncio.sleep(0)
+        await storage.loaded()
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+
+    asyncio.run(scenario())
+    storage.close()
+    reloaded = JsonStorage(path, journal=True)
+    reloaded.load()
+    assert sum(len(reloaded.records(str(i))) for i in range(7)) == 20000
+    assert reloaded.check_summary() == []
+
+
+def test_background_load_failure_is_reported(tmp_path):
+    """Негативный тест: при неудачной загрузке операция не подтверждается,
+    а save_data не затирает снимок"""
+    path = str(tmp_path / "d.json")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"1": [{"type": "inc')
+    storage = JsonStorage(path)
+    gate = threading.Event()
+    load = storage.load
+    storage.load = lambda: gate.wait() and load()
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0), background_load=True)
+    saver = threading.Thread(target=lambda: pytest.raises(
+        OSError, bot.save_data))
+    saver.start()
+
+    async def scenario():
+        replies = []
+        context = FakeContext()
+        for text in ("Расход", "Еда"):
+            await bot.hand_mess(FakeUpdate(1, text, replies), context)
+        amount = asyncio.create_task(
+            bot.hand_mess(FakeUpdate(1, "100", replies), context))
+        await asyncio.sleep(0.05)
+        gate.set()
+        await amount
+        await bot.hand_mess(FakeUpdate(1, "50", replies), context)
+        return replies
+
+    replies = asyncio.run(scenario())
+    saver.join()
+    assert [text for _, text in replies[2:]] == [
+        "Данные не загрузились, операция не сохранена. Попробуйте позже"
+    ] * 2
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == '{"1": [{"type": "inc'
+
+
+def test_import_does_not_load_matplotlib():
+    """Негативный тест: импорт бота не загружает matplotlib.pyplot"""
+    code = ("import sys, FinFlow_main; "
+            "print('matplotlib.pyplot' in sys.modules)")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                         text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert out.stdout.strip() == "False"
+
+
+STATEMENT = [
+    "Дата операции;Сумма;Описание;Категория\n",
+    "01.03.2026;-1 250,50;ПЯТЕРОЧКА 1234;Супермаркеты\n",
+    "02.03.2026;-300,00;Яндекс Такси;\n",
+    "03.03.2026;85000,00;Зарплата за февраль;\n",
+    "04.03.2026;-999;Перевод;Здоровье\n",
+    "не дата;-10;Ошибка;\n",
+    "05.03.2026;0;Нулевая операция;\n",
+]
+
+
+def test_csv_import_commits_per_chunk(tmp_path):
+    """Тест 22: выписка импортируется пачками с одним сохранением на пачку"""
+    storage = JsonStorage(str(tmp_path / "d.json"), journal=True)
+    storage.load()
+    importer = CsvImporter(chunk_size=2,
+                           categories={"expense": {"Здоровье"}})
+    stats = asyncio.run(importer.import_lines(storage, "1", STATEMENT))
+    assert stats["imported"] == 4 and stats["skipped"] == 2
+    assert stats["chunks"] == storage.flush_stats["flushes"] == 2
+    assert [r["category"] for r in storage.records("1")] == [
+        "Еда", "Транспорт", "Зарплата", "Здоровье"]
+    summ = storage.summary("1")
+    assert summ.income == 85000 and summ.expense == 2549.5
+    assert storage.records("1")[0]["ts"] == int(
+        datetime(2026, 3, 1).timestamp())
+
+
+def test_csv_import_debit_credit_cp1251(tmp_path):
+    """Тест 23: столбцы списания и зачисления в кодировке cp1251"""
+    path = tmp_path / "bank.csv"
+    path.write_bytes("Date,Debit,Credit,Description\n"
+                     "2026-03-01,120.5,,Аптека\n"
+                     "2026-03-02,,1000,Дивиденды\n".encode("cp1251"))
+    storage = JsonStorage(str(tmp_path / "d.json"))
+    storage.load()
+    stats = asyncio.run(CsvImporter().import_file(storage, "1", str(path)))
+    assert stats["imported"] == 2
+    assert [(r["type"], r["category"]) for r in storage.records("1")] == [
+        ("expense", "Здоровье"), ("income", "Инвестиции")]
+
+
+def test_csv_import_zero_filled_columns(tmp_path):
+    """Тест 43: 0,00 в пустом столбце и суммы вида 1.234,56"""
+    path = tmp_path / "bank.csv"
+    path.write_text("Дата;Списание;Зачисление;Описание\n"
+                    "01.03.2026;0,00;50000,00;Зарплата\n"
+                    "02.03.2026;1.234,56;0,00;Аптека\n", encoding="utf-8")
+    storage = JsonStorage(str(tmp_path / "d.json"))
+    storage.load()
+    stats = asyncio.run(CsvImporter().import_file(storage, "1", str(path)))
+    assert stats["imported"] == 2
+    assert [(r["type"], r["amount"]) for r in storage.records("1")] == [
+        ("income", 50000.0), ("expense", 1234.56)]
+
+
+def test_non_finite_amounts_rejected(tmp_path):
+    """Негативный тест: суммы nan и inf не попадают в данные"""
+    path = tmp_path / "bank.csv"
+    path.write_text("Дата;Сумма;Описание\n"
+                    "01.03.2026;nan;Кафе\n"
+                    "02.03.2026;-inf;Аптека\n"
+                    "03.03.2026;1e400;Зарплата\n"
+                    "04.03.2026;-100;Кафе\n", encoding="utf-8")
+    storage = JsonStorage(str(tmp_path / "d.json"))
+    storage.load()
+    stats = asyncio.run(CsvImporter().import_file(storage, "1", str(path)))
+    assert (stats["imported"], stats["skipped"]) == (1, 3)
+    assert (storage.summary("1").income, storage.summary("1").expense) == (
+        0, 100)
+
+    with pytest.raises(ValueError):
+        Budgets(str(tmp_path / "budgets.json")).set("1", "Еда", float("nan"))
+    with pytest.raises(ValueError):
+        Recurring(str(tmp_path / "recurring.json")).add(
+            "1", "expense", "Жилье", float("inf"), 5)
+
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0))
+    replies = []
+    context = FakeContext({"action": "expense", "category": "Еда"})
+    asyncio.run(bot.hand_mess(FakeUpdate(1, "nan", replies), context))
+    assert replies == [("text", "Введите число!")]
+    assert storage.summary("1").count == 1
+
+
+def test_hand_doc_imports_statement(tmp_path):
+    """Тест 24: присланный CSV файл добавляет операции пользователю"""
+    path = tmp_path / "statement.csv"
+    path.write_text("".join(STATEMENT), encoding="utf-8")
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    replies = []
+    update = FakeUpdate(1, None, replies, FakeDocument(str(path)))
+    asyncio.run(bot.hand_doc(update, FakeContext()))
+    assert "Импортировано операций: 4" in replies[-1][1]
+    assert "Пропущено строк: 2" in replies[-1][1]
+    assert bot.storage.summary("1").count == 4
+
+
+def test_hand_doc_rejects_unknown_header(tmp_path):
+    """Негативный тест: выписка без столбца суммы не импортируется"""
+    path = tmp_path / "statement.csv"
+    path.write_text("Дата;Описание\n01.03.2026;Кафе\n", encoding="utf-8")
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    replies = []
+    update = FakeUpdate(1, None, replies, FakeDocument(str(path)))
+    asyncio.run(bot.hand_doc(update, FakeContext()))
+    assert replies[-1][1].startswith("Не удалось прочитать выписку")
+    assert bot.storage.summary("1") is None
+
+
+def test_export_round_trip(tmp_path):
+    """Тест 25: выгруженный CSV загружается обратно без потерь"""
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    now = int(time.time())
+    bot.storage.append_many("1", [
+        {"type": "income", "amount": 1000.0, "category": "Зарплата",
+         "ts": now},
+        {"type": "expense", "amount": 250.5, "category": "Еда", "ts": now},
+        {"type": "expense", "amount": 749.5, "category": "Жилье",
+         "ts": now - 400 * 86400},
+    ])
+    replies = []
+    asyncio.run(bot.hand_export(FakeUpdate(1, "/export", replies),
+                                FakeContext(args=["итоги"])))
+    (kind, operations), (_, totals) = replies
+    assert kind == "document" and operations.startswith(codecs.BOM_UTF8)
+
+    copy = JsonStorage(str(tmp_path / "copy.json"))
+    stats = asyncio.run(bot.importer.import_lines(
+        copy, "1", operations.decode("utf-8-sig").splitlines(True)))
+    assert stats["imported"] == 3
+    assert copy.summary("1").matches(bot.storage.summary("1"))
+    assert "Расход;Жилье;749.5;75.0" in totals.decode("utf-8-sig")
+    assert "Итого;Баланс;0.0;" in totals.decode("utf-8-sig")
+
+
+def test_export_period_filters_records(tmp_path):
+    """Тест 26: /export неделя выгружает только операции за неделю"""
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    now = int(time.time())
+    bot.storage.append_many("1", [
+        {"type": "expense", "amount": 10, "category": "Еда", "ts": now},
+        {"type": "expense", "amount": 20, "category": "Еда",
+         "ts": now - 30 * 86400},
+        {"type": "expense", "amount": 30, "category": "Еда"},
+    ])
+    replies = []
+    asyncio.run(bot.hand_export(FakeUpdate(1, "/export", replies),
+                                FakeContext(args=["неделя"])))
+    lines = replies[0][1].decode("utf-8-sig").splitlines()
+    assert len(lines) == 2 and lines[1].endswith(";Расход;10;Еда")
+
+
+def test_export_without_records(tmp_path):
+    """Негативный тест: выгрузка без операций не отправляет файл"""
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    replies = []
+    asyncio.run(bot.hand_export(FakeUpdate(1, "/export", replies),
+                                FakeContext()))
+    assert replies == [("text", "Нет операций")]
+
+
+def test_iter_csv_chunks_and_sharded_records(tmp_path):
+    """Тест 27: CSV собирается частями, история шарда читается частями"""
+    chunks = list(iter_csv(([i] for i in range(2500)), chunk_rows=1000))
+    assert len(chunks) == 4 and chunks[0] == codecs.BOM_UTF8
+    assert b"".join(chunks[1:]).count(b"\n") == 2500
+
+    storage = ShardedStorage(str(tmp_path / "shards"))
+    records = make_records(5000)
+    storage.append_many("1", records)
+    assert list(storage.records("1")) == records
+
+
+def test_pie_templates_are_reused():
+    """Тест 28: заготовка диаграммы переиспользуется без остатков"""
+    first = render_pie("expense", {"Еда": 100, "Жилье": 300})
+    template = charts_module._TEMPLATES["expense"]
+    second = render_pie("expense", {"Транспорт": 50})
+    assert charts_module._TEMPLATES["expense"] is template
+    assert first.startswith(b"\x89PNG") and second.startswith(b"\x89PNG")
+    assert not template.axes.patches and not template.axes.texts
+    svg = render_pie("income", {"Зарплата": 1000}, fmt="svg")
+    assert svg.lstrip().startswith(b"<?xml") and "Зарплата".encode() in svg
+
+
+def test_render_pie_unknown_format():
+    """Негативный тест: неизвестный формат диаграммы"""
+    with pytest.raises(ValueError):
+        render_pie("income", {"Зарплата": 1000}, fmt="gif")
+
+
+def test_render_does_not_use_pyplot():
+    """Тест 29: диаграммы рисуются без pyplot"""
+    code = ("import sys, charts; charts.render_pie('income', {'a': 1}); "
+            "print('matplotlib.pyplot' in sys.modules)")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                         text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert out.stdout.strip() == "False"
+
+
+def test_show_stat_sends_svg_documents(tmp_path):
+    """Тест 30: в режиме SVG диаграммы отправляются файлами"""
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0, fmt="svg"))
+    bot.storage.append("1", {"type": "expense", "amount": 10,
+                             "category": "Еда"})
+    replies = []
+    asyncio.run(bot.show_stat(FakeUpdate(1, "Статистика", replies), "1"))
+    assert replies[0] == ("text", "Нет данных о доходах")
+    assert replies[1][0] == "document" and b"<svg" in replies[1][1]
+
+
+def test_hash_ring_moves_few_users():
+    """Тест 31: при добавлении узла переезжает около 1/N пользователей"""
+    users = [str(i) for i in range(10000)]
+    two = HashRing(node_names(2))
+    three = HashRing(node_names(3))
+    counts = {}
+    for user in users:
+        counts[two.node(user)] = counts.get(two.node(user), 0) + 1
+    assert min(counts.values()) > 4000
+    moved = [user for user in users if two.node(user) != three.node(user)]
+    assert 2500 < len(moved) < 4200
+    assert all(three.node(user) == "worker-2" for user in moved)
+
+
+def test_rebalance_keeps_records(tmp_path):
+    """Тест 32: перенос пользователей при смене числа узлов"""
+    directory = str(tmp_path)
+    assert rebalance(directory, 2) == 0
+    ring = HashRing(node_names(2))
+    for user in range(40):
+        store = journal_storage(os.path.join(directory, ring.node(user)))
+        store.load()
+        store.append_many(str(user), [
+            {"type": "income", "amount": user + i, "category": "Премия"}
+            for i in range(3)
+        ])
+        store.close()
+        node_budgets(os.path.join(directory, ring.node(user))).set(
+            str(user), "Еда", 100 + user)
+    # у пользователей 40-59 есть только регулярные операции,
+    # у 60-79 - только бюджеты с пройденными порогами
+    for user in range(20, 60):
+        node_recurring(os.path.join(directory, ring.node(user))).add(
+            str(user), "expense", "Жилье", 1000 + user, 5)
+    for user in range(60, 80):
+        budgets = node_budgets(os.path.join(directory, ring.node(user)))
+        budgets.set(str(user), "Еда", 100 + user)
+        budgets.check(str(user), "Еда", (2026, 3), 100 + user)
+        budgets.save()
+
+    moved = rebalance(directory, 3)
+    assert moved > 0
+    ring = HashRing(node_names(3))
+    seen = {}
+    for name in ring.nodes:
+        store = journal_storage(os.path.join(directory, name))
+        store.load()
+        for user in store.users():
+            assert ring.node(user) == name
+            seen[user] = store.summary(user).income
+        store.close()
+        budgets = node_budgets(os.path.join(directory, name))
+        for user, limits in budgets.limits.items():
+            assert ring.node(user) == name
+            assert limits == {"Еда": 100 + int(user)}
+            seen[user, "budget"] = budgets.fired.get(user)
+        for user, rules in node_recurring(
+                os.path.join(directory, name)).rules.items():
+            assert ring.node(user) == name
+            seen[user, "rule"] = [rule["amount"] for rule in rules]
+    assert all(seen.pop((str(user), "rule")) == [1000 + user]
+               for user in range(20, 60))
+    assert all(seen.pop((str(user), "budget")) is None
+               for user in range(40))
+    assert all(seen.pop((str(user), "budget")) == {"2026-03": {"Еда": 1.0}}
+               for user in range(60, 80))
+    assert seen == {str(user): 3 * user + 3 for user in range(40)}
+    assert rebalance(directory, 3) == 0
+
+
+def test_cluster_routes_users_to_workers(tmp_path):
+    """Тест 33: кластер из двух процессов отвечает через Bot API"""
+    server = FakeBotApiServer()
+    cluster = Cluster("123:ABC", workers=2, directory=str(tmp_path),
+                      base_url=server.base_url)
+    users = range(1, 9)
+    cluster.start()
+    try:
+        update_id = 0
+        for user in users:
+            for text in ["Доход", "Премия", str(user * 100)]:
+                update_id += 1
+                cluster.route(user, json.dumps(
+                    make_update(update_id, user, text)))
+        for _ in range(600):
+            if len(server.api.sent) == update_id:
+                break
+            time.sleep(0.05)
+    finally:
+        cluster.stop()
+        server.close()
+
+    assert len(server.api.sent) == update_id
+    assert all(count > 0 for count in cluster.routed.values())
+    for user in users:
+        name = cluster.ring.node(user)
+        store = journal_storage(os.path.join(str(tmp_path), name))
+        store.load()
+        assert store.summary(str(user)).income == user * 100
+        store.close()
+
+
+def test_show_stat_sends_one_media_group(tmp_path):
+    """Тест 34: диаграммы и статистика уходят одним альбомом"""
+    server = FakeBotApiServer()
+    bot = FinanceBot("123:ABC", storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    bot.storage.append("5", {"type": "income", "amount": 900,
+                             "category": "Зарплата"})
+    bot.storage.append("5", {"type": "expense", "amount": 300,
+                             "category": "Еда"})
+    app = bot.build_app(base_url=server.base_url)
+
+    async def scenario():
+        await app.initialize()
+        await app.process_update(
+            Update.de_json(make_update(1, 5, "Статистика"), app.bot))
+        await app.shutdown()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        server.close()
+    assert [method for method, _ in server.api.sent] == ["sendMediaGroup"]
+    media = server.api.sent[0][1]["media"]
+    assert [item["type"] for item in media] == ["photo", "photo"]
+    assert "Итоговый баланс: 600 руб." in media[0]["caption"]
+
+
+def test_show_stat_long_caption_sent_separately(tmp_path):
+    """Тест 35: статистика длиннее подписи отправляется отдельно"""
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    for i in range(40):
+        bot.storage.append("1", {"type": "income", "amount": 100 + i,
+                                 "category": f"Категория дохода {i}"})
+    bot.storage.append("1", {"type": "expense", "amount": 50,
+                             "category": "Еда"})
+    replies = []
+    asyncio.run(bot.show_stat(FakeUpdate(1, "Статистика", replies), "1"))
+    assert replies[0] == ("media", ["Общие доходы: 4780 руб.",
+                                    "Общие расходы: 50 руб."])
+    assert replies[1][0] == "text" and len(replies[1][1]) > 1024
+    assert len(replies) == 2
+
+
+def test_outbox_keeps_order_and_rate():
+    """Тест 36: запросы одного чата уходят по очереди с заданной скоростью"""
+    outbox = Outbox(chat_rate=50, chat_burst=2)
+    sent = []
+    depth = []
+
+    async def send(i):
+        depth.append(outbox.queued)
+        sent.append((i, time.perf_counter()))
+        return i
+
+    async def scenario():
+        return await asyncio.gather(*(
+            outbox.process_request(send, (i,), {}, "sendMessage",
+                                   {"chat_id": 1}, None)
+            for i in range(6)
+        ))
+
+    assert asyncio.run(scenario()) == list(range(6))
+    assert [i for i, _ in sent] == list(range(6))
+    assert sent[-1][1] - sent[0][1] >= 0.07
+    assert max(depth) >= 3 and outbox.queued == 0
+
+
+def test_outbox_retries_after_flood(tmp_path):
+    """Тест 37: после ошибки 429 запрос повторяется через retry_after"""
+    api = FakeBotApi()
+    api.flood = 1
+    bot = FinanceBot("123:ABC", storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0))
+    app = bot.build_app(request=api)
+    retries = metrics.SEND_RETRIES.get(method="sendMessage")
+
+    async def scenario():
+        await app.initialize()
+        start = time.perf_counter()
+        await app.bot.send_message(chat_id=3, text="Баланс")
+        elapsed = time.perf_counter() - start
+        await app.shutdown()
+        return elapsed
+
+    assert asyncio.run(scenario()) >= 1.0
+    assert [method for method, _ in api.sent] == ["sendMessage"]
+    assert metrics.SEND_RETRIES.get(method="sendMessage") == retries + 1
+
+
+def add_expense(bot, user_id, category, amount):
+    """Проводит расход через диалог и возвращает последний ответ"""
+    context = FakeContext()
+    replies = []
+    for text in ["Расход", category, str(amount)]:
+        asyncio.run(bot.hand_mess(FakeUpdate(user_id, text, replies),
+                                  context))
+    return replies[-1][1]
+
+
+def test_budget_alerts_fire_once(tmp_path):
+    """Тест 38: предупреждения о 80% и 100% бюджета приходят по разу"""
+    path = str(tmp_path / "budgets.json")
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0), budgets=Budgets(path))
+    replies = []
+    asyncio.run(bot.hand_budget(FakeUpdate(1, "/budget Еда 1000", replies),
+                                FakeContext(args=["Еда", "1000"])))
+    assert replies == [("text", "Бюджет на Еда: 1000.0 руб. в месяц")]
+
+    texts = [add_expense(bot, 1, "Еда", amount)
+             for amount in (500, 300, 100, 200, 50)]
+    assert ["\n" in text for text in texts] == [False, True, False, True,
+                                                False]
+    assert "Внимание: на Еда потрачено 800.0 из 1000.0" in texts[1]
+    assert "Бюджет на Еда превышен: 1100.0 из 1000.0" in texts[3]
+    assert "\n" not in add_expense(bot, 1, "Транспорт", 5000)
+
+    # пороги переживают перезапуск и сбрасываются при новом лимите
+    bot.budgets = Budgets(path)
+    assert "\n" not in add_expense(bot, 1, "Еда", 10)
+    bot.budgets.set("1", "Еда", 2000)
+    assert "Внимание" in add_expense(bot, 1, "Еда", 500)
+
+
+def test_budget_commands(tmp_path):
+    """Тест 39: /budgets показывает лимиты и расходы месяца"""
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0),
+                     budgets=Budgets(str(tmp_path / "budgets.json")))
+    replies = []
+    asyncio.run(bot.hand_budget(FakeUpdate(1, "/budgets", replies),
+                                FakeContext()))
+    asyncio.run(bot.hand_budget(FakeUpdate(1, "/budget Кино 100", replies),
+                                FakeContext(args=["Кино", "100"])))
+    assert replies[0][1].startswith("Бюджетов нет")
+    assert replies[1][1].startswith("Например: /budget Еда 10000")
+
+    bot.budgets.set("1", "Еда", 400)
+    bot.budgets.set("1", "Жилье", 1000)
+    add_expense(bot, 1, "Еда", 100)
+    asyncio.run(bot.hand_budget(FakeUpdate(1, "/budgets", replies),
+                                FakeContext()))
+    assert "Еда: 100.0 из 400 руб. (25%)" in replies[-1][1]
+    assert "Жилье: 0 из 1000 руб. (0%)" in replies[-1][1]
+
+    asyncio.run(bot.hand_budget(FakeUpdate(1, "/budget Еда 0", replies),
+                                FakeContext(args=["Еда", "0"])))
+    assert replies[-1][1] == "Бюджет на Еда удален"
+    assert bot.budgets.get("1") == {"Жилье": 1000}
+
+
+def test_binary_snapshot_round_trip(tmp_path):
+    """Тест 40: двоичный снимок со сжатием загружается без потерь"""
+    data = {
+        "1": [{"type": "income", "amount": 1500, "category": "Зарплата",
+               "ts": 1700000000},
+              {"type": "expense", "amount": 99.5, "category": "Еда"}],
+        "2": [],
+        "пользователь": [{"type": "expense", "amount": 0.1,
+                          "category": "Кафе ☕", "ts": 0}],
+    }
+    path = str(tmp_path / "d.snap")
+    for journal in (False, True):
+        storage = JsonStorage(path, journal=journal, fmt="binary",
+                              compression="zlib")
+        storage.load()
+        storage.save(json.loads(json.dumps(data)))
+        storage.append("2", {"type": "expense", "amount": 7,
+                             "category": "Еда"})
+        storage.close()
+        with open(path, "rb") as f:
+            assert f.read(4) == b"FFSN"
+        loaded = JsonStorage(path, journal=journal, fmt="binary").load()
+        assert loaded["1"] == data["1"]
+        assert loaded["пользователь"] == data["пользователь"]
+        assert loaded["2"] == [{"type": "expense", "amount": 7,
+                                "category": "Еда"}]
+        assert type(loaded["1"][0]["amount"]) is int
+
+    # старый data.json читается и переписывается в двоичном формате
+    old = str(tmp_path / "old.json")
+    with open(old, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    storage = JsonStorage(old, fmt="binary")
+    assert storage.load() == data
+    storage.save()
+    assert JsonStorage(old).load() == data
+
+
+def test_corrupt_snapshot_is_reported(tmp_path):
+    """Негативный тест: поврежденный снимок не подменяется пустыми данными"""
+    path = str(tmp_path / "d.snap")
+    storage = JsonStorage(path, fmt="binary")
+    storage.save({"1": [{"type": "income", "amount": 5,
+                         "category": "Подарки"}]})
+    with open(path, "rb") as f:
+        payload = f.read()
+    flipped = bytearray(payload)
+    flipped[40] ^= 1
+    for damaged in (payload[:-3], bytes(flipped)):
+        with open(path, "wb") as f:
+            f.write(damaged)
+        with pytest.raises(snapshot.SnapshotError):
+            JsonStorage(path, fmt="binary").load()
+
+    text = str(tmp_path / "d.json")
+    with open(text, "w", encoding="utf-8") as f:
+        f.write('{"1": [{"type": "inc')
+    with pytest.raises(snapshot.SnapshotError):
+        JsonStorage(text).load()
+
+    # фоновая загрузка сообщает об ошибке и не перезаписывает файл
+    storage = JsonStorage(text)
+    gate = threading.Event()
+    load = storage.load
+    storage.load = lambda: gate.wait() and load()
+    thread = storage.load_background()
+    storage.append("1", {"type": "expense", "amount": 1, "category": "Еда"})
+    gate.set()
+    thread.join()
+    with pytest.raises(OSError):
+        storage.wait_loaded()
+    with pytest.raises(OSError):
+        storage.append("1", {"type": "expense", "amount": 2,
+                             "category": "Еда"})
+    with open(text, encoding="utf-8") as f:
+        assert f.read() == '{"1": [{"type": "inc'
+    with pytest.raises(ValueError):
+        snapshot.dumps({"1": [{"type": "income", "amount": "5",
+                               "category": "Еда"}]})
+
+
+def test_recurring_tick_catches_up_in_one_flush(tmp_path):
+    """Тест 41: проход расписания добавляет пропущенные операции пачкой"""
+    storage = JsonStorage(str(tmp_path / "d.json"), journal=True)
+    recurring = Recurring(str(tmp_path / "recurring.json"))
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0), recurring=recurring)
+    start = datetime(2026, 1, 20).timestamp()
+    recurring.add("1", "income", "Зарплата", 80000, 10, now=start)
+    recurring.add("1", "expense", "Жилье", 30000, 31, now=start)
+    recurring.add("2", "expense", "Образование", 500, 25, now=start)
+    storage.append("1", {"type": "income", "amount": 100,
+                         "category": "Премия", "ts": int(start)})
+    assert storage.summary("1").income == 100
+    assert asyncio.run(bot.tick_recurring(now=start)) == 0
+
+    # бот не работал до 15 апреля: зарплата 10.02, 10.03, 10.04,
+    # аренда 31.01, 28.02, 31.03, подписка 25.01, 25.02, 25.03
+    flushes = storage.flush_stats["flushes"]
+    now = datetime(2026, 4, 15).timestamp()
+    assert asyncio.run(bot.tick_recurring(now=now)) == 9
+    assert storage.flush_stats["flushes"] == flushes + 1
+    assert storage.summary("1").income == 240100
+    assert storage.summary("1").expense == 90000
+    assert storage.month_summary("2", 2026, 2).expense == 500
+    assert [date.fromtimestamp(r["ts"]).day for r in storage.records("1")
+            if r["category"] == "Жилье"] == [31, 28, 31]
+    assert asyncio.run(bot.tick_recurring(now=now)) == 0
+    storage.close()
+
+    # сдвинутые сроки сохранены: после перезапуска операции не повторяются
+    restarted = Recurring(recurring.path)
+    assert [date.fromtimestamp(r["next"]) for r in restarted.get("1")] == [
+        date(2026, 5, 10), date(2026, 4, 30)]
+    assert restarted.due(now) == {}
+
+    app = bot.build_app()
+    assert [job.name for job in app.job_queue.jobs()] == ["recurring"]
+
+
+def test_recurring_failed_write_keeps_schedule(tmp_path):
+    """Негативный тест: после ошибки записи операции не повторяются"""
+    storage = JsonStorage(str(tmp_path / "d.json"))
+    recurring = Recurring(str(tmp_path / "recurring.json"))
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0), recurring=recurring)
+    start = datetime(2026, 1, 20).timestamp()
+    recurring.add("1", "expense", "Жилье", 30000, 1, now=start)
+    now = datetime(2026, 3, 2).timestamp()
+    os.mkdir(storage.path + ".tmp")
+    with pytest.raises(OSError):
+        asyncio.run(bot.tick_recurring(now=now))
+    assert not os.path.exists(storage.path)
+    assert Recurring(recurring.path).get("1")[0]["next"] == datetime(
+        2026, 2, 1).timestamp()
+
+    # следующий проход сохраняет те же две операции и сдвинутые сроки
+    os.rmdir(storage.path + ".tmp")
+    assert asyncio.run(bot.tick_recurring(now=now)) == 0
+    assert len(storage.records("1")) == 2
+    assert storage.summary("1").expense == 60000
+    reloaded = JsonStorage(storage.path)
+    reloaded.load()
+    assert len(reloaded.records("1")) == 2
+    assert reloaded.summary("1").expense == 60000
+    assert Recurring(recurring.path).get("1")[0]["next"] == datetime(
+        2026, 4, 1).timestamp()
+
+
+def test_batch_writes_check_budgets(tmp_path):
+    """Тест 46: регулярные и импортированные расходы проверяют бюджет"""
+    sent = []
+
+    async def send_message(chat_id, text):
+        sent.append((chat_id, text))
+
+    storage = JsonStorage(str(tmp_path / "d.json"))
+    recurring = Recurring(str(tmp_path / "recurring.json"))
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0), recurring=recurring,
+                     budgets=Budgets(str(tmp_path / "budgets.json")))
+    context = SimpleNamespace(bot=SimpleNamespace(send_message=send_message))
+    start = datetime(2026, 1, 20).timestamp()
+    bot.budgets.set("1", "Жилье", 30000)
+    bot.budgets.set("2", "Жилье", 30000)
+    recurring.add("1", "expense", "Жилье", 25000, 1, now=start)
+    recurring.add("1", "expense", "Жилье", 5000, 2, now=start)
+    recurring.add("2", "expense", "Жилье", 1000, 1, now=start)
+
+    # перерасход за февраль уже не предупреждает,
+    # две операции одной категории дают одно сообщение
+    now = datetime(2026, 3, 3).timestamp()
+    assert asyncio.run(bot.tick_recurring(context, now=now)) == 6
+    assert sent == [(1, "Бюджет на Жилье превышен: 30000 из 30000 руб."
+                        " за месяц (100%)")]
+
+    path = tmp_path / "statement.csv"
+    path.write_text("Дата;Сумма;Описание\n"
+                    f"{date.today():%d.%m.%Y};-700;Пятерочка\n"
+                    f"{date.today():%d.%m.%Y};-200;Магнит\n",
+                    encoding="utf-8")
+    bot.budgets.set("3", "Еда", 1000)
+    replies = []
+    update = FakeUpdate(3, None, replies, FakeDocument(str(path)))
+    asyncio.run(bot.hand_doc(update, FakeContext()))
+    assert replies[-1][1].endswith(
+        "Внимание: на Еда потрачено 900.0 из 1000 руб. "
+        "за месяц (90%)")
+
+
+def test_repeat_command(tmp_path):
+    """Тест 42: /repeat добавляет, показывает и удаляет правила"""
+    bot = FinanceBot("test_token",
+                     storage=JsonStorage(str(tmp_path / "d.json")),
+                     charts=ChartRenderer(workers=0),
+                     recurring=Recurring(str(tmp_path / "recurring.json")))
+    replies = []
+
+    def repeat(*args):
+        text = " ".join(("/repeat",) + args)
+        asyncio.run(bot.hand_repeat(FakeUpdate(1, text, replies),
+                                    FakeContext(args=list(args))))
+        return replies[-1][1]
+
+    assert repeat().startswith("Регулярных операций нет")
+    assert repeat("расход", "Жилье", "30000", "5").startswith(
+        "Расход Жилье 30000.0 руб. будет добавляться каждый месяц")
+    assert repeat("доход", "Зарплата", "80000", "10")
+    for wrong in (("расход", "Кино", "100", "5"),
+                  ("расход", "Жилье", "100", "32"),
+                  ("расход", "Жилье", "-1", "5"),
+                  ("перевод", "Жилье", "100", "5")):
+        assert repeat(*wrong).startswith("Например: /repeat")
+    listing = repeat()
+    assert "1. Расход Жилье: 30000.0 руб., 5 числа" in listing
+    assert "2. Доход Зарплата: 80000.0 руб., 10 числа" in listing
+    assert repeat("удалить", "1") == (
+        "Регулярная операция удалена: Жилье 30000.0 руб.")
+    assert repeat("удалить", "5").startswith("Например: /repeat удалить")
+    assert [r["category"] for r in bot.recurring.get("1")] == ["Зарплата"]
+
+
+def test_journal_torn_tail_and_corruption(tmp_path):
+    """Негативный тест: отрезается только оборванная последняя строка"""
+    path = str(tmp_path / "d.json")
+    storage = JsonStorage(path, journal=True)
+    storage.load()
+    for amount in (1, 2):
+        storage.append("1", {"type": "income", "amount": amount,
+                             "category": "Премия"})
+    storage.close()
+    with open(storage.journal_path, "ab") as f:
+        f.write(b'{"seq": 3, "user": "1", "rec": {"ty')
+
+    storage = JsonStorage(path, journal=True)
+    assert [r["amount"] for r in storage.load()["1"]] == [1, 2]
+    storage.append("1", {"type": "income", "amount": 3,
+                         "category": "Премия"})
+    storage.close()
+    assert [r["amount"] for r in
+            JsonStorage(path, journal=True).load()["1"]] == [1, 2, 3]
+
+    with open(storage.journal_path, "rb") as f:
+        lines = f.readlines()
+    lines[0] = b"{garbage\n"
+    with open(storage.journal_path, "wb") as f:
+        f.writelines(lines)
+    with pytest.raises(snapshot.SnapshotError):
+        JsonStorage(path, journal=True).load()
+
+
+def test_failed_compaction_keeps_batch_written(tmp_path, monkeypatch):
+    """Негативный тест: ошибка сжатия не записывает пачку второй раз"""
+    path = str(tmp_path / "d.json")
+    storage = JsonStorage(path, journal=True, journal_limit=1, fsync=False)
+    storage.load()
+    replace = os.replace
+    monkeypatch.setattr(os, "replace", lambda *args: (_ for _ in ()).throw(
+        OSError("диск недоступен")))
+    for amount in (1, 2):
+        storage.append("1", {"type": "income", "amount": amount,
+                             "category": "Премия"})
+    assert storage.pending == []
+    monkeypatch.setattr(os, "replace", replace)
+    storage.append("1", {"type": "income", "amount": 3,
+                         "category": "Премия"})
+    storage.close()
+    assert [r["amount"] for r in
+            JsonStorage(path, journal=True).load()["1"]] == [1, 2, 3]
+
+
+def test_render_recovers_after_worker_death():
+    """Негативный тест: погибший процесс пула и ошибка отрисовки"""
+    charts = ChartRenderer(workers=1, timeout=60)
+    data = {"Зарплата": 1000.0}
+    assert asyncio.run(charts.render("income", data)).startswith(b"\x89PNG")
+    for pid in list(charts._pool._processes):
+        os.kill(pid, signal.SIGKILL)
+    data = {"Зарплата": 2000.0}
+    assert asyncio.run(charts.render("income", data)) is None
+    assert asyncio.run(charts.render("income", data)).startswith(b"\x89PNG")
+    assert charts.pending == 0
+    charts.close()
+
+    for workers in (0, 1):
+        charts = ChartRenderer(workers=workers, timeout=60)
+        assert asyncio.run(charts.render(
+            "expense", {"Еда": -5.0, "Жилье": 10.0})) is None
+        charts.close()
+
+
+def test_inline_render_keeps_loop_responsive(monkeypatch):
+    """Тест 48: без пула диаграмма рисуется в потоке, а цикл событий
+    продолжает отвечать"""
+    def slow_pie(kind, by_category, fmt="png"):
+        time.sleep(0.3)
+        return b"\x89PNG"
+
+    monkeypatch.setattr(charts_module, "render_pie", slow_pie)
+    charts = ChartRenderer(workers=0)
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        png = await charts.render("income", {"Зарплата": 1000.0})
+        task.cancel()
+        return png, ticks
+
+    png, ticks = asyncio.run(scenario())
+    assert png == b"\x89PNG"
+    assert ticks >= 10
+    assert charts.pending == 0
+
+
+def test_failed_flush_is_retried(tmp_path, monkeypatch):
+    """Негативный тест: ошибка записи не теряет пачку и не ломает flusher"""
+    storage = SqliteStorage(str(tmp_path / "d.db"), durability="batched",
+                            flush_interval=0.01)
+    write = storage._write_batch
+    failures = [OSError("диск недоступен")]
+
+    def flaky(batch):
+        if failures:
+            raise failures.pop()
+        write(batch)
+
+    storage._write_batch = flaky
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0),
+                     budgets=Budgets(str(tmp_path / "budgets.json")))
+
+    async def scenario():
+        await bot.post_init(None)
+        storage.append("1", {"type": "income", "amount": 1,
+                             "category": "Премия"})
+        await asyncio.sleep(0.05)
+        assert not failures and not bot.flusher.done()
+        storage.append("1", {"type": "income", "amount": 2,
+                             "category": "Премия"})
+        await asyncio.sleep(0.05)
+        assert storage.pending == []
+
+        async def broken():
+            raise OSError("задача упала")
+
+        storage.append("1", {"type": "income", "amount": 3,
+                             "category": "Премия"})
+        bot.flusher = asyncio.create_task(broken())
+        await asyncio.sleep(0)
+        await bot.post_stop(None)
+
+    asyncio.run(scenario())
+    assert [r["amount"] for r in storage.records("1")] == [1, 2, 3]
+    storage.close()
+
+    # недописанная пачка журнала отрезается и пишется заново
+    path = str(tmp_path / "d.json")
+    storage = JsonStorage(path, journal=True)
+    storage.load()
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: (_ for _ in ()).throw(
+        OSError("fsync")))
+    with pytest.raises(OSError):
+        storage.append("1", {"type": "income", "amount": 1,
+                             "category": "Премия"})
+    monkeypatch.setattr(os, "fsync", fsync)
+    storage.append("1", {"type": "income", "amount": 2,
+                         "category": "Премия"})
+    storage.close()
+    assert [r["amount"] for r in
+            JsonStorage(path, journal=True).load()["1"]] == [1, 2]
+
+
+def test_export_streams_file(tmp_path):
+    """Тест 44: выгрузка передается PTB файлом, а не прочитанными байтами"""
+    storage = JsonStorage(str(tmp_path / "d.json"))
+    bot = FinanceBot("test_token", storage=storage,
+                     charts=ChartRenderer(workers=0))
+    storage.append("1", {"type": "income", "amount": 10,
+                         "category": "Премия", "ts": 1700000000})
+    update = FakeUpdate(1, "/export")
+    sent = []
+
+    async def reply_document(document, **kwargs):
+        sent.append((document.input_file_content, document.filename))
+        assert document.input_file_content.read().startswith(b"\xef\xbb\xbf")
+
+    update.message.reply_document = reply_document
+    asyncio.run(bot.hand_export(update, FakeContext()))
+    content, filename = sent[0]
+    assert not isinstance(content, bytes)
+    assert filename == "finflow_operations.csv"
+
+
+def test_worker_outbox_shares_global_limit():
+    """Тест 45: узлы кластера вместе не превышают лимит Bot API"""
+    outboxes = [worker_outbox(4) for _ in range(4)]
+    assert sum(o._global.rate for o in outboxes) == 30
+    assert sum(o._global.burst for o in outboxes) <= 30
+    assert outboxes[0].chat_limits == Outbox().chat_limits
+    assert worker_outbox(64)._global.burst == 1